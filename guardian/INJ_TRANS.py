@@ -31,8 +31,35 @@ The pathway for a successful injection is:
       jump back to the WAIT_FOR_NEXT_INJECT state to wait to perform the next
       injection.
 
+If coalesce_injections is True then the READ_WAVEFORM state also reads the
+following injections of the same type that start less than
+coalesce_gap_seconds after the end of the previous waveform, and uploads a
+GraceDB event for each of them. Their waveforms are injected with one stream
+with zeros in the gaps.
+
+If pipeline_injections is True then while an injection is in the
+_INJECT_STATE_ACTIVE state the next injection is prepared in a background
+thread, ie. steps (4) and (5) and creating its stream. Once the active
+injection has finished, the WAIT_FOR_NEXT_INJECT state jumps straight to the
+AWG_STREAM_OPEN_PREINJECT state for the prepared injection.
+
 Other states are for failures or waiting for external alerts.
 
+If an injection is interrupted, eg. by INJECT_KILL or
+FAILURE_DURING_ACTIVE_INJECT, then the number of samples that were delivered
+is logged and a schedule line to resume the injection is appended to
+resume_path. The line has a seventh column with the sample offset to resume
+from. To resume the injection copy the line into the schedule file and change
+its GPS start time; the stream then starts at that time with the remaining
+samples of the waveform.
+
+The schedule line, GraceDB ID, state times, and TINJ_OUTCOME value of each
+injection are recorded in the SQLite database at history_path. It can be
+queried with injtools.InjectionHistory, eg.
+    injtools.InjectionHistory(history_path).query(
+        schedule_state="INJECT_CBC_ACTIVE", failed=True,
+        start_time=start_time, end_time=end_time)
+
 Operating the Node
 ------------------
 
@@ -71,6 +98,7 @@ authenticated and at the time the robot certificate should be renewed.
 import injtools
 import os.path
 import sys
+import time
 import traceback
 from gpstime import gpstime
 from guardian import GuardStateDecorator
@@ -104,21 +132,149 @@ exttrig_wait_seconds = 3600
 # seconds to check for an imminent hardware injection
 # eg. if set to 300 seconds then begin uploading to GraceDB and read
 # waveform file 300 seconds in advance of hardware injection start time
+# if adaptive_imminent is True then this is the maximum seconds to check
 imminent_seconds = 300
 
+# if True then estimate the seconds to check for each imminent hardware
+# injection from the waveform file size and the measured throughput of the
+# READ_WAVEFORM state and GraceDB latency, the estimate is between
+# min_imminent_seconds and imminent_seconds
+adaptive_imminent = True
+
+# minimum seconds to check for an imminent hardware injection
+min_imminent_seconds = 60
+
+# if True then prepare the next injection while an injection is active so
+# injections can be back-to-back, the schedule then only needs
+# min_pipeline_gap_seconds between the end of a waveform and the start of the
+# next injection instead of imminent_seconds between start times
+pipeline_injections = False
+min_pipeline_gap_seconds = 2
+
+# only prepare the next injection while an injection is active if it starts
+# within this many seconds of the start of the active injection
+pipeline_look_ahead_seconds = 3600
+
+# if True then injections of the same type that start less than
+# coalesce_gap_seconds after the end of the waveform of the previous injection
+# are injected with one stream, the schedule then does not need
+# imminent_seconds between their start times if the waveform lengths are known
+coalesce_injections = False
+coalesce_gap_seconds = 10
+
 # maximum seconds in advance before jump to injection state
 # eg. if set to 2 seconds then jump from AWG_STREAM_OPEN_PREINJECT to
 # _INJECT_STATE_ACTIVE 2 seconds in advance of hardware injection start time
 jump_to_inj_seconds = 20
 
+# uploading an injection to GraceDB must finish this many seconds before its
+# scheduled time so there is time left to create the stream and read the
+# waveform, calls to GraceDB are retried until then, see injtools.gracedb_call
+gracedb_deadline_seconds = 40
+
 # sample rate of excitation channel and waveform files
 sample_rate = 16384
 
+# paths to filter files applied in order to the waveform as it is sent to the
+# excitation channel, eg. to compensate the actuation response, see
+# injtools.inj_filter for the file format; if empty then no filtering
+actuation_filter_paths = []
+
+# if True then a schedule time that is not a whole number of samples is
+# injected by starting the stream on a whole sample and delaying the waveform
+# by the remaining fraction of a sample, the fraction is from the fractional
+# second in the schedule file; this filters every waveform and delays the
+# end of each injection so it is off by default
+align_start = False
+
+# limits on the samples appended to the stream, ie. the waveform after the
+# fractional delay and the actuation filters, the scale factor is not applied
+# to the excitation; if a limit is None then it is not checked; waveforms with
+# NaN or Inf samples are never injected
+max_peak_amplitude = None
+max_rms_amplitude = None
+max_slew = None
+
+# map injection states to the frequency band in Hz where the power of the
+# waveform is expected to be and the minimum fraction of power that must be
+# in the band, if a state is not in the dict or the fraction is None then the
+# band is not checked; the check estimates a power spectral density of the
+# whole waveform in READ_WAVEFORM so it is off by default, the schedule
+# validation script checks the band with --min-band-fraction before the
+# injection instead, and if it is switched on here its time is included in
+# the lead time that READ_WAVEFORM measures for lead_time_estimator
+band_dict = injtools.default_band_dict
+min_band_power_fraction = None
+
+# path to file where lead-time margins are written when jumping to the
+# _INJECT_STATE_ACTIVE state, eg. how many seconds were left before the
+# injection would have been a FAILURE_INJECT_IN_PAST
+margin_path = os.path.dirname(__file__) + "/log/lead_time_margin.txt"
+
+# name of channel to write lead-time margin, if None then do not write
+margin_channel_name = None
+
+# path to SQLite database where the schedule line, GraceDB ID, state times,
+# and TINJ_OUTCOME value of each injection are recorded
+history_path = os.path.dirname(__file__) + "/log/history.sqlite"
+
+# records the history of injections
+injection_history = injtools.InjectionHistory(history_path)
+
+# records the latency of each state used to prepare an injection
+state_timer = injtools.StateTimer(margin_path,
+                                  injection_history=injection_history,
+                                  log=lambda message: log(message))
+
+# GPS time the node was loaded, the last injection that GraceDB updates are
+# posted to must be scheduled after this time so an injection from a previous
+# run of the node is not updated
+run_start_time = gpstime.utcnow().gps()
+
+# path to directory where profiles of states are written, profiling is
+# switched on for states listed in the INJ_PROFILE_STATES environment variable
+# or for profile_state_names while profile_channel_name is nonzero
+profile_dir = os.path.dirname(__file__) + "/log/profile"
+
+# name of channel to switch on profiling, if None then do not read
+profile_channel_name = None
+
+# states to profile when profile_channel_name is nonzero
+profile_state_names = ["CREATE_GRACEDB_EVENT", "CREATE_AWG_STREAM",
+                       "READ_WAVEFORM"]
+
+# profiles the CPU time and memory of states
+state_profiler = injtools.StateProfiler(profile_dir,
+                                        state_names=profile_state_names,
+                                        channel_name=profile_channel_name)
+
+# estimates the seconds to check for each imminent hardware injection
+lead_time_estimator = injtools.LeadTimeEstimator(state_timer,
+                                                 min_imminent_seconds,
+                                                 imminent_seconds,
+                                                 jump_to_inj_seconds)
+
+# prepares the next injection while an injection is active
+injection_pipeline = injtools.InjectionPipeline()
+
+# injections that had a stream or were sent data when streams were last
+# killed, the INJECT_KILL state records them as killed
+killed_injections = []
+
+# path to file where a schedule line is appended for each injection that was
+# interrupted with the sample offset to resume the injection from
+resume_path = os.path.dirname(__file__) + "/log/resume.txt"
+
+# path to shared-memory directory where guardian_inj_waveform_prep.py writes
+# prepared waveforms, if None then the node reads the waveform files itself
+shm_dir = None
+
 # path to schedule file
 schedule_path = os.path.dirname(__file__) + "/schedule/schedule_1148558052.txt"
 
-# read schedule
-hwinj_list = injtools.read_schedule(schedule_path)
+# read schedule the first time it is used, the INIT state reads it so that an
+# error in the schedule file is found when the node starts
+hwinj_list = injtools.LazySchedule(schedule_path)
 
 # a boolean that turns off code blocks to run guardian daemon for development
 # at the dev_mode does the following:
@@ -126,6 +282,13 @@ hwinj_list = injtools.read_schedule(schedule_path)
 #   * Does not check if there is an external alert
 dev_mode = False
 
+# URL of a GraceDB emulator, eg. started with guardian_inj_gracedb_benchmark.py
+# --serve, to upload to instead of GraceDB for testing the node offline, if
+# None then upload to GraceDB
+gracedb_emulator_url = None
+if gracedb_emulator_url is not None:
+    injtools.set_gracedb_backend(lambda: injtools.EmulatorClient(gracedb_emulator_url))
+
 # map injection states to GraceDB groups
 gracedb_group_dict = {
     "INJECT_CBC_ACTIVE" : "CBC",
@@ -134,6 +297,373 @@ gracedb_group_dict = {
     "INJECT_DETCHAR_ACTIVE" : "Burst",
 }
 
+# legacy of the old setup to map injection states to TINJ_TYPE
+tinj_type_dict = {
+    "INJECT_CBC_ACTIVE" : 1,
+    "INJECT_BURST_ACTIVE" : 2,
+    "INJECT_DETCHAR_ACTIVE" : 3,
+    "INJECT_STOCHASTIC_ACTIVE" : 4,
+}
+
+def get_actuation_filters():
+    """ Returns the filters applied to the waveform as it is sent to the
+    excitation channel.
+
+    Returns
+    ----------
+    filters: list
+        A list of ActuationFilter instances, empty if there are no actuation
+        filter files.
+    """
+    filters = []
+    if actuation_filter_paths:
+        filters.append(injtools.ActuationFilter(actuation_filter_paths))
+    return filters
+
+def check_waveform(hwinj, log):
+    """ Checks that the waveform data of a hardware injection is safe to
+    inject and that its power is in the expected frequency band. The safety
+    limits are checked on the samples that send_data appends to the stream,
+    ie. after the fractional delay and the actuation filters.
+
+    Parameters
+    ----------
+    hwinj: HardwareInjection
+        The injection with its stream created, its data read, and its
+        filters from get_actuation_filters.
+    log: function
+        The function to log messages with, it is passed in so that the
+        injection can be checked in the thread of injection_pipeline.
+
+    Returns
+    ----------
+    problems: list
+        A list of str describing each problem. If the waveform can be
+        injected then the list is empty.
+    """
+
+    # generated noise, including noise resumed from a sample offset, is not
+    # scanned since it would be generated twice, instead its expected RMS
+    # amplitude from its power spectral density is checked and its samples
+    # are checked block by block in send_data; its frequency band is not
+    # checked since its power spectral density is given in its spec
+    if hasattr(hwinj.data, "expected_rms"):
+        rms = hwinj.data.expected_rms
+        log("Generated noise expected RMS amplitude %e"%rms)
+        if max_rms_amplitude is not None and rms > max_rms_amplitude:
+            return ["Generated noise expected RMS amplitude %e exceeds limit %e"
+                    %(rms, max_rms_amplitude)]
+        return []
+
+    # check samples appended to the stream are safe to inject, the scan is
+    # cached by the waveform, the sample offset, and the filters
+    key = None
+    if hwinj.waveform_key is not None:
+        filter_paths = [filter_path for block_filter in hwinj.filters
+                        for filter_path in block_filter.filter_paths]
+        key = "%s:%d:%s:%s"%(hwinj.waveform_key, hwinj.sample_offset,
+                             getattr(hwinj.fractional_delay, "step", None),
+                             ",".join(filter_paths))
+    scan = injtools.scan_waveform_blocks(hwinj.iter_stream_blocks(), key=key)
+    log("Waveform peak amplitude %e, RMS amplitude %e, and maximum slew %e"
+        %(scan.peak, scan.rms, scan.max_slew))
+    problems = injtools.check_waveform_scan(scan, max_peak=max_peak_amplitude,
+                                            max_rms=max_rms_amplitude,
+                                            max_slew=max_slew)
+    if problems:
+        return problems
+
+    # check power of waveform is in the expected frequency band, a waveform
+    # that is resampled as it is sent is checked at the rate of its file
+    band = band_dict.get(hwinj.schedule_state)
+    if band and min_band_power_fraction is not None:
+        waveform, rate = hwinj.data, sample_rate
+        if hasattr(waveform, "input_rate"):
+            waveform, rate = waveform.waveform, waveform.input_rate
+        fraction = injtools.band_power_fraction(waveform, rate,
+                                                band, key=hwinj.waveform_key)
+        log("Waveform has %f of its power between %f and %f Hz"
+            %(fraction, band[0], band[1]))
+        if fraction < min_band_power_fraction:
+            problems.append("Waveform has less than %f of its power in the expected band"
+                            %min_band_power_fraction)
+
+    return problems
+
+def get_waveform_seconds(hwinj):
+    """ Returns the length in seconds of the waveform of a hardware injection
+    from its waveform_length attribute or the length sidecar file of its
+    waveform file. The length of a row of a ScheduleTable, or of an injection
+    made from a row, is from the schedule snapshot.
+
+    Parameters
+    ----------
+    hwinj: {HardwareInjection, ScheduleRow}
+        The injection.
+
+    Returns
+    ----------
+    seconds: float
+        Length of the waveform in seconds. If it is not known then None.
+    """
+    length = getattr(hwinj, "waveform_length", None)
+    if length is None and getattr(hwinj, "schedule_row", None) is not None:
+        length = hwinj.schedule_row.waveform_length
+    if callable(length):
+        length = length(ezca.ifo)
+    if length is not None:
+        return float(length - hwinj.sample_offset) / sample_rate
+    path = injtools.find_converted_waveform(hwinj.waveform_path.format(ifo=ezca.ifo))
+    length = injtools.read_waveform_length(path)
+    if length is None:
+        return None
+    rate = injtools.read_waveform_rate(path) or sample_rate
+    return float(length) / rate - float(hwinj.sample_offset) / sample_rate
+
+def coalesce_injection(hwinj, ifo, log, cancel=None):
+    """ Reads the waveforms of the injections after a hardware injection
+    that can be injected with the same stream, and uploads a GraceDB event
+    for each of them. The data of the hardware injection is replaced by the
+    combined data of all the injections.
+
+    Parameters
+    ----------
+    hwinj: HardwareInjection
+        The first injection with its data read.
+    ifo: str
+        The IFO, eg. H1.
+    log: function
+        The function to log messages with.
+    cancel: threading.Event
+        If not None then stop adding injections once it is set, eg. when
+        injection_pipeline is reset.
+
+    Returns
+    ----------
+    coalesced_hwinj_list: list
+        The HardwareInjection instances injected with the stream, starting
+        with hwinj.
+    skipped_hwinj: HardwareInjection
+        The injection that should have been coalesced but could not be, eg.
+        its waveform could not be read. CHECK_SCHEDULE_TIMES let it start
+        before hwinj could be finished so it cannot be injected after hwinj,
+        see record_skipped_injection. If there is none then None.
+    """
+
+    # data generated in blocks, ie. generated noise and waveforms resampled
+    # as they are sent, is not coalesced since it is not in memory
+    coalesced_hwinj_list = [hwinj]
+    skipped_hwinj = None
+    if hasattr(hwinj.data, "iter_blocks"):
+        return coalesced_hwinj_list, skipped_hwinj
+
+    # add following injections while the gap to the end of the previous
+    # waveform is short enough
+    format_dict = {
+        "ifo" : ifo,
+    }
+    while cancel is None or not cancel.is_set():
+        last_hwinj = coalesced_hwinj_list[-1]
+        next_hwinj = injtools.get_next_injection(hwinj_list, last_hwinj)
+        if next_hwinj is None \
+                or next_hwinj.schedule_state != last_hwinj.schedule_state \
+                or next_hwinj.observation_mode != last_hwinj.observation_mode:
+            break
+        gap = next_hwinj.schedule_time - last_hwinj.schedule_time \
+                  - float(len(last_hwinj.data)) / sample_rate
+        if gap < 0 or gap >= coalesce_gap_seconds:
+            break
+
+        # read and check waveform and upload GraceDB event unless it was
+        # uploaded by an earlier attempt, the upload must finish before the
+        # first injection starts
+        try:
+            next_hwinj.data = next_hwinj.read_data(format_dict=format_dict,
+                                                   shm_dir=shm_dir,
+                                                   sample_rate=sample_rate)
+            next_hwinj.filters = get_actuation_filters()
+            if hasattr(next_hwinj.data, "iter_blocks"):
+                raise ValueError("Data generated in blocks is not coalesced")
+            problems = check_waveform(next_hwinj, log)
+            if problems:
+                raise ValueError(" ".join(problems))
+            if next_hwinj.gracedb_id is None:
+                group = gracedb_group_dict[next_hwinj.schedule_state]
+                next_hwinj.gracedb_id = injtools.gracedb_upload_injection(next_hwinj,
+                                            [ifo], group=group,
+                                            deadline=hwinj.schedule_time - jump_to_inj_seconds)
+        except:
+            etype, val, tb = sys.exc_info()
+            log(str(etype) + " " + str(val))
+            log("Not coalescing injection: %s"%str(next_hwinj))
+            next_hwinj.release_data()
+            skipped_hwinj = next_hwinj
+            break
+        log("Coalescing injection with GraceDB ID %s: %s"
+            %(next_hwinj.gracedb_id, str(next_hwinj)))
+        coalesced_hwinj_list.append(next_hwinj)
+
+    # replace data with the combined data
+    if len(coalesced_hwinj_list) > 1:
+        hwinj.data = injtools.CoalescedData(hwinj.schedule_time, sample_rate,
+                                            coalesced_hwinj_list,
+                                            block_size=injtools.send_block_size)
+    for coalesced_hwinj in coalesced_hwinj_list:
+        coalesced_hwinj.coalesced_hwinj_list = coalesced_hwinj_list
+    return coalesced_hwinj_list, skipped_hwinj
+
+def record_skipped_injection(skipped_hwinj, hwinj):
+    """ Logs and records the failure outcome of an injection that could not
+    be coalesced with a hardware injection, see coalesce_injection. The
+    pending outcome of the hardware injection is then set again.
+
+    Parameters
+    ----------
+    skipped_hwinj: HardwareInjection
+        The injection that could not be coalesced. If None then nothing is
+        done.
+    hwinj: HardwareInjection
+        The injection that is pending.
+    """
+    if skipped_hwinj is None:
+        return
+    log("Skipping injection since it could not be coalesced and starts "
+        "before the injection it was scheduled with ends: %s"%str(skipped_hwinj))
+    set_outcome(-4, hwinj=skipped_hwinj)
+    set_outcome(0, hwinj=hwinj)
+
+def prepare_injection(hwinj, cancel, ifo, log):
+    """ Prepares a hardware injection while another injection is active. This
+    does the work of the CREATE_GRACEDB_EVENT, CREATE_AWG_STREAM, and
+    READ_WAVEFORM states and is run in a background thread by
+    injection_pipeline. The thread does not use the globals of the guardian
+    node, so the IFO and the log function are passed in.
+
+    Parameters
+    ----------
+    hwinj: HardwareInjection
+        The injection to prepare.
+    cancel: threading.Event
+        Set when injection_pipeline is reset, it is checked between steps.
+    ifo: str
+        The IFO, eg. H1.
+    log: function
+        The function to log messages with.
+
+    Returns
+    ----------
+    skipped_hwinj: HardwareInjection
+        The injection that could not be coalesced, see coalesce_injection.
+        The main thread records its outcome since the thread cannot. If
+        there is none then None.
+    """
+
+    # upload hardware injection to GraceDB unless it was uploaded by an
+    # earlier attempt
+    if hwinj.gracedb_id is None:
+        group = gracedb_group_dict[hwinj.schedule_state]
+        hwinj.gracedb_id = injtools.gracedb_upload_injection(hwinj, [ifo],
+                               group=group,
+                               deadline=hwinj.schedule_time - gracedb_deadline_seconds)
+    log("Prepared GraceDB ID is " + hwinj.gracedb_id)
+    if cancel.is_set():
+        return None
+
+    # create stream
+    hwinj.create_stream(ifo + ":" + exc_channel_name, sample_rate,
+                        align_start=align_start)
+    if cancel.is_set():
+        return None
+
+    # read and check waveform
+    format_dict = {
+        "ifo" : ifo,
+    }
+    hwinj.data = hwinj.read_data(format_dict=format_dict, shm_dir=shm_dir,
+                                 sample_rate=sample_rate)
+    hwinj.filters = get_actuation_filters()
+    if cancel.is_set():
+        return None
+    problems = check_waveform(hwinj, log)
+    if problems:
+        raise ValueError(" ".join(problems))
+    if coalesce_injections and not cancel.is_set():
+        return coalesce_injection(hwinj, ifo, log, cancel=cancel)[1]
+    return None
+
+def release_prepared_injection(hwinj):
+    """ Closes the stream and releases the data of a hardware injection that
+    was being prepared when injection_pipeline was reset. This is called in
+    the thread of injection_pipeline after prepare_injection stops.
+
+    Parameters
+    ----------
+    hwinj: HardwareInjection
+        The injection that was being prepared.
+    """
+    injtools.close_all_streams(hwinj.coalesced_hwinj_list or [hwinj])
+
+def set_outcome(outcome, hwinj=None, overwrite=True):
+    """ Sets the legacy TINJ_OUTCOME value and records it in the injection
+    history. Errors writing the history are logged and not raised.
+
+    Parameters
+    ----------
+    outcome: int
+        The TINJ_OUTCOME value.
+    hwinj: HardwareInjection
+        The injection. If None then the injection recorded last in the
+        injection history.
+    overwrite: bool
+        If False then do not change an outcome in the injection history that
+        is final, ie. 1 or a negative failure code.
+    """
+    ezca[outcome_channel_name] = outcome
+    try:
+        injection_history.record_outcome(outcome, gpstime.utcnow().gps(),
+                                         hwinj=hwinj, overwrite=overwrite)
+    except:
+        etype, val, tb = sys.exc_info()
+        log(str(etype) + " " + str(val))
+
+def record_interrupted_injections(hwinj_list):
+    """ Records how many samples were delivered by each stream that is being
+    killed, and appends a schedule line to resume_path for each injection
+    that was started but not finished. Only injections whose data was sent
+    to the stream with send_data are recorded, an injection that was only
+    prepared has not started. Errors are logged and not raised so that the
+    streams are still killed.
+
+    Parameters
+    ----------
+    hwinj_list: list
+        A list of HardwareInjection instances.
+    """
+    try:
+        current_gps_time = gpstime.utcnow().gps()
+        for hwinj in hwinj_list:
+            if not hwinj.data_sent or hwinj.stream is None \
+                    or hwinj.data is None \
+                    or hwinj.schedule_time > current_gps_time:
+                continue
+            for interrupted_hwinj in injtools.record_samples_delivered(
+                                         hwinj, current_gps_time, sample_rate):
+                log("Injection was interrupted after sample %d: %s"
+                    %(interrupted_hwinj.samples_delivered, str(interrupted_hwinj)))
+                line = injtools.format_schedule_line(interrupted_hwinj,
+                           sample_offset=interrupted_hwinj.samples_delivered)
+                resume_dir = os.path.dirname(resume_path)
+                if resume_dir and not os.path.exists(resume_dir):
+                    os.makedirs(resume_dir)
+                fp = open(resume_path, "a")
+                fp.write(line + "\n")
+                fp.close()
+    except:
+        etype, val, tb = sys.exc_info()
+        ftb = traceback.format_tb(tb)
+        for line in ftb: log(line)
+        log(str(etype) + " " + str(val))
+
 def check_exttrig_alert(hwinj_list, failure_state):
     """ Create a GuardStateDecorator to check if there is an external alert.
 
@@ -173,7 +703,9 @@ def check_exttrig_alert(hwinj_list, failure_state):
 
                 # if there is an external alert then close all streams
                 try:
-                    injtools.close_all_streams(hwinj_list)
+                    injection_pipeline.reset()
+                    record_interrupted_injections(injtools.active_injections)
+                    injtools.close_all_streams()
                 except:
                     etype, val, tb = sys.exc_info()
                     ftb = traceback.format_tb(tb)
@@ -213,8 +745,17 @@ def gracedb_post_inject_update(hwinj_list, text, label=None,
             """ Do this before entering the GuardState.
             """
 
-            # get last hardware injection from schedule
-            hwinj = injtools.get_last_injection(hwinj_list)
+            # get last hardware injection from injection history or from
+            # schedule if the history cannot be read
+            try:
+                hwinj = injtools.get_last_injection(hwinj_list,
+                                                    history=injection_history,
+                                                    start_time=run_start_time)
+            except:
+                etype, val, tb = sys.exc_info()
+                log(str(etype) + " " + str(val))
+                hwinj = injtools.get_last_injection(hwinj_list,
+                                                    start_time=run_start_time)
 
             # if no GraceDB ID found then go to failuire state
             if not hwinj:
@@ -224,21 +765,23 @@ def gracedb_post_inject_update(hwinj_list, text, label=None,
                 log("Could not find GraceDB ID.")
                 return "FAILURE_TO_FIND_GRACEDB_ID"
 
-            # upload message and label for GraceDB event
+            # upload message and label for GraceDB event of each injection
+            # if injections were coalesced
             try:
-                injtools.gracedb_upload_message(hwinj.gracedb_id, text)
-                if label:
-                    injtools.gracedb_add_label(hwinj.gracedb_id, label)
-
-                # if verbose
-                if include_schedule_line:
-                    line = " ".join(map(str, [hwinj.schedule_time,
-                                              hwinj.schedule_state,
-                                              hwinj.observation_mode,
-                                              hwinj.scale_factor,
-                                              hwinj.waveform_path,
-                                              hwinj.metadata_path]))
-                    injtools.gracedb_upload_message(hwinj.gracedb_id, line)
+                for coalesced_hwinj in hwinj.coalesced_hwinj_list or [hwinj]:
+                    injtools.gracedb_upload_message(coalesced_hwinj.gracedb_id, text)
+                    if label:
+                        injtools.gracedb_add_label(coalesced_hwinj.gracedb_id, label)
+
+                    # if verbose
+                    if include_schedule_line:
+                        line = " ".join(map(str, [coalesced_hwinj.schedule_time,
+                                                  coalesced_hwinj.schedule_state,
+                                                  coalesced_hwinj.observation_mode,
+                                                  coalesced_hwinj.scale_factor,
+                                                  coalesced_hwinj.waveform_path,
+                                                  coalesced_hwinj.metadata_path]))
+                        injtools.gracedb_upload_message(coalesced_hwinj.gracedb_id, line)
 
             # if an unexpected error was encountered then
             # jump to failure state
@@ -251,14 +794,39 @@ def gracedb_post_inject_update(hwinj_list, text, label=None,
 
     return gracedb_post_inject_update_decorator
 
-def kill_all_streams(hwinj_list):
+def load_schedule():
+    """ Reads the schedule file if it has not been read. Errors are logged
+    and not raised.
+
+    Returns
+    ----------
+    loaded: bool
+        True if the schedule was read.
+    """
+    try:
+        hwinj_list.load()
+    except:
+        etype, val, tb = sys.exc_info()
+        ftb = traceback.format_tb(tb)
+        for line in ftb: log(line)
+        log(str(etype) + " " + str(val))
+        return False
+    return True
+
+def kill_all_streams(hwinj_list, keep_prepared=False):
     """ Create a GuardStateDecorator that aborts all streams and resets the
     HardwareInjection.stream class attribute to None.
 
+    Only the injections in injtools.active_injections hold a stream or data
+    so the streams of the other injections in hwinj_list are not checked.
+
     Parameters
     ----------
     hwinj_list: list
         A list of HardwareInjection instances.
+    keep_prepared: bool
+        If True then do not abort the stream of the injection prepared by
+        injection_pipeline, otherwise stop using the prepared injection too.
 
     Returns
     ----------
@@ -275,9 +843,29 @@ def kill_all_streams(hwinj_list):
             """ Do this before entering the GuardState.
             """
 
+            # an injection is over so discard profiles of run methods that
+            # did not return, eg. because a decorator jumped to another state
+            state_profiler.discard()
+
             # close all streams
             try:
-                injtools.close_all_streams(hwinj_list)
+                if keep_prepared:
+                    keep = [injection_pipeline.hwinj]
+                    if injection_pipeline.hwinj is not None:
+                        keep += injection_pipeline.hwinj.coalesced_hwinj_list or []
+                else:
+                    keep = []
+                    injection_pipeline.reset()
+                    record_interrupted_injections(injtools.active_injections)
+
+                    # remember the injections that are killed
+                    del killed_injections[:]
+                    killed_injections.extend(
+                        [hwinj for hwinj in injtools.active_injections
+                         if hwinj.stream is not None or hwinj.data_sent])
+
+                # only injections that hold a stream or data are closed
+                injtools.close_all_streams(keep=keep)
             except:
                 etype, val, tb = sys.exc_info()
                 ftb = traceback.format_tb(tb)
@@ -298,6 +886,11 @@ class INIT(injtools.HwinjGuardState):
     def main(self):
         """ Execute method once.
         """
+
+        # read the schedule now instead of when it is first used
+        if not load_schedule():
+            return "FAILURE_READ_SCHEDULE"
+
         return True
 
 class WAIT_FOR_NEXT_INJECT(injtools.HwinjGuardState):
@@ -318,10 +911,20 @@ class WAIT_FOR_NEXT_INJECT(injtools.HwinjGuardState):
     # determines if state appears on guardian MEDM screen dropdown menu
     request = False
 
-    @kill_all_streams(hwinj_list)
+    @kill_all_streams(hwinj_list, keep_prepared=True)
     def main(self):
         """ Execute method once.
         """
+
+        # check if profiling is switched on for the next injection
+        try:
+            state_profiler.poll(ezca)
+        except:
+            etype, val, tb = sys.exc_info()
+            ftb = traceback.format_tb(tb)
+            for line in ftb: log(line)
+            log(str(etype) + " " + str(val))
+
         return False
 
     @check_exttrig_alert(hwinj_list, "EXTTRIG_ALERT_ACTIVE")
@@ -329,13 +932,33 @@ class WAIT_FOR_NEXT_INJECT(injtools.HwinjGuardState):
         """ Execute method in a loop.
         """
 
+        # read the schedule if it has not been read, eg. the node was reloaded
+        if not hwinj_list.loaded and not load_schedule():
+            return "FAILURE_READ_SCHEDULE"
+
+        # get the seconds to check for an imminent hardware injection
+        if adaptive_imminent:
+            format_dict = {
+                "ifo" : ezca.ifo,
+            }
+            imminent_wait_time = lambda hwinj: \
+                lead_time_estimator.lead_time(hwinj, format_dict=format_dict)
+        else:
+            imminent_wait_time = imminent_seconds
+
         # get hardware injection in the future that is soonest
-        self.hwinj = injtools.check_imminent_injection(hwinj_list, imminent_seconds)
+        self.hwinj = injtools.check_imminent_injection(hwinj_list, imminent_wait_time)
 
         # if there is no imminent hardware injection then recheck injections
         if not self.hwinj:
             return False
 
+        # if the injection is still being prepared in the background then
+        # recheck until it is finished
+        if injection_pipeline.is_preparing(self.hwinj):
+            notify("PREPARING INJECTION: %f"%self.hwinj.schedule_time)
+            return False
+
         # in dev mode ignore if detector is locked
         # otherwise check if detector is locked
         if ezca[lock_channel_name] == 1 or dev_mode:
@@ -351,7 +974,28 @@ class WAIT_FOR_NEXT_INJECT(injtools.HwinjGuardState):
                 ezca[start_channel_name] = current_gps_time
 
                 # set legacy TINJ_OUTCOME value for pending injection
-                ezca[outcome_channel_name] = 0
+                set_outcome(0, hwinj=self.hwinj)
+
+                # if the injection was prepared while the last injection was
+                # active then jump to wait for it to start
+                if injection_pipeline.is_prepared(self.hwinj):
+                    log("Using injection prepared while last injection was active")
+                    record_skipped_injection(injection_pipeline.result,
+                                             self.hwinj)
+                    ezca[type_channel_name] = tinj_type_dict[self.hwinj.schedule_state]
+                    injection_pipeline.reset()
+                    return "AWG_STREAM_OPEN_PREINJECT"
+                elif self.hwinj is injection_pipeline.hwinj:
+                    if injection_pipeline.error:
+                        log(injection_pipeline.error)
+                    log("Could not use prepared injection so preparing it again")
+                    injection_pipeline.reset()
+                    try:
+                        injtools.close_all_streams([self.hwinj])
+                    except:
+                        etype, val, tb = sys.exc_info()
+                        log(str(etype) + " " + str(val))
+                        return "FAILURE_TO_KILL_STREAM"
 
                 return True
 
@@ -360,12 +1004,12 @@ class WAIT_FOR_NEXT_INJECT(injtools.HwinjGuardState):
             else:
                 log("Ignoring hardware injection since detector is not in " \
                     + "the desired observation mode.")
-                ezca[outcome_channel_name] = -5
+                set_outcome(-5, hwinj=self.hwinj)
 
         # set legacy TINJ_OUTCOME value for detector not locked
         else:
             log("Ignoring hardware injection since detector is not locked.")
-            ezca[outcome_channel_name] = -6
+            set_outcome(-6, hwinj=self.hwinj)
 
         return False
 
@@ -411,6 +1055,8 @@ class CHECK_SCHEDULE_TIMES(injtools.HwinjGuardState):
     # determines if state appears on guardian MEDM screen dropdown menu
     request = False
 
+    @injtools.timed_state(state_timer)
+    @injtools.profiled_state(state_profiler)
     def main(self):
         """ Execute this method once.
         """
@@ -420,8 +1066,9 @@ class CHECK_SCHEDULE_TIMES(injtools.HwinjGuardState):
         notify("INJECTION IMMINENT: %f"%self.hwinj.schedule_time)
         if not self.hwinj: return "FAILURE_INJECT_IN_PAST"
 
-        # get a sorted list of hardware injections by their start time
-        sorted_hwinj_list = sorted(hwinj_list, key=lambda hwinj: hwinj.schedule_time)
+        # get the rows of the schedule sorted by their start time, the rows are
+        # checked without making a HardwareInjection for each of them
+        sorted_hwinj_list = hwinj_list.table
 
         # if this is the first injection that will be performed then do check
         # otherwise continue because check would have already been done
@@ -430,12 +1077,25 @@ class CHECK_SCHEDULE_TIMES(injtools.HwinjGuardState):
 
             # check that no two injections are too close together
             # this is a safeguard to do before an injection in case someone
-            # did not validate the schedule
+            # did not validate the schedule; if injections are pipelined then
+            # only the waveforms must be apart if their lengths are known, and
+            # injections that will be coalesced do not need to be apart
             for hwinj_1, hwinj_2 in zip(sorted_hwinj_list, sorted_hwinj_list[1:]):
                 dt = hwinj_2.schedule_time - hwinj_1.schedule_time
-                if dt > 0 and abs(dt) < imminent_seconds:
+                min_dt = imminent_seconds
+                waveform_seconds = get_waveform_seconds(hwinj_1) \
+                    if pipeline_injections or coalesce_injections else None
+                if waveform_seconds is not None:
+                    dt -= waveform_seconds
+                    if coalesce_injections and 0 <= dt < coalesce_gap_seconds \
+                            and hwinj_1.schedule_state == hwinj_2.schedule_state \
+                            and hwinj_1.observation_mode == hwinj_2.observation_mode:
+                        continue
+                    if pipeline_injections:
+                        min_dt = min_pipeline_gap_seconds
+                if hwinj_2.schedule_time > hwinj_1.schedule_time and dt < min_dt:
                     message = "Schedule has two injections %f seconds"%dt \
-                        + " apart but must be at least %f"%imminent_seconds \
+                        + " apart but must be at least %f"%min_dt \
                         + " seconds apart"
                     log(message)
                     log("Injections are %s and %s"%(str(hwinj_1), str(hwinj_2)))
@@ -459,6 +1119,8 @@ class CREATE_GRACEDB_EVENT(injtools.HwinjGuardState):
     request = False
 
     @check_exttrig_alert(hwinj_list, "ABORT_INJECT_FOR_EXTTRIG")
+    @injtools.timed_state(state_timer)
+    @injtools.profiled_state(state_profiler)
     def main(self):
         """ Execute method once.
         """
@@ -469,14 +1131,14 @@ class CREATE_GRACEDB_EVENT(injtools.HwinjGuardState):
         if not self.hwinj: return "FAILURE_INJECT_IN_PAST"
 
         # legacy of the old setup to set TINJ_TYPE
-        tinj_type_dict = {
-            "INJECT_CBC_ACTIVE" : 1,
-            "INJECT_BURST_ACTIVE" : 2,
-            "INJECT_DETCHAR_ACTIVE" : 3,
-            "INJECT_STOCHASTIC_ACTIVE" : 4,
-        }
         ezca[type_channel_name] = tinj_type_dict[self.hwinj.schedule_state]
 
+        # an event uploaded by an earlier attempt, eg. by injection_pipeline
+        # before it was reset, is used again
+        if self.hwinj.gracedb_id is not None:
+            log("Using GraceDB ID " + self.hwinj.gracedb_id)
+            return True
+
         # try to upload an event to GraceDB
         try:
 
@@ -486,9 +1148,12 @@ class CREATE_GRACEDB_EVENT(injtools.HwinjGuardState):
             # log meta-data file path
             log("Reading meta-data from %s"%self.hwinj.metadata_path)
 
-            # upload hardware injection to GraceDB
+            # upload hardware injection to GraceDB, the upload is retried
+            # until gracedb_deadline_seconds before the injection
+            deadline = self.hwinj.schedule_time - gracedb_deadline_seconds
             self.hwinj.gracedb_id = injtools.gracedb_upload_injection(self.hwinj,
-                                           [ezca.ifo], group=group)
+                                           [ezca.ifo], group=group,
+                                           deadline=deadline)
             log("GraceDB ID is " + self.hwinj.gracedb_id)
 
         # if an unexpected error was encountered then jump to failure state
@@ -514,6 +1179,8 @@ class CREATE_AWG_STREAM(injtools.HwinjGuardState):
     request = False
 
     @check_exttrig_alert(hwinj_list, "ABORT_INJECT_FOR_EXTTRIG")
+    @injtools.timed_state(state_timer)
+    @injtools.profiled_state(state_profiler)
     def main(self):
         """ Execute method once.
         """
@@ -527,7 +1194,8 @@ class CREATE_AWG_STREAM(injtools.HwinjGuardState):
         # this is the object from the awg module that will control
         # the injection
         try:
-            self.hwinj.create_stream(ezca.ifo + ":" + exc_channel_name, sample_rate)
+            self.hwinj.create_stream(ezca.ifo + ":" + exc_channel_name, sample_rate,
+                                     align_start=align_start)
         except:
             etype, val, tb = sys.exc_info()
             ftb = traceback.format_tb(tb)
@@ -549,22 +1217,22 @@ class READ_WAVEFORM(injtools.HwinjGuardState):
     request = False
 
     @check_exttrig_alert(hwinj_list, "ABORT_INJECT_FOR_EXTTRIG")
+    @injtools.timed_state(state_timer)
+    @injtools.profiled_state(state_profiler)
     def main(self):
         """ Execute method once.
         """
 
+        # time the whole state for the lead-time estimate since checking and
+        # coalescing the waveform also scale with its size
+        start_time = time.time()
+
         # get hardware injection in the future that is soonest
         self.hwinj = injtools.check_imminent_injection(hwinj_list, imminent_seconds)
         notify("INJECTION IMMINENT: %f"%self.hwinj.schedule_time)
         if not self.hwinj: return "FAILURE_INJECT_IN_PAST"
 
         # legacy of the old setup to set TINJ_TYPE
-        tinj_type_dict = {
-            "INJECT_CBC_ACTIVE" : 1,
-            "INJECT_BURST_ACTIVE" : 2,
-            "INJECT_DETCHAR_ACTIVE" : 3,
-            "INJECT_STOCHASTIC_ACTIVE" : 4,
-        }
         ezca[type_channel_name] = tinj_type_dict[self.hwinj.schedule_state]
 
         # create a dict for formatting strings
@@ -572,10 +1240,13 @@ class READ_WAVEFORM(injtools.HwinjGuardState):
             "ifo" : ezca.ifo,
         }
 
-        # try to read waveform file
+        # try to read waveform file and the actuation filter files
         try:
             log("Reading waveform data from %s"%self.hwinj.waveform_path.format(**format_dict))
-            self.hwinj.data = self.hwinj.read_data(format_dict=format_dict)
+            self.hwinj.data = self.hwinj.read_data(format_dict=format_dict,
+                                                   shm_dir=shm_dir,
+                                                   sample_rate=sample_rate)
+            self.hwinj.filters = get_actuation_filters()
 
         # if an unexpected error was encountered then jump to failure state
         except:
@@ -585,6 +1256,28 @@ class READ_WAVEFORM(injtools.HwinjGuardState):
             log(str(etype) + " " + str(val))
             return "FAILURE_READ_WAVEFORM"
 
+        # check waveform is safe to inject
+        try:
+            problems = check_waveform(self.hwinj, log)
+        except:
+            etype, val, tb = sys.exc_info()
+            ftb = traceback.format_tb(tb)
+            for line in ftb: log(line)
+            log(str(etype) + " " + str(val))
+            return "FAILURE_WAVEFORM_UNSAFE"
+        if problems:
+            for problem in problems: log(problem)
+            return "FAILURE_WAVEFORM_UNSAFE"
+
+        # inject following injections with the same stream
+        if coalesce_injections:
+            skipped_hwinj = coalesce_injection(self.hwinj, ezca.ifo, log)[1]
+            record_skipped_injection(skipped_hwinj, self.hwinj)
+
+        # record how long it took to prepare the waveform
+        lead_time_estimator.record_read(self.hwinj, time.time() - start_time,
+                                        format_dict=format_dict)
+
         return True
 
 class AWG_STREAM_OPEN_PREINJECT(injtools.HwinjGuardState):
@@ -617,6 +1310,7 @@ class AWG_STREAM_OPEN_PREINJECT(injtools.HwinjGuardState):
         return False
 
     @check_exttrig_alert(hwinj_list, "ABORT_INJECT_FOR_EXTTRIG")
+    @injtools.profiled_state(state_profiler)
     def run(self):
         """ Execute method in a loop.
         """
@@ -627,6 +1321,18 @@ class AWG_STREAM_OPEN_PREINJECT(injtools.HwinjGuardState):
         # check if its time to jump to the corresponding _INJECT_STATE_ACTIVE subclass
         current_gps_time = gpstime.utcnow().gps()
         if current_gps_time > self.hwinj.schedule_time - jump_to_inj_seconds:
+
+            # record how many seconds are left before the injection
+            try:
+                margin = state_timer.record_lead_time(self.hwinj, ezca=ezca,
+                                              channel_name=margin_channel_name)
+                log("Lead-time margin is %f seconds"%margin)
+            except:
+                etype, val, tb = sys.exc_info()
+                ftb = traceback.format_tb(tb)
+                for line in ftb: log(line)
+                log(str(etype) + " " + str(val))
+
             return self.hwinj.schedule_state
         elif current_gps_time > self.hwinj.schedule_time:
             return "FAILURE_INJECT_IN_PAST"
@@ -649,6 +1355,7 @@ class _INJECT_STATE_ACTIVE(injtools.HwinjGuardState):
     request = False
 
     @check_exttrig_alert(hwinj_list, "ABORT_INJECT_FOR_EXTTRIG")
+    @injtools.timed_state(state_timer)
     def main(self):
         """ Execute method once.
         """
@@ -658,10 +1365,36 @@ class _INJECT_STATE_ACTIVE(injtools.HwinjGuardState):
         notify("INJECTION ACTIVE: %f"%self.hwinj.schedule_time)
         if not self.hwinj: return "FAILURE_INJECT_IN_PAST"
 
+        # prepare the next injection while this injection is active
+        if pipeline_injections:
+            last_hwinj = (self.hwinj.coalesced_hwinj_list or [self.hwinj])[-1]
+            next_hwinj = injtools.get_next_injection(hwinj_list, last_hwinj)
+
+            # an injection that starts before this injection ends, eg. one
+            # that could not be coalesced, cannot be injected after it
+            end_time = self.hwinj.schedule_time \
+                           + float(len(self.hwinj.data)) / sample_rate
+            while next_hwinj is not None and next_hwinj.schedule_time < end_time:
+                next_hwinj = injtools.get_next_injection(hwinj_list, next_hwinj)
+            if next_hwinj is not None and next_hwinj.schedule_time \
+                    - self.hwinj.schedule_time < pipeline_look_ahead_seconds:
+                log("Preparing next injection: %s"%str(next_hwinj))
+                injection_pipeline.start(next_hwinj, prepare_injection,
+                                         args=(ezca.ifo, log),
+                                         cleanup=release_prepared_injection)
+
         # close stream and perform injection
         # waits for injection to finish
+        # generated noise is not scanned in check_waveform so its samples
+        # are checked as they are sent
         try:
-            self.hwinj.stream.send(self.hwinj.data)
+            monitor = None
+            if hasattr(self.hwinj.data, "expected_rms"):
+                monitor = injtools.WaveformMonitor(len(self.hwinj.data),
+                                                   max_peak=max_peak_amplitude,
+                                                   max_rms=max_rms_amplitude,
+                                                   max_slew=max_slew)
+            self.hwinj.send_data(monitor=monitor)
         except:
             etype, val, tb = sys.exc_info()
             ftb = traceback.format_tb(tb)
@@ -674,13 +1407,17 @@ class _INJECT_STATE_ACTIVE(injtools.HwinjGuardState):
             self.hwinj.stream.abort()
             return "FAILURE_AWG_STREAM_NOT_CLOSED"
 
-        # explicitly record the data from the schedule file
-        log("GPS start time: %f"%self.hwinj.schedule_time)
-        log("Requested state: %s"%self.hwinj.schedule_state)
-        log("Requested observation mode: %d"%self.hwinj.observation_mode)
-        log("Scale factor: %f"%self.hwinj.scale_factor)
-        log("Waveform path: %s"%self.hwinj.waveform_path)
-        log("Meta-data path: %s"%self.hwinj.metadata_path)
+        # explicitly record the data from the schedule file of each
+        # injection if injections were coalesced
+        for hwinj in self.hwinj.coalesced_hwinj_list or [self.hwinj]:
+            log("GPS start time: %f"%hwinj.schedule_time)
+            log("Requested state: %s"%hwinj.schedule_state)
+            log("Requested observation mode: %d"%hwinj.observation_mode)
+            log("Scale factor: %f"%hwinj.scale_factor)
+            log("Waveform path: %s"%hwinj.waveform_path)
+            log("Meta-data path: %s"%hwinj.metadata_path)
+            if hwinj.sample_offset:
+                log("Sample offset: %d"%hwinj.sample_offset)
 
         return True
 
@@ -723,14 +1460,14 @@ class INJECT_SUCCESS(injtools.HwinjGuardState):
     # assign index for state
     index = 200
 
-    @kill_all_streams(hwinj_list)
+    @kill_all_streams(hwinj_list, keep_prepared=True)
     @gracedb_post_inject_update(hwinj_list, "Injection was successful.", label="INJ")
     def main(self):
         """ Execute method once.
         """
 
         # set legacy TINJ_OUTCOME value for successful injection
-        ezca[outcome_channel_name] = 1
+        set_outcome(1)
 
         # legacy of the old setup to set TINJ_END_TIME
         current_gps_time = gpstime.utcnow().gps()
@@ -757,8 +1494,13 @@ class INJECT_KILL(injtools.HwinjGuardState):
     def main(self):
         """ Execute method once.
         """
-        # set legacy TINJ_OUTCOME value for killed injection
-        ezca[outcome_channel_name] = -11
+        # set legacy TINJ_OUTCOME value and record each injection that was
+        # killed, an injection that already has a final outcome is not changed
+        if killed_injections:
+            for hwinj in killed_injections:
+                set_outcome(-11, hwinj=hwinj, overwrite=False)
+        else:
+            ezca[outcome_channel_name] = -11
 
         return False
 
@@ -784,8 +1526,9 @@ class ABORT_INJECT_FOR_EXTTRIG(injtools.HwinjGuardState):
         """ Execute method once.
         """
 
-        # set legacy TINJ_OUTCOME value for failed injection
-        ezca[outcome_channel_name] = -4
+        # set legacy TINJ_OUTCOME value for failed injection, if no injection
+        # was active then the outcome of the last injection is not changed
+        set_outcome(-4, overwrite=False)
 
         # legacy of the old setup to set TINJ_END_TIME
         current_gps_time = gpstime.utcnow().gps()
@@ -812,8 +1555,9 @@ class _INJECT_FAILURE(injtools.HwinjGuardState):
         """ Execute method once.
         """
 
-        # set legacy TINJ_OUTCOME value for failed injection
-        ezca[outcome_channel_name] = -4
+        # set legacy TINJ_OUTCOME value for failed injection, if no injection
+        # was active then the outcome of the last injection is not changed
+        set_outcome(-4, overwrite=False)
 
         # legacy of the old setup to set TINJ_END_TIME
         current_gps_time = gpstime.utcnow().gps()
@@ -843,8 +1587,9 @@ class _INJECT_FAILURE_GRACEDB(injtools.HwinjGuardState):
         """ Execute method once.
         """
 
-        # set legacy TINJ_OUTCOME value for failed injection
-        ezca[outcome_channel_name] = -4
+        # set legacy TINJ_OUTCOME value for failed injection, if no injection
+        # was active then the outcome of the last injection is not changed
+        set_outcome(-4, overwrite=False)
 
         # legacy of the old setup to set TINJ_END_TIME
         current_gps_time = gpstime.utcnow().gps()
@@ -898,6 +1643,81 @@ class FAILURE_READ_WAVEFORM(_INJECT_FAILURE):
     # assign index for state
     index = 240
 
+class FAILURE_WAVEFORM_UNSAFE(_INJECT_FAILURE):
+    """ The FAILURE_WAVEFORM_UNSAFE state is for a waveform that has NaN or
+    Inf samples, whose samples appended to the stream, ie. after the
+    fractional delay and the actuation filters, exceed the amplitude or slew
+    limits, or that has too little of its power in the frequency band
+    expected for its injection state. The limits are checked without the
+    scale factor since the node does not apply it to the excitation.
+    """
+
+    # assign index for state
+    index = 245
+
+class FAILURE_TO_KILL_STREAM(injtools.HwinjGuardState):
+    """ The FAILURE_TO_KILL_STREAM state indicates that a stream could not be
+    aborted or closed. It does not try to kill the streams again, request
+    INJECT_KILL to try again.
+    """
+
+    # assign index for state
+    index = 260
+
+    # determines if state appears on guardian MEDM screen dropdown menu
+    request = False
+
+    def main(self):
+        """ Execute method once.
+        """
+
+        # legacy of the old setup to set TINJ_END_TIME
+        current_gps_time = gpstime.utcnow().gps()
+        ezca[end_channel_name] = current_gps_time
+
+        return False
+
+    def run(self):
+        """ Execute method in a loop.
+        """
+
+        # notify operator
+        notify("ERROR")
+
+        return False
+
+class FAILURE_READ_SCHEDULE(injtools.HwinjGuardState):
+    """ The FAILURE_READ_SCHEDULE state indicates that the schedule file
+    could not be read. Once the schedule file is fixed and the node is
+    reloaded the schedule is read again and there is an edge transition to
+    the WAIT_FOR_NEXT_INJECT state.
+    """
+
+    # assign index for state
+    index = 320
+
+    # determines if state appears on guardian MEDM screen dropdown menu
+    request = False
+
+    def main(self):
+        """ Execute method once.
+        """
+        return False
+
+    def run(self):
+        """ Execute method in a loop.
+        """
+
+        # notify operator until the schedule can be read
+        if not hwinj_list.loaded:
+            try:
+                hwinj_list.load()
+            except:
+                notify("ERROR READING SCHEDULE")
+                return False
+
+        return True
+
 class FAILURE_INJECT_IN_PAST(_INJECT_FAILURE):
     """ The FAILURE_INJECT_IN_PAST state is a state used to log
     when a hardware injection was aborted because the scheduled
@@ -965,9 +1785,12 @@ edges = (
     ("FAILURE_TO_FIND_GRACEDB_ID", "WAIT_FOR_NEXT_INJECT"),
     ("FAILURE_ADDING_GRACEDB_MESSAGE", "WAIT_FOR_NEXT_INJECT"),
     ("FAILURE_READ_WAVEFORM", "WAIT_FOR_NEXT_INJECT"),
+    ("FAILURE_WAVEFORM_UNSAFE", "WAIT_FOR_NEXT_INJECT"),
     ("FAILURE_INJECT_IN_PAST", "WAIT_FOR_NEXT_INJECT"),
     ("FAILURE_AWG_STREAM_NOT_CLOSED", "WAIT_FOR_NEXT_INJECT"),
     ("FAILURE_DURING_ACTIVE_INJECT", "WAIT_FOR_NEXT_INJECT"),
     ("FAILURE_SCHEDULED_TWO_INJECT_TOO_CLOSE", "WAIT_FOR_NEXT_INJECT"),
+    ("FAILURE_TO_KILL_STREAM", "WAIT_FOR_NEXT_INJECT"),
+    ("FAILURE_READ_SCHEDULE", "WAIT_FOR_NEXT_INJECT"),
 )
 
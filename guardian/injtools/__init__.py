@@ -1,6 +1,21 @@
 # -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
 
+from inj_lazy import *
 from inj_det import *
 from inj_io import *
 from inj_types import *
 from inj_upload import *
+from inj_emulator import *
+from inj_timing import *
+from inj_profile import *
+from inj_shm import *
+from inj_snapshot import *
+from inj_validation import *
+from inj_spectral import *
+from inj_synth import *
+from inj_noise import *
+from inj_resample import *
+from inj_filter import *
+from inj_pipeline import *
+from inj_coalesce import *
+from inj_history import *
@@ -0,0 +1,62 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ coalesce guardian module
+
+This module provides a class for combining the waveforms of closely spaced
+hardware injections so they are injected with a single stream.
+
+2016 - Christopher M. Biwer
+"""
+
+import numpy
+
+class CoalescedData(object):
+    """ A class that combines the data of several HardwareInjection instances
+    into one time series that starts at the schedule time of the first
+    injection. The gaps between injections are zero. The combined time series
+    is not stored, instead it is built block by block as it is sent.
+
+    Each injection is offset by the nearest whole number of samples to its
+    schedule time.
+
+    Parameters
+    ----------
+    start_time: float
+        Start time of the combined time series in GPS seconds.
+    sample_rate: int
+        Sample rate of the time series.
+    hwinj_list: list
+        HardwareInjection instances with their data read as numpy arrays.
+    block_size: int
+        Number of samples in each block.
+    """
+
+    def __init__(self, start_time, sample_rate, hwinj_list, block_size=2**16):
+        self.parts = []
+        for hwinj in hwinj_list:
+            offset = int(round((hwinj.schedule_time - start_time) * sample_rate))
+            self.parts.append((offset, hwinj.data))
+        self.length = max([offset + len(data) for offset, data in self.parts])
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.length
+
+    def iter_blocks(self):
+        """ Builds the combined time series in blocks of block_size samples.
+
+        Yields
+        ----------
+        block: numpy.array
+            The next block of the time series.
+        """
+        for start in range(0, self.length, self.block_size):
+            end = min(start + self.block_size, self.length)
+            block = numpy.zeros(end - start)
+            for offset, data in self.parts:
+                lo = max(start, offset)
+                hi = min(end, offset + len(data))
+                if lo < hi:
+                    block[lo - start:hi - start] += data[lo - offset:hi - offset]
+            yield block
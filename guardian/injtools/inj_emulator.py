@@ -0,0 +1,316 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ emulator guardian module
+
+This module provides a local HTTP server that emulates the parts of GraceDB
+used to upload hardware injections, and a client for it with the same
+createEvent, writeLog, and writeLabel methods as the GraceDB client. This
+allows the upload functions in inj_upload to be benchmarked and stress-tested
+on an offline machine, eg.
+
+    server = injtools.GraceDbEmulator(latency=0.05, error_rate=0.01)
+    server.start()
+    injtools.set_gracedb_backend(lambda: injtools.EmulatorClient(server.url))
+
+The emulator can add latency to each request, fail a fraction of requests
+with HTTP status 500, and limit the rate of requests with HTTP status 429.
+
+2016 - Christopher M. Biwer
+"""
+
+import json
+import random
+import re
+import threading
+import time
+
+# the HTTP modules were renamed in python 3
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import urllib2 as urllib_request
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import urllib.request as urllib_request
+
+# paths of the emulated GraceDB API
+event_path = re.compile(r"^/events/?$")
+log_path = re.compile(r"^/events/(?P<graceid>[^/]+)/log/?$")
+label_path = re.compile(r"^/events/(?P<graceid>[^/]+)/labels/(?P<label>[^/]+)/?$")
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ An HTTPServer that handles each request in a thread. The listen
+    queue is longer than the default so many clients can connect at once.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+class _GraceDbRequestHandler(BaseHTTPRequestHandler):
+    """ Handles the requests to a GraceDbEmulator. The emulator is the
+    emulator attribute of the server.
+    """
+
+    def log_message(self, format, *args):
+        """ Do not write a line to stderr for each request.
+        """
+        pass
+
+    def _send_json(self, status, content, headers=None):
+        """ Sends a JSON response.
+        """
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        """ Applies the latency, rate limit, and error rate of the emulator
+        and then dispatches the request.
+        """
+        emulator = self.server.emulator
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length).decode("utf-8")) \
+                      if length else {}
+
+        # emulate the time to handle the request
+        emulator.count("requests")
+        emulator.wait()
+
+        # emulate rate limit and server errors
+        if not emulator.acquire_token():
+            emulator.count("rate_limited")
+            self._send_json(429, {"error" : "Request was throttled"},
+                            headers={"Retry-After" : "1"})
+            return
+        if random.random() < emulator.error_rate:
+            emulator.count("errors")
+            self._send_json(500, {"error" : "Emulated server error"})
+            return
+
+        # dispatch request
+        if method == "POST" and event_path.match(self.path):
+            status, content = emulator.create_event(request)
+        elif method == "POST" and log_path.match(self.path):
+            match = log_path.match(self.path)
+            status, content = emulator.write_log(match.group("graceid"), request)
+        elif method == "PUT" and label_path.match(self.path):
+            match = label_path.match(self.path)
+            status, content = emulator.write_label(match.group("graceid"),
+                                                   match.group("label"))
+        elif method == "GET" and self.path.rstrip("/") == "/stats":
+            status, content = 200, emulator.get_stats()
+        else:
+            status, content = 404, {"error" : "Unknown path %s"%self.path}
+        self._send_json(status, content)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+class GraceDbEmulator(object):
+    """ A class that runs a local HTTP server that emulates creating GraceDB
+    events and adding log messages and labels to them. Events are kept in
+    memory.
+
+    Parameters
+    ----------
+    host: str
+        Host name to listen on.
+    port: int
+        Port to listen on. If 0 then a free port is used.
+    latency: float
+        Seconds to wait before responding to each request.
+    latency_jitter: float
+        Maximum seconds of uniformly distributed random latency added to
+        latency.
+    error_rate: float
+        Fraction of requests that fail with HTTP status 500.
+    rate_limit: float
+        Maximum requests per second before requests fail with HTTP status
+        429. If None then there is no rate limit.
+    burst: int
+        Number of requests that can be made at once before the rate limit
+        applies.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0,
+                 latency_jitter=0.0, error_rate=0.0, rate_limit=None, burst=1):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = max(int(burst), 1)
+        self.lock = threading.Lock()
+        self.events = {}
+        self.stats = {"requests" : 0, "errors" : 0, "rate_limited" : 0}
+        self.tokens = float(self.burst)
+        self.token_time = time.time()
+        self.server = _ThreadingHTTPServer((host, port), _GraceDbRequestHandler)
+        self.server.emulator = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """ Returns the URL of the server.
+        """
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/"%(host, port)
+
+    def start(self):
+        """ Starts the server in a background thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops the server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key):
+        """ Increments a counter in the stats.
+        """
+        with self.lock:
+            self.stats[key] += 1
+
+    def wait(self):
+        """ Sleeps for the latency of a request.
+        """
+        seconds = self.latency + random.uniform(0, self.latency_jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def acquire_token(self):
+        """ Returns True if a request is within the rate limit. The rate limit
+        is a token bucket that holds burst tokens and is refilled at
+        rate_limit tokens per second.
+        """
+        if self.rate_limit is None:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.token_time) * self.rate_limit,
+                              self.burst)
+            self.token_time = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def create_event(self, request):
+        """ Creates an event and returns its GraceDB ID.
+        """
+        with self.lock:
+            graceid = "H%d"%(len(self.events) + 1)
+            self.events[graceid] = {"request" : request, "log" : [],
+                                    "labels" : []}
+        return 201, {"graceid" : graceid, "group" : request.get("group"),
+                     "pipeline" : request.get("pipeline")}
+
+    def write_log(self, graceid, request):
+        """ Adds a log message to an event.
+        """
+        with self.lock:
+            if graceid not in self.events:
+                return 404, {"error" : "Unknown event %s"%graceid}
+            self.events[graceid]["log"].append(request)
+            n = len(self.events[graceid]["log"])
+        return 201, {"N" : n, "comment" : request.get("message")}
+
+    def write_label(self, graceid, label):
+        """ Adds a label to an event.
+        """
+        with self.lock:
+            if graceid not in self.events:
+                return 404, {"error" : "Unknown event %s"%graceid}
+            self.events[graceid]["labels"].append(label)
+        return 201, {"name" : label}
+
+    def get_stats(self):
+        """ Returns the counts of requests, errors, rate-limited requests, and
+        events.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["events"] = len(self.events)
+        return stats
+
+class EmulatorResponse(object):
+    """ A class representing a response from a GraceDbEmulator. Like the
+    response of the GraceDB client it has a status attribute and a json
+    method.
+    """
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+class EmulatorClient(object):
+    """ A class with the createEvent, writeLog, and writeLabel methods of the
+    GraceDB client that sends requests to a GraceDbEmulator. Like the GraceDB
+    client it raises an HTTPError if a request fails.
+
+    Parameters
+    ----------
+    service_url: str
+        URL of the emulator.
+    timeout: float
+        Seconds to wait for each response.
+    """
+
+    def __init__(self, service_url, timeout=30.0):
+        self.service_url = service_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, path, content=None):
+        """ Sends a request with JSON content and returns the response.
+        """
+        data = json.dumps(content).encode("utf-8") if content is not None else None
+        request = urllib_request.Request(self.service_url + path, data=data)
+        request.add_header("Content-Type", "application/json")
+        request.get_method = lambda: method
+        response = urllib_request.urlopen(request, timeout=self.timeout)
+        try:
+            return EmulatorResponse(response.getcode(), response.read())
+        finally:
+            response.close()
+
+    def createEvent(self, group, pipeline, filename, filecontents=None,
+                    search=None, **kwargs):
+        """ Creates an event.
+        """
+        content = {"group" : group, "pipeline" : pipeline,
+                   "filename" : filename, "search" : search}
+        if filecontents is not None:
+            content["filecontents_length"] = len(filecontents)
+        content.update(kwargs)
+        return self._request("POST", "/events/", content)
+
+    def writeLog(self, graceid, message, filename=None, filecontents=None,
+                 tagname=None, **kwargs):
+        """ Adds a log message to an event.
+        """
+        content = {"message" : message, "filename" : filename,
+                   "tagname" : tagname}
+        return self._request("POST", "/events/%s/log/"%graceid, content)
+
+    def writeLabel(self, graceid, label):
+        """ Adds a label to an event.
+        """
+        return self._request("PUT", "/events/%s/labels/%s/"%(graceid, label))
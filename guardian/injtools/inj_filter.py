@@ -0,0 +1,297 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ filter guardian module
+
+This module provides a class for filtering a waveform in blocks as it is sent
+to the excitation channel, eg. to compensate the actuation response, so that
+waveform files do not need to be filtered offline.
+
+A filter file is an ASCII file of coefficients. A file with a ".sos"
+extension has one row per second-order section with the six coefficients
+b0 b1 b2 a0 a1 a2. A file with a ".fir" extension has one column of FIR
+filter taps.
+
+This module also provides a class for delaying a waveform by a fraction of a
+sample, so that an injection starts at a schedule time that is not a whole
+number of samples.
+
+2016 - Christopher M. Biwer
+"""
+
+import numpy
+import os
+import os.path
+from inj_lazy import LazyModule
+
+# scipy is slow to import so it is imported when first used
+signal = LazyModule("scipy.signal")
+
+# cache of filter coefficients keyed by path
+filter_coefficient_cache = {}
+
+# number of zeros filtered at a time when flushing second-order sections
+flush_block_size = 1024
+
+# second-order sections are flushed until the output is less than this
+# fraction of the peak output
+flush_tolerance = 1e-9
+
+# maximum number of samples returned when flushing second-order sections
+max_flush_samples = 2**20
+
+def read_filter(filter_path):
+    """ Reads the coefficients of a filter file. Coefficients are cached by
+    path and are read again if the modification time of the file changes.
+
+    Parameters
+    ----------
+    filter_path: str
+        Path to a ".sos" or ".fir" filter file.
+
+    Returns
+    ----------
+    ftype: str
+        Either "sos" or "fir".
+    coefficients: numpy.array
+        An array of second-order sections with shape (n_sections, 6) or an
+        array of FIR filter taps.
+    """
+
+    # check cache
+    mtime = os.path.getmtime(filter_path)
+    if filter_path in filter_coefficient_cache \
+            and filter_coefficient_cache[filter_path][0] == mtime:
+        return filter_coefficient_cache[filter_path][1:]
+
+    # read file
+    ext = os.path.splitext(filter_path)[1]
+    if ext == ".sos":
+        ftype = "sos"
+        coefficients = numpy.loadtxt(filter_path, ndmin=2)
+        if coefficients.shape[1] != 6:
+            raise ValueError("Second-order sections must have 6 coefficients: %s"%filter_path)
+    elif ext == ".fir":
+        ftype = "fir"
+        coefficients = numpy.loadtxt(filter_path, ndmin=1)
+    else:
+        raise ValueError("Unknown filter file extension %s"%ext)
+
+    filter_coefficient_cache[filter_path] = (mtime, ftype, coefficients)
+    return ftype, coefficients
+
+class ActuationFilter(object):
+    """ A class that applies a cascade of filters to a time series in blocks.
+    The state of each filter is carried from one block to the next so the
+    output does not depend on how the time series is split into blocks. The
+    state starts at zero since the excitation is zero before the injection.
+    The response of the filters after the last block is returned by the
+    flush method.
+
+    Parameters
+    ----------
+    filter_paths: list
+        Paths to the filter files in the order they are applied.
+    """
+
+    def __init__(self, filter_paths):
+        self.filter_paths = list(filter_paths)
+        self.filters = [read_filter(filter_path) for filter_path in filter_paths]
+        self.reset()
+
+    def reset(self):
+        """ Sets the state of all filters to zero.
+        """
+        self.peak = 0.0
+        self.states = []
+        for ftype, coefficients in self.filters:
+            if ftype == "sos":
+                self.states.append(numpy.zeros((len(coefficients), 2)))
+            else:
+                self.states.append(numpy.zeros(max(len(coefficients) - 1, 0)))
+
+    def process(self, block):
+        """ Filters the next block of the time series.
+
+        Parameters
+        ----------
+        block: numpy.array
+            The next block of the time series.
+
+        Returns
+        ----------
+        output: numpy.array
+            The filtered block.
+        """
+        output = numpy.asarray(block, dtype=numpy.float64)
+        for i, (ftype, coefficients) in enumerate(self.filters):
+            if ftype == "sos":
+                output, self.states[i] = signal.sosfilt(coefficients, output,
+                                                        zi=self.states[i])
+            elif len(coefficients) > 1:
+                output, self.states[i] = signal.lfilter(coefficients, [1.0], output,
+                                                        zi=self.states[i])
+            else:
+                output = output * coefficients[0]
+        if len(output):
+            self.peak = max(self.peak, numpy.abs(output).max())
+        return output
+
+    def flush(self):
+        """ Returns the output of the filters after the last block, ie. their
+        response to zeros, and sets the state of all filters to zero. FIR
+        filters are flushed with one less zero than their number of taps.
+        Second-order sections are flushed until the output is less than
+        flush_tolerance of the peak output, or until max_flush_samples
+        samples.
+
+        Returns
+        ----------
+        output: numpy.array
+            The end of the filtered time series.
+        """
+
+        # FIR filters only need their taps to be flushed
+        n_fir = sum([max(len(coefficients) - 1, 0)
+                     for ftype, coefficients in self.filters if ftype == "fir"])
+        blocks = [self.process(numpy.zeros(n_fir))]
+
+        # IIR filters are flushed until their response has decayed
+        if any([ftype == "sos" for ftype, coefficients in self.filters]):
+            n = len(blocks[0])
+            while n < max_flush_samples:
+                block = self.process(numpy.zeros(flush_block_size))
+                blocks.append(block)
+                n += len(block)
+                if numpy.abs(block).max() <= flush_tolerance * self.peak:
+                    break
+
+        self.reset()
+        return numpy.concatenate(blocks)
+
+# number of samples on each side of the fractional-delay kernel
+fractional_delay_half_width = 16
+
+# fractional delays are rounded to a multiple of 1 / fractional_delay_steps
+# samples so that kernels can be cached
+fractional_delay_steps = 1024
+
+# cache of fractional-delay kernels keyed by rounded fraction
+fractional_delay_cache = {}
+
+def get_fractional_delay_kernel(step):
+    """ Returns the kernel of a Kaiser-windowed sinc filter that delays a time
+    series by fractional_delay_half_width - 1 + step / fractional_delay_steps
+    samples. Kernels are cached by step.
+
+    Parameters
+    ----------
+    step: int
+        The fractional delay in units of 1 / fractional_delay_steps samples.
+
+    Returns
+    ----------
+    kernel: numpy.array
+        The filter taps.
+    """
+    if step not in fractional_delay_cache:
+        n_taps = 2 * fractional_delay_half_width
+        times = numpy.arange(n_taps) - (fractional_delay_half_width - 1) \
+                    - float(step) / fractional_delay_steps
+        kernel = numpy.sinc(times) * numpy.kaiser(n_taps, 8.0)
+        fractional_delay_cache[step] = kernel / kernel.sum()
+    return fractional_delay_cache[step]
+
+def split_start_time(start_time, sample_rate, fraction=None):
+    """ Splits a start time into a start time that is a whole number of
+    samples and a remaining fractional delay. The fraction is rounded to a
+    multiple of 1 / fractional_delay_steps samples.
+
+    A float GPS time only has a precision of about 1e-7 seconds, which is not
+    enough to find a fraction of a sample, so the fractional second should be
+    given separately, eg. parsed exactly from the schedule file. The whole
+    seconds and whole samples are then found with integers.
+
+    Parameters
+    ----------
+    start_time: float
+        The start time in GPS seconds.
+    sample_rate: int
+        Sample rate of the time series.
+    fraction: float
+        The fractional second of the start time. If None then it is found
+        from start_time.
+
+    Returns
+    ----------
+    aligned_time: float
+        The start time rounded down to a whole number of samples.
+    step: int
+        The fractional delay in units of 1 / fractional_delay_steps samples.
+    """
+    if fraction is None:
+        seconds = int(numpy.floor(start_time))
+        fraction = start_time - seconds
+    else:
+        seconds = int(round(start_time - fraction))
+    n_samples = int(numpy.floor(fraction * sample_rate))
+    step = int(round((fraction * sample_rate - n_samples) * fractional_delay_steps))
+    if step == fractional_delay_steps:
+        n_samples += 1
+        step = 0
+    return seconds + float(n_samples) / sample_rate, step
+
+class FractionalDelayFilter(object):
+    """ A class that delays a time series by a fraction of a sample in blocks.
+    The kernel also delays the time series by latency whole samples so the
+    stream should start latency samples early. The end of the filtered time
+    series is returned by the flush method.
+
+    Parameters
+    ----------
+    step: int
+        The fractional delay in units of 1 / fractional_delay_steps samples.
+    """
+
+    def __init__(self, step):
+        self.step = step
+        self.kernel = get_fractional_delay_kernel(step)
+        self.latency = fractional_delay_half_width - 1
+        self.reset()
+
+    def reset(self):
+        """ Sets the carried samples to zero.
+        """
+        self.tail = numpy.zeros(len(self.kernel) - 1)
+
+    def process(self, block):
+        """ Filters the next block of the time series.
+
+        Parameters
+        ----------
+        block: numpy.array
+            The next block of the time series.
+
+        Returns
+        ----------
+        output: numpy.array
+            The filtered block.
+        """
+        output = numpy.convolve(numpy.asarray(block, dtype=numpy.float64),
+                                self.kernel)
+        output[:len(self.tail)] += self.tail
+        self.tail = output[len(block):].copy()
+        return output[:len(block)]
+
+    def flush(self):
+        """ Returns the end of the filtered time series after the last block
+        and sets the carried samples to zero.
+
+        Returns
+        ----------
+        output: numpy.array
+            The end of the filtered time series.
+        """
+        output = self.tail
+        self.reset()
+        return output
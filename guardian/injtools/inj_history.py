@@ -0,0 +1,290 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ history guardian module
+
+This module provides a class for recording the history of hardware injections
+in an SQLite database. For each injection the line from the schedule file, the
+GraceDB ID, the entry and exit times of each state, and the legacy
+TINJ_OUTCOME code are recorded. The database is indexed so that queries, eg.
+all failed CBC injections in a month, do not scan the whole history.
+
+The outcome codes are the legacy TINJ_OUTCOME values, eg. 1 for a successful
+injection, 0 for a pending injection, and a negative value for an injection
+that failed or was ignored.
+
+2016 - Christopher M. Biwer
+"""
+
+import os
+import os.path
+import sqlite3
+import threading
+from inj_types import HardwareInjection
+
+# statements to create the tables and indices of the database
+history_schema = """
+CREATE TABLE IF NOT EXISTS injections (
+    id INTEGER PRIMARY KEY,
+    schedule_time REAL NOT NULL,
+    schedule_state TEXT NOT NULL,
+    observation_mode INTEGER NOT NULL,
+    scale_factor REAL NOT NULL,
+    waveform_path TEXT NOT NULL,
+    metadata_path TEXT NOT NULL,
+    sample_offset INTEGER NOT NULL DEFAULT 0,
+    gracedb_id TEXT,
+    outcome INTEGER NOT NULL DEFAULT 0,
+    outcome_time REAL,
+    UNIQUE (schedule_time, schedule_state, waveform_path, sample_offset)
+);
+CREATE INDEX IF NOT EXISTS injections_time ON injections (schedule_time);
+CREATE INDEX IF NOT EXISTS injections_state_time
+    ON injections (schedule_state, schedule_time);
+CREATE INDEX IF NOT EXISTS injections_outcome_time
+    ON injections (outcome, schedule_time);
+CREATE TABLE IF NOT EXISTS states (
+    injection_id INTEGER NOT NULL REFERENCES injections (id),
+    state_name TEXT NOT NULL,
+    enter_time REAL NOT NULL,
+    exit_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS states_injection ON states (injection_id);
+"""
+
+class InjectionHistory(object):
+    """ A class that records the history of hardware injections in an SQLite
+    database. The database is opened the first time it is used so that
+    loading the guardian node stays fast.
+
+    Parameters
+    ----------
+    db_path: str
+        Path to the SQLite database. It and its directory are created if they
+        do not exist.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = None
+        self.lock = threading.Lock()
+
+        # row IDs, injections by row ID, and last recorded outcomes of
+        # injections recorded by this instance, and the injection recorded last
+        self.injection_ids = {}
+        self.hwinj_dict = {}
+        self.outcomes = {}
+        self.hwinj = None
+
+    def _connect(self):
+        """ Opens the database and creates the directory and tables if needed.
+        """
+        if self.connection is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.executescript(history_schema)
+            connection.commit()
+            self.connection = connection
+        return self.connection
+
+    def _get_injection_id(self, hwinj):
+        """ Returns the row ID of an injection and inserts the row if it is
+        not in the database. The GraceDB ID is updated if it is known.
+        """
+        connection = self._connect()
+        if hwinj not in self.injection_ids:
+            key = (hwinj.schedule_time, hwinj.schedule_state,
+                   hwinj.waveform_path, hwinj.sample_offset)
+            connection.execute("INSERT OR IGNORE INTO injections "
+                               "(schedule_time, schedule_state, observation_mode, "
+                               "scale_factor, waveform_path, metadata_path, "
+                               "sample_offset) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (hwinj.schedule_time, hwinj.schedule_state,
+                                hwinj.observation_mode, hwinj.scale_factor,
+                                hwinj.waveform_path, hwinj.metadata_path,
+                                hwinj.sample_offset))
+            row = connection.execute("SELECT id FROM injections WHERE "
+                                     "schedule_time = ? AND schedule_state = ? "
+                                     "AND waveform_path = ? AND sample_offset = ?",
+                                     key).fetchone()
+            self.injection_ids[hwinj] = row["id"]
+            self.hwinj_dict[row["id"]] = hwinj
+        injection_id = self.injection_ids[hwinj]
+        if hwinj.gracedb_id:
+            connection.execute("UPDATE injections SET gracedb_id = ? WHERE id = ?",
+                               (hwinj.gracedb_id, injection_id))
+        return injection_id
+
+    def record_state(self, state_name, enter_time, exit_time, hwinj=None):
+        """ Records the entry and exit times of a state for an injection.
+
+        Parameters
+        ----------
+        state_name: str
+            Name of the guardian state.
+        enter_time: float
+            GPS time the state was entered.
+        exit_time: float
+            GPS time the state was exited.
+        hwinj: HardwareInjection
+            The injection the state was working on. If None then the
+            injection recorded last.
+        """
+        hwinj = hwinj or self.hwinj
+        if hwinj is None:
+            return
+        with self.lock:
+            injection_id = self._get_injection_id(hwinj)
+            self.connection.execute("INSERT INTO states VALUES (?, ?, ?, ?)",
+                                    (injection_id, state_name, enter_time,
+                                     exit_time))
+            self.connection.commit()
+            self.hwinj = hwinj
+
+    def record_outcome(self, outcome, gps_time, hwinj=None, overwrite=True):
+        """ Records the outcome code of an injection. If injections were
+        coalesced then the outcome is recorded for each of them. The database
+        is only written if the outcome changed.
+
+        Parameters
+        ----------
+        outcome: int
+            The legacy TINJ_OUTCOME code.
+        gps_time: float
+            GPS time of the outcome.
+        hwinj: HardwareInjection
+            The injection. If None then the injection recorded last.
+        overwrite: bool
+            If False then do not change an outcome that is final, ie. 1 for
+            a successful injection or a negative failure code.
+        """
+        hwinj = hwinj or self.hwinj
+        if hwinj is None:
+            return
+        with self.lock:
+            changed = False
+            for coalesced_hwinj in hwinj.coalesced_hwinj_list or [hwinj]:
+                last_outcome = self.outcomes.get(coalesced_hwinj)
+                if last_outcome == outcome:
+                    continue
+                if not overwrite and last_outcome is not None \
+                        and (last_outcome == 1 or last_outcome < 0):
+                    continue
+                injection_id = self._get_injection_id(coalesced_hwinj)
+                self.connection.execute("UPDATE injections SET outcome = ?, "
+                                        "outcome_time = ? WHERE id = ?",
+                                        (outcome, gps_time, injection_id))
+                self.outcomes[coalesced_hwinj] = outcome
+                changed = True
+            if changed:
+                self.connection.commit()
+            self.hwinj = hwinj
+
+    def get_last_injection(self, gps_time, start_time=None):
+        """ Returns the most recent injection in the history before a GPS
+        time. If the injection was recorded by this instance then it is the
+        same HardwareInjection instance, otherwise a HardwareInjection is
+        made from the row.
+
+        Parameters
+        ----------
+        gps_time: float
+            The GPS time.
+        start_time: float
+            If not None then only return an injection scheduled at or after
+            this GPS time, eg. so an injection from a previous run of the node
+            is not returned.
+
+        Returns
+        ----------
+        hwinj: HardwareInjection
+            The injection or None if there is no injection in the history.
+        """
+        statement = "SELECT * FROM injections WHERE schedule_time < ?"
+        values = [gps_time]
+        if start_time is not None:
+            statement += " AND schedule_time >= ?"
+            values.append(start_time)
+        statement += " ORDER BY schedule_time DESC LIMIT 1"
+        with self.lock:
+            row = self._connect().execute(statement, values).fetchone()
+        if row is None:
+            return None
+        if row["id"] in self.hwinj_dict:
+            return self.hwinj_dict[row["id"]]
+        hwinj = HardwareInjection(row["schedule_time"], row["schedule_state"],
+                                  row["observation_mode"], row["scale_factor"],
+                                  row["waveform_path"], row["metadata_path"],
+                                  sample_offset=row["sample_offset"])
+        hwinj.gracedb_id = row["gracedb_id"]
+        return hwinj
+
+    def query(self, schedule_state=None, outcome=None, failed=False,
+              start_time=None, end_time=None):
+        """ Returns the injections in the history that match all of the
+        given conditions, sorted by scheduled time.
+
+        Parameters
+        ----------
+        schedule_state: str
+            Only return injections with this INJECT state.
+        outcome: int
+            Only return injections with this outcome code.
+        failed: bool
+            If True then only return injections with a negative outcome code.
+        start_time: float
+            Only return injections scheduled at or after this GPS time.
+        end_time: float
+            Only return injections scheduled before this GPS time.
+
+        Returns
+        ----------
+        rows: list
+            A sqlite3.Row for each injection with the columns of the
+            injections table.
+        """
+        conditions = []
+        values = []
+        if schedule_state is not None:
+            conditions.append("schedule_state = ?")
+            values.append(schedule_state)
+        if outcome is not None:
+            conditions.append("outcome = ?")
+            values.append(outcome)
+        if failed:
+            conditions.append("outcome < 0")
+        if start_time is not None:
+            conditions.append("schedule_time >= ?")
+            values.append(start_time)
+        if end_time is not None:
+            conditions.append("schedule_time < ?")
+            values.append(end_time)
+        statement = "SELECT * FROM injections"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY schedule_time"
+        with self.lock:
+            return self._connect().execute(statement, values).fetchall()
+
+    def state_times(self, injection_id):
+        """ Returns the entry and exit times of the states of an injection.
+
+        Parameters
+        ----------
+        injection_id: int
+            The id column of the injection.
+
+        Returns
+        ----------
+        rows: list
+            A sqlite3.Row for each state with the state_name, enter_time, and
+            exit_time columns in the order the states were exited.
+        """
+        with self.lock:
+            return self._connect().execute("SELECT state_name, enter_time, "
+                                           "exit_time FROM states WHERE "
+                                           "injection_id = ? ORDER BY exit_time",
+                                           (injection_id,)).fetchall()
@@ -8,22 +8,101 @@ This module provides functions for reading input files.
 2016 - Christopher M. Biwer
 """
 
+import bz2
+import collections
+import decimal
+import gzip
+import hashlib
+import inj_noise
+import inj_resample
+import inj_snapshot
+import inj_synth
 import numpy
+import os
 import os.path
 import sys
 import StringIO
 import traceback
-from glue.ligolw import ilwd, ligolw, lsctables, table, utils
+import warnings
 from gpstime import gpstime
-from inj_types import HardwareInjection
+from inj_lazy import LazyModule
+from inj_types import HardwareInjection, ScheduleTable, schedule_dtype
 
-@lsctables.use_in
-class ContentHandler(ligolw.LIGOLWContentHandler):
-    """ Setup content handler for LIGOLW XML files.
+# glue is slow to import so it is imported when first used
+ilwd = LazyModule("glue.ligolw.ilwd")
+ligolw = LazyModule("glue.ligolw.ligolw")
+lsctables = LazyModule("glue.ligolw.lsctables")
+table = LazyModule("glue.ligolw.table")
+utils = LazyModule("glue.ligolw.utils")
+
+# lzma is only in python 3, otherwise try the backports package
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# map file extensions of compressed waveform files to the class that
+# opens a file object that decompresses the file
+compression_dict = {
+    ".gz" : gzip.GzipFile,
+    ".bz2" : bz2.BZ2File,
+}
+if lzma is not None:
+    compression_dict[".xz"] = lzma.LZMAFile
+
+# map file extensions of waveform files to the ftype used to read them
+waveform_ftype_dict = {
+    ".f64" : "binary",
+}
+
+# data type of samples in binary waveform files
+binary_dtype = numpy.dtype("<f8")
+
+# number of bytes to read at a time from waveform files
+read_block_size = 2**20
+
+# number of samples to scan at a time when checking waveform safety
+scan_block_size = 2**16
+
+# cache of waveform safety scans keyed by waveform key
+safety_scan_cache = {}
+
+# result of a waveform safety scan
+WaveformScan = collections.namedtuple("WaveformScan",
+                   ["length", "finite", "peak", "rms", "max_slew"])
+
+# cache of content hashes of files keyed by path, each value is a tuple of
+# the modification time, size, and hash of the file
+content_hash_cache = {}
+
+# cache of the content handler class since it can only be made after glue
+# is imported
+content_handler_cache = []
+
+def get_content_handler():
+    """ Returns the content handler for LIGOLW XML files. The class is made
+    the first time this function is called.
+
+    Returns
+    ----------
+    ContentHandler: class
+        The content handler for LIGOLW XML files.
     """
-    pass
+    if not content_handler_cache:
+
+        @lsctables.use_in
+        class ContentHandler(ligolw.LIGOLWContentHandler):
+            """ Setup content handler for LIGOLW XML files.
+            """
+            pass
 
-def read_schedule(schedule_path):
+        content_handler_cache.append(ContentHandler)
+    return content_handler_cache[0]
+
+def read_schedule(schedule_path, include_past=False):
     """ Parses schedule file. Schedule file should be a space-delimited file
     with the following ordered columns: GPS start time, INJECT state, observing
     mode, scale factor, path to the waveform file, and path to a meta-data
@@ -49,10 +128,17 @@ def read_schedule(schedule_path):
 
     If there is no meta-data file, then write None.
 
+    An optional seventh column is the sample offset in the waveform to start
+    the injection from, eg. to resume an injection that was interrupted. The
+    waveform is then injected from that sample starting at the GPS start time.
+    If there is no seventh column then the sample offset is 0.
+
     Parameters
     ----------
     schedule_path: str
         Path to the schedule file.
+    include_past: bool
+        If True then also return injections scheduled in the past.
 
     Returns
     ----------
@@ -60,14 +146,184 @@ def read_schedule(schedule_path):
         A list where each element is an HardwareInjection instance.
     """
 
-    # initialize empty list to store HardwareInjection
-    hwinj_list = []
-
     # get the current GPS time
     current_gps_time = gpstime.utcnow().gps()
 
+    # parse schedule file into a table
+    schedule_table = read_schedule_table(schedule_path)
+
+    # keep injections in the future
+    if not include_past:
+        schedule_table = schedule_table[schedule_table.rows["schedule_time"] \
+                                            - current_gps_time > 0]
+
+    return schedule_table.to_hwinj_list()
+
+class LazySchedule(object):
+    """ A class that behaves like the list of HardwareInjection instances
+    returned by read_schedule, but the schedule file is only read the first
+    time the schedule is used. This keeps loading the guardian node fast.
+
+    The schedule is kept as a ScheduleTable sorted by scheduled time and a
+    HardwareInjection is only made for a row when it is used, eg. by
+    find_imminent. The same HardwareInjection is returned each time a row is
+    used so that its stream, data, and GraceDB ID are kept. Iterating over the
+    schedule makes a HardwareInjection for every row, so the guardian node
+    uses the find methods and the table attribute instead.
+
+    Parameters
+    ----------
+    schedule_path: str
+        Path to the schedule file.
+    include_past: bool
+        If True then also include injections scheduled in the past.
+    """
+
+    def __init__(self, schedule_path, include_past=False):
+        self.schedule_path = schedule_path
+        self.include_past = include_past
+        self._table = None
+        self._hwinj_dict = {}
+
+    def load(self):
+        """ Reads the schedule file if it has not been read. Errors reading
+        the schedule file are raised.
+
+        Returns
+        ----------
+        schedule_table: ScheduleTable
+            The rows of the schedule sorted by scheduled time.
+        """
+        if self._table is None:
+            schedule_table = read_schedule_table(self.schedule_path)
+            if not self.include_past:
+                current_gps_time = gpstime.utcnow().gps()
+                schedule_table = schedule_table[schedule_table.rows["schedule_time"] \
+                                                    - current_gps_time > 0]
+            self._table = schedule_table.sort()
+        return self._table
+
+    @property
+    def table(self):
+        """ Returns the ScheduleTable of the schedule sorted by scheduled
+        time. The schedule file is read if it has not been read.
+        """
+        return self.load()
+
+    @property
+    def loaded(self):
+        """ Returns True if the schedule file has been read.
+        """
+        return self._table is not None
+
+    def _get(self, index):
+        """ Returns the HardwareInjection of a row and makes it if it has not
+        been made.
+        """
+        if index not in self._hwinj_dict:
+            self._hwinj_dict[index] = self.table[index].to_hwinj()
+        return self._hwinj_dict[index]
+
+    def find_imminent(self, gps_time, imminent_wait_time):
+        """ Returns the injection in the future that is soonest to a GPS time
+        if it is within imminent_wait_time, see check_imminent_injection.
+
+        Parameters
+        ----------
+        gps_time: float
+            The current GPS time.
+        imminent_wait_time: {float, function}
+            Seconds to check from gps_time, or a function that is called with
+            the soonest HardwareInjection and returns the seconds to check.
+
+        Returns
+        ----------
+        hwinj: HardwareInjection
+            The imminent injection or None.
+        """
+        times = self.table.rows["schedule_time"]
+        index = int(numpy.searchsorted(times, gps_time, side="right"))
+        if index == len(times):
+            return None
+        hwinj = self._get(index)
+        if callable(imminent_wait_time):
+            imminent_wait_time = imminent_wait_time(hwinj)
+        if hwinj.schedule_time - gps_time < imminent_wait_time:
+            return hwinj
+        return None
+
+    def find_next(self, schedule_time):
+        """ Returns the injection that is scheduled soonest after a GPS time.
+        If there is none then None.
+        """
+        times = self.table.rows["schedule_time"]
+        index = int(numpy.searchsorted(times, schedule_time, side="right"))
+        return self._get(index) if index < len(times) else None
+
+    def find_last(self, gps_time):
+        """ Returns the injection that is scheduled most recently before a GPS
+        time. If there is none then None.
+        """
+        times = self.table.rows["schedule_time"]
+        index = int(numpy.searchsorted(times, gps_time, side="left")) - 1
+        return self._get(index) if index >= 0 else None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        for index in range(len(self.table)):
+            yield self._get(index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.table)
+        if not 0 <= index < len(self.table):
+            raise IndexError("LazySchedule index out of range")
+        return self._get(index)
+
+    def __repr__(self):
+        """ String representation of instance.
+        """
+        if self.loaded:
+            return "<LazySchedule %s with %d injections>"%(self.schedule_path,
+                                                          len(self._table))
+        return "<LazySchedule %s not loaded>"%self.schedule_path
+
+def read_schedule_table(schedule_path, use_snapshot=True):
+    """ Parses schedule file into a ScheduleTable. See read_schedule for the
+    format of the schedule file. All injections in the schedule file are in
+    the table including injections in the past.
+
+    Parameters
+    ----------
+    schedule_path: str
+        Path to the schedule file.
+    use_snapshot: bool
+        If True then read the snapshot of the schedule file if it is
+        up-to-date instead of parsing the schedule file.
+
+    Returns
+    ----------
+    schedule_table: ScheduleTable
+        A table with a row for each line in the schedule file.
+    """
+
+    # read snapshot if schedule file has not changed
+    if use_snapshot:
+        schedule_table = inj_snapshot.read_schedule_snapshot(schedule_path)
+        if schedule_table is not None:
+            return schedule_table
+
+    # initialize columns and lists of unique strings
+    columns = [[] for name in schedule_dtype.names]
+    state_names = []
+    state_codes = {}
+    paths = []
+    path_indices = {}
+
     # read lines of schedule file
-    fp = open(schedule_path, "rb")
+    fp = open(schedule_path, "r")
     lines = fp.readlines()
     fp.close()
 
@@ -77,35 +333,650 @@ def read_schedule(schedule_path):
         # get line in schedule as a list of strings
         # assumes its a space-delimited line
         data = line.split()
+        if not data:
+            continue
+
+        # get index of state and paths in lists of unique strings
+        if data[1] not in state_codes:
+            state_codes[data[1]] = len(state_names)
+            state_names.append(data[1])
+        for path in data[4:6]:
+            if path not in path_indices:
+                path_indices[path] = len(paths)
+                paths.append(path)
 
-        # parse line elements into variables
-        i = 0
-        schedule_time = float(data[i]); i += 1
-        schedule_state = data[i]; i += 1
-        observation_mode = int(data[i]); i+= 1
-        scale_factor = float(data[i]); i += 1
-        waveform_path = data[i]; i += 1
-        metadata_path = data[i]; i += 1
+        # parse line elements into columns, the fractional second of the
+        # GPS start time is parsed exactly
+        schedule_time = decimal.Decimal(data[0])
+        schedule_fraction = float(schedule_time - int(schedule_time))
+        sample_offset = int(data[6]) if len(data) > 6 else 0
+        row = (float(schedule_time), state_codes[data[1]], int(data[2]),
+               float(data[3]), path_indices[data[4]], path_indices[data[5]],
+               sample_offset, schedule_fraction)
+        for column, value in zip(columns, row):
+            column.append(value)
 
-        # add a new HardwareInjection to list if its in the future
-        if schedule_time - current_gps_time > 0:
-            hwinj = HardwareInjection(schedule_time, schedule_state,
-                                      observation_mode, scale_factor,
-                                      waveform_path, metadata_path)
-            hwinj_list.append(hwinj)
+    # make structured array
+    rows = numpy.empty(len(columns[0]), dtype=schedule_dtype)
+    for name, column in zip(schedule_dtype.names, columns):
+        rows[name] = column
 
-    return hwinj_list
+    return ScheduleTable(rows, state_names, paths)
+
+def format_schedule_line(hwinj, schedule_time=None, sample_offset=None):
+    """ Formats a line of a schedule file for a hardware injection. See
+    read_schedule for the format of the schedule file.
+
+    Parameters
+    ----------
+    hwinj: HardwareInjection
+        The injection.
+    schedule_time: float
+        GPS start time of the line. If None then the schedule_time of hwinj,
+        which is written with its exact fractional second if it is known.
+    sample_offset: int
+        Sample offset of the line. If None then the sample_offset of hwinj.
+
+    Returns
+    ----------
+    line: str
+        The line without a newline. The sample offset column is only written
+        if the sample offset is nonzero.
+    """
+    time_column = "%.6f"%schedule_time if schedule_time is not None else None
+    if time_column is None and hwinj.schedule_fraction is not None:
+        seconds = int(round(hwinj.schedule_time - hwinj.schedule_fraction))
+        time_column = str(decimal.Decimal(seconds)
+                          + decimal.Decimal(repr(hwinj.schedule_fraction)))
+    elif time_column is None:
+        time_column = "%.6f"%hwinj.schedule_time
+    if sample_offset is None:
+        sample_offset = hwinj.sample_offset
+    columns = [time_column, hwinj.schedule_state,
+               hwinj.observation_mode, hwinj.scale_factor,
+               hwinj.waveform_path, hwinj.metadata_path]
+    if sample_offset:
+        columns.append(int(sample_offset))
+    return " ".join(map(str, columns))
+
+def open_waveform(waveform_path):
+    """ Opens a waveform file for reading bytes. If the file extension
+    is in compression_dict then the file object decompresses the file.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+
+    Returns
+    ----------
+    fp: file
+        A file object opened for reading bytes.
+    """
+    ext = os.path.splitext(waveform_path)[1]
+    if ext in compression_dict:
+        return compression_dict[ext](waveform_path, "rb")
+    elif ext == ".xz":
+        raise ImportError("Reading xz files requires the lzma module")
+    return open(waveform_path, "rb")
 
-def read_waveform(waveform_path, ftype="ascii"):
-    """ Reads a waveform file. Only single-column ASCII files are
-    supported for reading.
+def get_waveform_ftype(waveform_path):
+    """ Returns the ftype to read a waveform file with read_waveform. The
+    ftype is determined by the file extension after removing the extension
+    of a compressed file, eg. H1-TEST-0-0.f64.gz is a "binary" file. Files
+    with an extension not in waveform_ftype_dict are "ascii" files. A spec of
+    a synthetic waveform, see inj_synth, is a "synthetic" file and a spec of
+    generated noise, see inj_noise, is a "noise" file.
 
     Parameters
     ----------
     waveform_path: str
         Path to the waveform file.
+
+    Returns
+    ----------
     ftype: str
-        Selects what method to use. Currently must be a string set to "ascii".
+        The ftype of the waveform file.
+    """
+    if inj_synth.is_synthetic_waveform(waveform_path):
+        return "synthetic"
+    if inj_noise.is_noise_waveform(waveform_path):
+        return "noise"
+    root, ext = os.path.splitext(waveform_path)
+    if ext in compression_dict or ext == ".xz":
+        ext = os.path.splitext(root)[1]
+    return waveform_ftype_dict.get(ext, "ascii")
+
+def read_waveform_length(waveform_path):
+    """ Reads the number of samples in a waveform file from its length
+    sidecar file, ie. the waveform path with a ".len" suffix.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+
+    Returns
+    ----------
+    length: int
+        Number of samples in the waveform file. If there is no length
+        sidecar file then None.
+    """
+    length_path = waveform_path + ".len"
+    if not os.path.exists(length_path):
+        return None
+    fp = open(length_path, "r")
+    length = int(fp.read().strip())
+    fp.close()
+    return length
+
+def read_waveform_rate(waveform_path):
+    """ Reads the sample rate of a waveform file from its rate sidecar file,
+    ie. the waveform path with a ".rate" suffix. A waveform file with a
+    different sample rate than the excitation channel is resampled when it is
+    read by the guardian node.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+
+    Returns
+    ----------
+    sample_rate: int
+        Sample rate of the waveform file. If there is no rate sidecar file
+        then None.
+    """
+    rate_path = waveform_path + ".rate"
+    if not os.path.exists(rate_path):
+        return None
+    fp = open(rate_path, "r")
+    sample_rate = int(fp.read().strip())
+    fp.close()
+    return sample_rate
+
+def resample_to_rate(waveform, waveform_path, sample_rate):
+    """ Resamples a time series read from a waveform file to a sample rate
+    if the rate sidecar file of the waveform file gives a different rate.
+
+    Parameters
+    ----------
+    waveform: numpy.array
+        The time series read from the waveform file.
+    waveform_path: str
+        Path to the waveform file.
+    sample_rate: int
+        Sample rate to resample to.
+
+    Returns
+    ----------
+    waveform: numpy.array
+        The time series at the sample rate.
+    """
+    waveform_rate = read_waveform_rate(waveform_path)
+    if waveform_rate is None or waveform_rate == sample_rate:
+        return waveform
+    return inj_resample.resample_waveform(waveform, waveform_rate, sample_rate)
+
+def file_sha256(path):
+    """ Returns the SHA-256 hex digest of the bytes of a file.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file.
+
+    Returns
+    ----------
+    digest: str
+        The hex digest of the file.
+    """
+    sha = hashlib.sha256()
+    fp = open(path, "rb")
+    for block in iter(lambda: fp.read(read_block_size), b""):
+        sha.update(block)
+    fp.close()
+    return sha.hexdigest()
+
+def file_content_hash(path):
+    """ Returns the SHA-256 hex digest of a file. If there is a checksum
+    sidecar file, ie. the path with a ".sha256" suffix, that is not older than
+    the file then the digest is read from the sidecar file. Digests are cached
+    by path and are recomputed if the modification time or size of the file
+    changes. The digest of a spec of a synthetic waveform is the digest of
+    the spec, and the digest of a spec of generated noise is the digest of the
+    spec and its power spectral density file.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file.
+
+    Returns
+    ----------
+    digest: str
+        The hex digest of the file.
+    """
+
+    # synthetic waveform has no file
+    if inj_synth.is_synthetic_waveform(path):
+        return hashlib.sha256(path.encode("utf-8")).hexdigest()
+    if inj_noise.is_noise_waveform(path):
+        return inj_noise.noise_content_hash(path)
+
+    # check cache
+    stat = os.stat(path)
+    if path in content_hash_cache:
+        mtime, size, digest = content_hash_cache[path]
+        if mtime == stat.st_mtime and size == stat.st_size:
+            return digest
+
+    # read sidecar file or hash file
+    sha256_path = path + ".sha256"
+    if os.path.exists(sha256_path) \
+            and os.path.getmtime(sha256_path) >= stat.st_mtime:
+        fp = open(sha256_path, "r")
+        digest = fp.read().strip()
+        fp.close()
+    else:
+        digest = file_sha256(path)
+
+    content_hash_cache[path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+def file_content_key(path, hash_file=False):
+    """ Returns a key that identifies the contents of a waveform file without
+    reading the file. If there is a checksum sidecar file that is not older
+    than the file, or hash_file is True, then the key is the SHA-256 hex
+    digest from file_content_hash. Otherwise the key is made from the
+    absolute path, modification time, and size of the file. The key of a spec
+    of a synthetic waveform or generated noise is its digest.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file.
+    hash_file: bool
+        If True then hash the file if there is no checksum sidecar file.
+
+    Returns
+    ----------
+    key: str
+        The key of the file.
+    """
+    if inj_synth.is_synthetic_waveform(path) or inj_noise.is_noise_waveform(path):
+        return file_content_hash(path)
+    stat = os.stat(path)
+    sha256_path = path + ".sha256"
+    if hash_file or (os.path.exists(sha256_path)
+                     and os.path.getmtime(sha256_path) >= stat.st_mtime):
+        return file_content_hash(path)
+    return "%s:%r:%d"%(os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+def get_converted_waveform_path(waveform_path, compression=None):
+    """ Returns the path of the binary file converted from an ASCII waveform
+    file, ie. the waveform path with a ".f64" suffix.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the ASCII waveform file.
+    compression: str
+        Extension of the compression of the binary file, eg. ".gz". If None
+        then the binary file is not compressed.
+
+    Returns
+    ----------
+    converted_path: str
+        Path to the binary waveform file.
+    """
+    return waveform_path + ".f64" + (compression or "")
+
+def find_converted_waveform(waveform_path):
+    """ Returns the path to an up-to-date binary file converted from an ASCII
+    waveform file, see is_converted_waveform_current.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the ASCII waveform file.
+
+    Returns
+    ----------
+    path: str
+        Path to the binary file if there is an up-to-date binary file,
+        otherwise waveform_path.
+    """
+    if get_waveform_ftype(waveform_path) != "ascii":
+        return waveform_path
+    for compression in [None] + sorted(compression_dict.keys()):
+        converted_path = get_converted_waveform_path(waveform_path,
+                                                     compression=compression)
+        if is_converted_waveform_current(waveform_path, converted_path):
+            return converted_path
+    return waveform_path
+
+def is_converted_waveform_current(waveform_path, converted_path):
+    """ Returns True if a binary file converted from an ASCII waveform file
+    exists, has a length sidecar file, was converted from the current contents
+    of the ASCII file, and has the same sample rate in its rate sidecar file
+    as the ASCII file.
+
+    The modification time, size, and SHA-256 digest of the ASCII file are
+    recorded in a source sidecar file, ie. the binary path with a ".src"
+    suffix, when it is converted. If the modification time or size of the
+    ASCII file changed then its digest is compared, so a binary file is not
+    used if the ASCII file was replaced by a file with an older modification
+    time.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the ASCII waveform file.
+    converted_path: str
+        Path to the binary waveform file.
+
+    Returns
+    ----------
+    current: bool
+        True if the binary file is up-to-date.
+    """
+    if not os.path.exists(converted_path) \
+            or not os.path.exists(converted_path + ".len"):
+        return False
+    if os.path.exists(waveform_path):
+        source = read_waveform_source(converted_path)
+        if source is None:
+            return False
+        mtime, size, digest = source
+        stat = os.stat(waveform_path)
+        if (mtime != stat.st_mtime or size != stat.st_size) \
+                and digest != file_content_hash(waveform_path):
+            return False
+    if read_waveform_rate(waveform_path) != read_waveform_rate(converted_path):
+        return False
+    return True
+
+def read_waveform_source(converted_path):
+    """ Reads the source sidecar file of a binary file converted from an
+    ASCII waveform file, ie. the binary path with a ".src" suffix.
+
+    Parameters
+    ----------
+    converted_path: str
+        Path to the binary waveform file.
+
+    Returns
+    ----------
+    source: tuple
+        The modification time, size, and SHA-256 hex digest of the ASCII file
+        when it was converted. If there is no source sidecar file then None.
+    """
+    source_path = converted_path + ".src"
+    if not os.path.exists(source_path):
+        return None
+    fp = open(source_path, "r")
+    mtime, size, digest = fp.read().split()
+    fp.close()
+    return float(mtime), int(size), digest
+
+def write_waveform(waveform_path, waveform, sample_rate=None, source_path=None):
+    """ Writes a binary waveform file and its length and checksum sidecar
+    files, ie. the waveform path with a ".len" and ".sha256" suffix. If the
+    file extension is in compression_dict then the file is compressed. If a
+    sample rate is given then a rate sidecar file is written too, and if a
+    source path is given then a source sidecar file is written, see
+    is_converted_waveform_current.
+
+    The files are written to temporary files and then renamed so that a
+    reader never sees a partially written file.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the binary waveform file.
+    waveform: numpy.array
+        The time series to write.
+    sample_rate: int
+        Sample rate of the time series.
+    source_path: str
+        Path to the ASCII waveform file the time series was read from.
+    """
+
+    # write binary file
+    tmp_path = waveform_path + ".tmp%d"%os.getpid()
+    ext = os.path.splitext(waveform_path)[1]
+    if ext in compression_dict:
+        fp = compression_dict[ext](tmp_path, "wb")
+    else:
+        fp = open(tmp_path, "wb")
+    fp.write(numpy.ascontiguousarray(waveform, dtype=binary_dtype).tobytes())
+    fp.close()
+
+    # write sidecar files
+    sidecars = [(".len", str(len(waveform))),
+                (".sha256", file_sha256(tmp_path))]
+    if sample_rate is not None:
+        sidecars.append((".rate", str(int(sample_rate))))
+    if source_path is not None:
+        stat = os.stat(source_path)
+        sidecars.append((".src", "%r %d %s"%(stat.st_mtime, stat.st_size,
+                                             file_sha256(source_path))))
+    for suffix, contents in sidecars:
+        fp = open(tmp_path + suffix, "w")
+        fp.write(contents + "\n")
+        fp.close()
+
+    # the length sidecar is renamed last since it marks the file as complete
+    suffixes = [suffix for suffix, _ in sidecars if suffix != ".len"]
+    for suffix in suffixes + ["", ".len"]:
+        os.rename(tmp_path + suffix, waveform_path + suffix)
+
+def convert_waveform(waveform_path, compression=None, overwrite=False):
+    """ Converts an ASCII waveform file to a binary waveform file.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the ASCII waveform file.
+    compression: str
+        Extension of the compression of the binary file, eg. ".gz". If None
+        then the binary file is not compressed.
+    overwrite: bool
+        If True then convert even if the binary file is up-to-date.
+
+    Returns
+    ----------
+    converted_path: str
+        Path to the binary waveform file. If the binary file was up-to-date
+        and not overwritten then None.
+    """
+    converted_path = get_converted_waveform_path(waveform_path,
+                                                 compression=compression)
+    if not overwrite and is_converted_waveform_current(waveform_path,
+                                                       converted_path):
+        return None
+    waveform = read_waveform(waveform_path, ftype="ascii")
+    write_waveform(converted_path, waveform,
+                   sample_rate=read_waveform_rate(waveform_path),
+                   source_path=waveform_path)
+    return converted_path
+
+def _parse_ascii_block(block):
+    """ Parses the samples in a block of bytes of a single-column ASCII file.
+    Comments, ie. the rest of a line after "#", and blank lines are skipped.
+
+    The block is parsed in one call if the number of samples is the number of
+    lines. Otherwise, eg. the block has a comment or a line that is not a
+    number, each line is parsed so that an error is raised instead of
+    returning partial data.
+
+    Parameters
+    ----------
+    block: bytes
+        Whole lines of the file.
+
+    Returns
+    ----------
+    samples: numpy.array
+        An array of the samples in the block.
+    """
+
+    # parse block in one call
+    nlines = block.count(b"\n") + (not block.endswith(b"\n"))
+    if b"#" not in block:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                samples = numpy.fromstring(block, dtype=numpy.float64, sep=" ")
+        except ValueError:
+            samples = None
+        if samples is not None and len(samples) == nlines:
+            return samples
+
+    # parse each line without comments
+    lines = [line.split(b"#", 1)[0].strip() for line in block.splitlines()]
+    try:
+        return numpy.array([float(line) for line in lines if line],
+                           dtype=numpy.float64)
+    except ValueError:
+        raise ValueError("ASCII waveform file has a line that is not a "
+                         "single number: %s"%str(sys.exc_info()[1]))
+
+def _iter_ascii_blocks(fp):
+    """ Yields arrays of samples parsed from blocks of bytes of a single-column
+    ASCII file. Blocks are split at the last newline so that no sample is
+    split between blocks.
+
+    Parameters
+    ----------
+    fp: file
+        A file object opened for reading bytes.
+
+    Returns
+    ----------
+    samples: numpy.array
+        An array of the samples in a block.
+    """
+    remainder = b""
+    while True:
+        block = fp.read(read_block_size)
+        if not block:
+            break
+        block = remainder + block
+        end = block.rfind(b"\n") + 1
+        remainder = block[end:]
+        if end:
+            yield _parse_ascii_block(block[:end])
+    if remainder.strip():
+        yield _parse_ascii_block(remainder)
+
+def _fill_ascii(fp, waveform):
+    """ Parses a single-column ASCII file into an array. If there are more
+    samples than the length of the array then the array is grown.
+
+    Parameters
+    ----------
+    fp: file
+        A file object opened for reading bytes.
+    waveform: numpy.array
+        The array to fill.
+
+    Returns
+    ----------
+    waveform: numpy.array
+        The filled array.
+    length: int
+        The number of samples read.
+    """
+    length = 0
+    for samples in _iter_ascii_blocks(fp):
+        while length + len(samples) > len(waveform):
+            waveform = _grow(waveform)
+        waveform[length:length + len(samples)] = samples
+        length += len(samples)
+    return waveform, length
+
+def _fill_binary(fp, waveform):
+    """ Reads the bytes of a binary file directly into an array. If there are
+    more samples than the length of the array then the array is grown.
+
+    Parameters
+    ----------
+    fp: file
+        A file object opened for reading bytes.
+    waveform: numpy.array
+        The array to fill.
+
+    Returns
+    ----------
+    waveform: numpy.array
+        The filled array.
+    length: int
+        The number of samples read.
+    """
+    nbytes = 0
+    while True:
+
+        # if the array is full then check for more bytes before growing it
+        if nbytes == waveform.nbytes:
+            block = fp.read(1)
+            if not block:
+                break
+            waveform = _grow(waveform)
+            waveform.view(numpy.uint8)[nbytes] = bytearray(block)[0]
+            nbytes += 1
+
+        # read bytes into the array
+        buf = waveform.view(numpy.uint8)[nbytes:nbytes + read_block_size]
+        if hasattr(fp, "readinto"):
+            n = fp.readinto(buf)
+        else:
+            block = fp.read(len(buf))
+            n = len(block)
+            buf[:n] = numpy.frombuffer(block, dtype=numpy.uint8)
+        if not n:
+            break
+        nbytes += n
+    if nbytes % binary_dtype.itemsize:
+        raise ValueError("Binary waveform file has a partial sample")
+    return waveform, nbytes // binary_dtype.itemsize
+
+def _grow(waveform):
+    """ Returns an array with twice the length that starts with the samples
+    of the given array.
+    """
+    grown = numpy.empty(max(2 * len(waveform), 1), dtype=waveform.dtype)
+    grown[:len(waveform)] = waveform
+    return grown
+
+def read_waveform(waveform_path, ftype="ascii", length=None, sample_rate=16384):
+    """ Reads a waveform file. Single-column ASCII files and binary files of
+    little-endian 64-bit floats are supported for reading. Files compressed
+    with gzip, bzip2, or xz are decompressed while reading if the file
+    extension is in compression_dict.
+
+    The samples are read directly into an array whose length is known in
+    advance. The length is given by the length argument, the length sidecar
+    file, or for an uncompressed binary file the file size. Otherwise the
+    array is grown while reading. Uncompressed binary files are memory-mapped.
+    Waveform files are not resampled, see resample_to_rate.
+
+    Synthetic waveforms are generated from their spec instead of read. For
+    generated noise a ColoredNoiseGenerator is returned instead of an array,
+    so the noise is generated in blocks when it is used.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+    ftype: str
+        Selects what method to use. Must be a string set to "ascii",
+        "binary", "synthetic", or "noise".
+    length: int
+        Number of samples in the waveform file.
+    sample_rate: int
+        Sample rate to generate a synthetic waveform or noise.
 
     Retuns
     ----------
@@ -113,14 +984,248 @@ def read_waveform(waveform_path, ftype="ascii"):
         Returns the time series as a numpy array.
     """
 
-    # single-coulmn ASCII file reading
-    if ftype == "ascii":
+    # synthetic waveform generated from spec
+    if ftype == "synthetic":
+        return inj_synth.synthesize_waveform(waveform_path, sample_rate)
+
+    # generated noise is generated in blocks when it is used
+    if ftype == "noise":
+        return inj_noise.read_noise_spec(waveform_path, sample_rate)
 
-        # read single-column ASCII file with time series
-        waveform = numpy.loadtxt(waveform_path)
+    # get number of samples
+    if length is None:
+        length = read_waveform_length(waveform_path)
+    compressed = os.path.splitext(waveform_path)[1] in compression_dict
+
+    # uncompressed binary file memory-mapped, the file size must match the
+    # length since a memory map does not check it
+    if ftype == "binary" and not compressed:
+        if length is not None and os.path.getsize(waveform_path) \
+                != length * binary_dtype.itemsize:
+            raise ValueError("Waveform file has %d bytes but expected %d samples"
+                             %(os.path.getsize(waveform_path), length))
+        return numpy.memmap(waveform_path, dtype=binary_dtype, mode="r",
+                            shape=length)
+
+    # preallocate array, if the length is not known then make a guess
+    if length is not None:
+        waveform = numpy.empty(length, dtype=numpy.float64)
+    else:
+        size = os.path.getsize(waveform_path)
+        waveform = numpy.empty(max(size // binary_dtype.itemsize, 1),
+                               dtype=numpy.float64)
+
+    # read file
+    fp = open_waveform(waveform_path)
+    try:
+
+        # single-coulmn ASCII file reading
+        if ftype == "ascii":
+            waveform, n = _fill_ascii(fp, waveform)
+
+        # binary file reading
+        elif ftype == "binary":
+            waveform, n = _fill_binary(fp, waveform)
+
+        else:
+            raise ValueError("Unknown waveform ftype %s"%ftype)
+
+    finally:
+        fp.close()
+
+    # check length and remove unused samples
+    if length is not None and n != length:
+        raise ValueError("Waveform file has %d samples but expected %d"%(n, length))
+    if n != len(waveform):
+        waveform.resize(n, refcheck=False)
 
     return waveform
 
+def scan_waveform(waveform, key=None):
+    """ Scans a time series for values that are unsafe to inject. The time
+    series is scanned in blocks of scan_block_size samples so a memory-mapped
+    waveform is read once without making a copy of it.
+
+    The scan checks that all samples are finite, and finds the peak amplitude,
+    the root-mean-square amplitude, and the maximum difference between
+    adjacent samples. The excitation is zero before and after the injection,
+    so the first and last sample are differenced with zero.
+
+    Parameters
+    ----------
+    waveform: {numpy.array, ColoredNoiseGenerator}
+        The time series to scan. A ColoredNoiseGenerator is scanned block by
+        block as it generates the noise.
+    key: str
+        If not None then the scan is cached with this key, eg. the key of
+        the waveform file, and a cached scan is returned without scanning
+        again.
+
+    Returns
+    ----------
+    scan: WaveformScan
+        The result of the scan.
+    """
+    if hasattr(waveform, "iter_blocks"):
+        blocks = waveform.iter_blocks()
+    else:
+        blocks = (waveform[start:start + scan_block_size]
+                  for start in range(0, len(waveform), scan_block_size))
+    return scan_waveform_blocks(blocks, key=key)
+
+def scan_waveform_blocks(blocks, key=None):
+    """ Scans a time series given as consecutive blocks for values that are
+    unsafe to inject, eg. the blocks appended to a stream. See scan_waveform
+    for the values that are checked.
+
+    Parameters
+    ----------
+    blocks: iterable
+        The blocks of the time series in order.
+    key: str
+        If not None then the scan is cached with this key and a cached scan
+        is returned without iterating over the blocks.
+
+    Returns
+    ----------
+    scan: WaveformScan
+        The result of the scan.
+    """
+
+    # check cache
+    if key is not None and key in safety_scan_cache:
+        return safety_scan_cache[key]
+
+    # scan blocks
+    length = 0
+    finite = True
+    peak = 0.0
+    sum_squares = 0.0
+    max_slew = 0.0
+    previous = 0.0
+    for block in blocks:
+        block = numpy.asarray(block, dtype=numpy.float64)
+        if not len(block):
+            continue
+        length += len(block)
+        if not numpy.isfinite(block).all():
+            finite = False
+            peak = sum_squares = max_slew = float("nan")
+            break
+        peak = max(peak, numpy.abs(block).max())
+        sum_squares += numpy.dot(block, block)
+        max_slew = max(max_slew, abs(block[0] - previous))
+        if len(block) > 1:
+            max_slew = max(max_slew, numpy.abs(numpy.diff(block)).max())
+        previous = block[-1]
+    if finite:
+        max_slew = max(max_slew, abs(previous))
+    rms = numpy.sqrt(sum_squares / length) if length else 0.0
+    scan = WaveformScan(length, finite, float(peak), float(rms),
+                        float(max_slew))
+    if key is not None:
+        safety_scan_cache[key] = scan
+    return scan
+
+class WaveformMonitor(object):
+    """ A class that checks the blocks of a time series against the limits of
+    check_waveform_scan as they are sent, eg. for generated noise that would
+    have to be generated twice to scan it before it is sent. The RMS amplitude
+    is checked with the sum of squares so far divided by the length of the
+    whole time series, so it exceeds the limit as soon as the RMS amplitude
+    of the whole time series must exceed it.
+
+    Parameters
+    ----------
+    length: int
+        Number of samples in the whole time series.
+    max_peak: float
+        Maximum peak amplitude. If None then it is not checked.
+    max_rms: float
+        Maximum root-mean-square amplitude. If None then it is not checked.
+    max_slew: float
+        Maximum difference between adjacent samples. If None then it is not
+        checked.
+    """
+
+    def __init__(self, length, max_peak=None, max_rms=None, max_slew=None):
+        self.length = max(int(length), 1)
+        self.max_peak = max_peak
+        self.max_rms = max_rms
+        self.max_slew = max_slew
+        self.sum_squares = 0.0
+        self.previous = 0.0
+
+    def check(self, block):
+        """ Checks the next block of the time series.
+
+        Parameters
+        ----------
+        block: numpy.array
+            The next block of the time series.
+
+        Raises
+        ----------
+        ValueError
+            If the block has NaN or Inf samples or a limit is exceeded.
+        """
+        block = numpy.asarray(block, dtype=numpy.float64)
+        if not len(block):
+            return
+        if not numpy.isfinite(block).all():
+            raise ValueError("Waveform has NaN or Inf samples")
+        if self.max_peak is not None:
+            peak = numpy.abs(block).max()
+            if peak > self.max_peak:
+                raise ValueError("Waveform peak amplitude %e exceeds limit %e"
+                                 %(peak, self.max_peak))
+        if self.max_rms is not None:
+            self.sum_squares += numpy.dot(block, block)
+            rms = numpy.sqrt(self.sum_squares / self.length)
+            if rms > self.max_rms:
+                raise ValueError("Waveform RMS amplitude %e exceeds limit %e"
+                                 %(rms, self.max_rms))
+        if self.max_slew is not None:
+            slew = abs(block[0] - self.previous)
+            if len(block) > 1:
+                slew = max(slew, numpy.abs(numpy.diff(block)).max())
+            if slew > self.max_slew:
+                raise ValueError("Waveform slew %e exceeds limit %e"
+                                 %(slew, self.max_slew))
+        self.previous = block[-1]
+
+def check_waveform_scan(scan, max_peak=None, max_rms=None, max_slew=None):
+    """ Checks a waveform safety scan against limits.
+
+    Parameters
+    ----------
+    scan: WaveformScan
+        The result of scan_waveform.
+    max_peak: float
+        Maximum peak amplitude. If None then it is not checked.
+    max_rms: float
+        Maximum root-mean-square amplitude. If None then it is not checked.
+    max_slew: float
+        Maximum difference between adjacent samples. If None then it is not
+        checked.
+
+    Returns
+    ----------
+    problems: list
+        A list of strings describing each limit that was exceeded. If the
+        waveform is safe to inject then the list is empty.
+    """
+    problems = []
+    if not scan.finite:
+        problems.append("Waveform has NaN or Inf samples")
+        return problems
+    for name, value, limit in [("peak amplitude", scan.peak, max_peak),
+                               ("RMS amplitude", scan.rms, max_rms),
+                               ("slew", scan.max_slew, max_slew)]:
+        if limit is not None and value > limit:
+            problems.append("Waveform %s %e exceeds limit %e"%(name, value, limit))
+    return problems
+
 def read_metadata(metadata_path, waveform_start_time, schedule_time=0.0,
                   ftype="sim_inspiral"):
     """ Reads a file that contains meta-data about the waveform file.
@@ -151,7 +1256,7 @@ def read_metadata(metadata_path, waveform_start_time, schedule_time=0.0,
 
         # read XML file
         xmldoc = utils.load_filename(metadata_path,
-                                     contenthandler=ContentHandler)
+                                     contenthandler=get_content_handler())
 
         # get first sim_inspiral row
         sim_table = table.get_table(xmldoc,
@@ -0,0 +1,50 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ lazy guardian module
+
+This module provides a class for deferring imports of modules that are slow
+to import until they are first used.
+
+2016 - Christopher M. Biwer
+"""
+
+import importlib
+
+class LazyModule(object):
+    """ A class that imports a module the first time one of its attributes
+    is accessed. This keeps loading and reloading the guardian node fast since
+    modules such as glue, the GraceDB client, and awg are only imported when a
+    state first needs them.
+
+    Parameters
+    ----------
+    module_name: str
+        Full name of the module, eg. "ligo.gracedb.rest".
+    """
+
+    def __init__(self, module_name):
+        self.__dict__["_module_name"] = module_name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """ Imports the module if it has not been imported and returns it.
+        """
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._module_name)
+        return self._module
+
+    def __getattr__(self, name):
+        # do not import the module when only checking for special attributes
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        """ String representation of instance.
+        """
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<LazyModule %s %s>"%(self._module_name, state)
@@ -0,0 +1,186 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ noise guardian module
+
+This module provides a class for generating colored Gaussian noise from a
+target power spectral density in blocks, so that long stochastic injections
+do not need a waveform file and use a constant amount of memory.
+
+A spec is written in the waveform_path column of the schedule file as the
+prefix "noise:" then comma-separated parameters, eg.
+noise:psd=/path/to/{ifo}-PSD.txt,duration=3600,seed=1234. The psd parameter
+is the path to a two-column ASCII file of frequency in Hz and one-sided power
+spectral density.
+
+2016 - Christopher M. Biwer
+"""
+
+import hashlib
+import numpy
+
+# prefix of waveform_path column for a generated noise waveform
+noise_prefix = "noise:"
+
+class ColoredNoiseGenerator(object):
+    """ A class that generates colored Gaussian noise in blocks. White noise
+    from a seeded random number generator is filtered with a FIR filter whose
+    frequency response is the square root of the power spectral density. The
+    filter is applied with FFT overlap-add and the filter tail is carried to
+    the next block so there are no discontinuities at block boundaries. The
+    same seed always generates the same noise.
+
+    The start and end of the noise are tapered with a Hann window so that the
+    excitation turns on and off smoothly.
+
+    The expected_rms attribute is the root-mean-square amplitude of the noise
+    before the taper, which is known from the filter without generating the
+    noise.
+
+    Parameters
+    ----------
+    freqs: numpy.array
+        Frequencies of the power spectral density in Hz.
+    psd: numpy.array
+        One-sided power spectral density.
+    sample_rate: int
+        Sample rate of the noise.
+    duration: float
+        Length of the noise in seconds.
+    seed: int
+        Seed of the random number generator.
+    block_seconds: float
+        Length of each block in seconds.
+    filter_seconds: float
+        Length of the FIR filter in seconds.
+    taper_seconds: float
+        Length of the taper at the start and end in seconds.
+    """
+
+    def __init__(self, freqs, psd, sample_rate, duration, seed=0,
+                 block_seconds=16.0, filter_seconds=1.0, taper_seconds=1.0):
+        self.sample_rate = sample_rate
+        self.length = int(duration * sample_rate)
+        self.seed = seed
+        self.n_taps = max(int(filter_seconds * sample_rate), 1)
+        self.block_length = max(int(block_seconds * sample_rate), self.n_taps)
+        self.taper_length = min(int(taper_seconds * sample_rate), self.length // 2)
+
+        # unit variance white noise has a one-sided power spectral density
+        # of 2 / sample_rate so scale the response to get the target
+        filter_freqs = numpy.fft.rfftfreq(self.n_taps, 1.0 / sample_rate)
+        response = numpy.sqrt(numpy.interp(filter_freqs, freqs, psd,
+                                           left=0.0, right=0.0) * sample_rate / 2.0)
+
+        # get a windowed linear-phase impulse response and its FFT
+        impulse = numpy.roll(numpy.fft.irfft(response, self.n_taps),
+                             self.n_taps // 2) * numpy.hanning(self.n_taps)
+        self.fft_length = 2**int(numpy.ceil(numpy.log2(self.block_length
+                                                       + self.n_taps - 1)))
+        self.filter_fft = numpy.fft.rfft(impulse, self.fft_length)
+
+        # filtered unit variance white noise has a variance of the sum of the
+        # squares of the impulse response
+        self.expected_rms = float(numpy.sqrt(numpy.dot(impulse, impulse)))
+
+    def __len__(self):
+        return self.length
+
+    def iter_blocks(self):
+        """ Generates the noise in blocks of block_length samples. The last
+        block is shorter if the length is not a multiple of block_length.
+
+        Yields
+        ----------
+        block: numpy.array
+            The next block of the time series.
+        """
+        random_state = numpy.random.RandomState(self.seed)
+        taper = numpy.hanning(2 * self.taper_length)
+        end_taper_start = self.length - self.taper_length
+        tail = numpy.zeros(self.n_taps - 1)
+        start = 0
+        while start < self.length:
+
+            # filter white noise and add tail of previous block
+            white = random_state.standard_normal(self.block_length)
+            colored = numpy.fft.irfft(numpy.fft.rfft(white, self.fft_length)
+                                      * self.filter_fft, self.fft_length)
+            colored = colored[:self.block_length + self.n_taps - 1]
+            colored[:self.n_taps - 1] += tail
+            tail = colored[self.block_length:].copy()
+            block = colored[:min(self.block_length, self.length - start)]
+            n = len(block)
+
+            # taper start and end
+            if start < self.taper_length:
+                k = min(self.taper_length - start, n)
+                block[:k] *= taper[start:start + k]
+            if start + n > end_taper_start:
+                k = max(end_taper_start - start, 0)
+                block[k:] *= taper[self.taper_length + start + k - end_taper_start:
+                                   self.taper_length + start + n - end_taper_start]
+
+            yield block
+            start += n
+
+def is_noise_waveform(waveform_path):
+    """ Returns True if a waveform_path column is a spec of generated noise.
+    """
+    return waveform_path.startswith(noise_prefix)
+
+def parse_noise_spec(spec):
+    """ Parses the spec of generated noise.
+
+    Parameters
+    ----------
+    spec: str
+        The spec, eg. noise:psd=H1-PSD.txt,duration=3600,seed=1234.
+
+    Returns
+    ----------
+    psd_path: str
+        Path to the power spectral density file.
+    params: dict
+        A dict of the other parameter names and float values.
+    """
+    params = {}
+    for field in spec[len(noise_prefix):].split(","):
+        name, _, value = field.partition("=")
+        params[name] = value
+    if "psd" not in params or "duration" not in params:
+        raise ValueError("Noise spec must have psd and duration: %s"%spec)
+    psd_path = params.pop("psd")
+    return psd_path, dict([(name, float(value)) for name, value in params.items()])
+
+def read_noise_spec(spec, sample_rate):
+    """ Returns a ColoredNoiseGenerator for the spec of generated noise. The
+    parameters other than psd are passed to ColoredNoiseGenerator.
+
+    Parameters
+    ----------
+    spec: str
+        The spec, eg. noise:psd=H1-PSD.txt,duration=3600,seed=1234.
+    sample_rate: int
+        Sample rate of the noise.
+
+    Returns
+    ----------
+    generator: ColoredNoiseGenerator
+        The noise generator.
+    """
+    psd_path, params = parse_noise_spec(spec)
+    data = numpy.loadtxt(psd_path, ndmin=2)
+    if "seed" in params:
+        params["seed"] = int(params["seed"])
+    return ColoredNoiseGenerator(data[:, 0], data[:, 1], sample_rate, **params)
+
+def noise_content_hash(spec):
+    """ Returns the SHA-256 hex digest of the spec of generated noise and the
+    power spectral density file, so the digest changes if either changes.
+    """
+    sha = hashlib.sha256(spec.encode("utf-8"))
+    fp = open(parse_noise_spec(spec)[0], "rb")
+    sha.update(fp.read())
+    fp.close()
+    return sha.hexdigest()
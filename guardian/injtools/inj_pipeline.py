@@ -0,0 +1,171 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ pipeline guardian module
+
+This module provides a class for preparing the next hardware injection in a
+background thread while the current hardware injection is active, so that
+injections can be scheduled back-to-back.
+
+2016 - Christopher M. Biwer
+"""
+
+import threading
+import traceback
+
+class InjectionPipeline(object):
+    """ A class that prepares one HardwareInjection at a time in a background
+    thread. Preparing is done by a function that is called with the
+    HardwareInjection, eg. to upload the GraceDB event, create the stream,
+    and read the waveform. The function should raise an exception if the
+    injection cannot be prepared. Its return value is kept in the result
+    attribute.
+
+    The function is also called with a threading.Event that is set when the
+    pipeline is reset. The function should check it between steps and return
+    early if it is set. If the thread is still running when the pipeline is
+    reset then the thread calls the cleanup function, eg. to close the stream
+    it created, since the caller of reset cannot know what the thread did
+    after it returned. A thread that is still running after a reset is kept
+    in the abandoned list until it finishes.
+    """
+
+    def __init__(self):
+        self.hwinj = None
+        self.thread = None
+        self.error = None
+        self.result = None
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.abandoned = []
+
+    def start(self, hwinj, prepare, args=(), cleanup=None):
+        """ Starts preparing a HardwareInjection in a background thread. If
+        the HardwareInjection is already being prepared, including by a
+        thread that is finishing after a reset, then nothing is done.
+
+        Parameters
+        ----------
+        hwinj: HardwareInjection
+            The injection to prepare.
+        prepare: function
+            The function to call with the HardwareInjection, the cancel
+            threading.Event, and args.
+        args: tuple
+            More arguments for prepare, eg. the IFO and the log function so
+            the thread does not use the globals of the guardian node.
+        cleanup: function
+            The function to call with the HardwareInjection in the thread if
+            the pipeline is reset before the thread finishes.
+
+        Returns
+        ----------
+        started: bool
+            True if a thread was started.
+        """
+        if hwinj is self.hwinj or self.is_preparing(hwinj):
+            return False
+        self.hwinj = hwinj
+        self.error = None
+        self.result = None
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       args=(hwinj, prepare, args, cleanup,
+                                             self.cancel, self.done))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def _run(self, hwinj, prepare, args, cleanup, cancel, done):
+        """ Calls the prepare function and records the traceback of any
+        exception. If the pipeline was reset then calls the cleanup function
+        instead of keeping the result.
+        """
+        try:
+            result = prepare(hwinj, cancel, *args)
+            if not cancel.is_set():
+                self.result = result
+        except Exception:
+            if not cancel.is_set():
+                self.error = traceback.format_exc()
+        finally:
+
+            # if the pipeline was reset while the thread was running then
+            # the thread cleans up, otherwise the caller of reset does
+            with self.lock:
+                hand_off = cancel.is_set()
+                if not hand_off:
+                    done.set()
+            if hand_off:
+                try:
+                    if cleanup is not None:
+                        cleanup(hwinj)
+                finally:
+                    done.set()
+
+    def wait(self, timeout=None):
+        """ Waits for the background thread to finish.
+
+        Parameters
+        ----------
+        timeout: float
+            Maximum seconds to wait.
+
+        Returns
+        ----------
+        finished: bool
+            True if the thread finished.
+        """
+        return self.done.wait(timeout)
+
+    def is_preparing(self, hwinj):
+        """ Returns True if a HardwareInjection is still being prepared, or
+        if a thread that was preparing it before a reset is still running.
+        """
+        if hwinj is None:
+            return False
+        if hwinj is self.hwinj and not self.done.is_set():
+            return True
+        self.abandoned = [(abandoned_hwinj, done)
+                          for abandoned_hwinj, done in self.abandoned
+                          if not done.is_set()]
+        return any([abandoned_hwinj is hwinj
+                    for abandoned_hwinj, done in self.abandoned])
+
+    def is_prepared(self, hwinj):
+        """ Returns True if a HardwareInjection finished preparing without an
+        exception.
+        """
+        return hwinj is not None and hwinj is self.hwinj \
+                   and self.done.is_set() and self.error is None
+
+    def reset(self, timeout=0.0):
+        """ Forgets the HardwareInjection being prepared and tells the thread
+        to stop. If the thread has finished then the caller should clean up
+        the injection, eg. close its stream. Otherwise the thread calls its
+        cleanup function when it stops and it is kept in the abandoned list.
+
+        Parameters
+        ----------
+        timeout: float
+            Maximum seconds to wait for the thread to stop.
+
+        Returns
+        ----------
+        hwinj: HardwareInjection
+            The injection that was being prepared or None.
+        """
+        hwinj = self.hwinj
+        with self.lock:
+            self.cancel.set()
+            finished = self.done.is_set()
+        if hwinj is not None and not finished:
+            self.thread.join(timeout)
+            if not self.done.is_set():
+                self.abandoned.append((hwinj, self.done))
+        self.hwinj = None
+        self.error = None
+        self.result = None
+        return hwinj
@@ -0,0 +1,243 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ profile guardian module
+
+This module provides a class for profiling the CPU time and memory used by
+guardian states. Profiling is off unless it is switched on with an
+environment variable or an EPICS record.
+
+2016 - Christopher M. Biwer
+"""
+
+import cProfile
+import functools
+import glob
+import os
+import os.path
+
+# tracemalloc is only in python 3
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class StateProfiler(object):
+    """ A class that profiles guardian state methods with cProfile and takes
+    tracemalloc memory snapshots.
+
+    The states to profile are read from the environment variable env_name at
+    initialization. It should be a comma-delimited list of state names, eg.
+    READ_WAVEFORM,CREATE_GRACEDB_EVENT, or "all" to profile every decorated
+    state. The states in state_names are also profiled while the EPICS record
+    channel_name is nonzero, the record is read with the poll method.
+
+    For each injection, the profile of a state method is written to
+    profile_dir as SCHEDULE_TIME-STATE-METHOD.prof and the memory snapshot as
+    SCHEDULE_TIME-STATE-METHOD.tracemalloc. Only the max_files most recent
+    files are kept in profile_dir.
+
+    Parameters
+    ----------
+    profile_dir: str
+        Path to the directory to write profiles.
+    state_names: list
+        Names of states to profile when the EPICS record is nonzero.
+    channel_name: str
+        Name of the EPICS record that switches on profiling.
+    env_name: str
+        Name of environment variable with states to profile.
+    max_files: int
+        Maximum number of files to keep in profile_dir.
+    """
+
+    def __init__(self, profile_dir, state_names=(), channel_name=None,
+                 env_name="INJ_PROFILE_STATES", max_files=100):
+        self.profile_dir = profile_dir
+        self.state_names = set(state_names)
+        self.channel_name = channel_name
+        self.max_files = max_files
+        self.profiles = {}
+
+        # get states to profile from environment variable
+        env_states = os.environ.get(env_name, "")
+        self.env_state_names = set([state_name.strip()
+                                    for state_name in env_states.split(",")
+                                    if state_name.strip()])
+        self.channel_on = False
+        self._update()
+
+    def _update(self):
+        """ Sets the active attribute and starts or stops tracemalloc.
+        """
+        self.active = bool(self.env_state_names) or \
+                          (self.channel_on and bool(self.state_names))
+        if tracemalloc is not None:
+            if self.active and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            elif not self.active and tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def poll(self, ezca):
+        """ Reads the EPICS record that switches on profiling.
+
+        Parameters
+        ----------
+        ezca: Ezca
+            The Ezca instance to read the EPICS record.
+        """
+        if self.channel_name:
+            self.channel_on = bool(ezca[self.channel_name])
+            self._update()
+
+    def enabled(self, state_name):
+        """ Returns True if a state should be profiled.
+
+        Parameters
+        ----------
+        state_name: str
+            Name of the guardian state.
+
+        Returns
+        ----------
+        enabled: bool
+            True if the state should be profiled.
+        """
+        if "all" in self.env_state_names \
+                or state_name in self.env_state_names:
+            return True
+        return self.channel_on and state_name in self.state_names
+
+    def call(self, func, state, *args, **kwargs):
+        """ Calls a guardian state method while profiling it. The profile of
+        a main method is written after each call. The profile of a run method
+        is accumulated over calls and written when the method returns a value
+        other than None or False. If the state exits another way, eg. a
+        decorator jumps to another state, then the accumulated profile is
+        discarded when the state is entered again or when discard is called.
+
+        Parameters
+        ----------
+        func: function
+            The method to call.
+        state: GuardState
+            The GuardState instance.
+
+        Returns
+        ----------
+        ret:
+            The value returned by func.
+        """
+
+        # entering a state means an accumulated run profile of the state is
+        # from an earlier visit that did not finish
+        state_name = state.__class__.__name__
+        if func.__name__ == "main":
+            self.discard(state_name)
+
+        # get profile for this state method, a profile accumulated for
+        # another injection is discarded
+        key = (state_name, func.__name__)
+        if key not in self.profiles or self.profiles[key][0] is not state.hwinj:
+            self.profiles[key] = (state.hwinj, cProfile.Profile())
+        profile = self.profiles[key][1]
+
+        # call method
+        profile.enable()
+        try:
+            ret = func(state, *args, **kwargs)
+        finally:
+            profile.disable()
+
+        # write profile and snapshot, a failure to write should never
+        # stop an injection so errors writing files are ignored
+        if func.__name__ != "run" or ret not in (None, False):
+            del self.profiles[key]
+            try:
+                self.write(profile, state.hwinj, *key)
+            except (IOError, OSError):
+                pass
+
+        return ret
+
+    def discard(self, state_name=None):
+        """ Discards the profiles of run methods that are still being
+        accumulated. This should be called when a state is exited without
+        its run method returning, eg. when streams are killed.
+
+        Parameters
+        ----------
+        state_name: str
+            Name of the guardian state. If None then the profiles of all
+            states are discarded.
+        """
+        for key in list(self.profiles.keys()):
+            if state_name is None or key[0] == state_name:
+                del self.profiles[key]
+
+    def write(self, profile, hwinj, state_name, method_name):
+        """ Writes a profile and a memory snapshot to profile_dir and removes
+        the oldest files if there are more than max_files files.
+
+        Parameters
+        ----------
+        profile: cProfile.Profile
+            The profile to write.
+        hwinj: HardwareInjection
+            The injection that was profiled.
+        state_name: str
+            Name of the guardian state.
+        method_name: str
+            Name of the method.
+        """
+
+        # make directory
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        # write profile and snapshot
+        schedule_time = hwinj.schedule_time if hwinj is not None else 0.0
+        prefix = os.path.join(self.profile_dir, "-".join(
+                     [str(schedule_time), state_name, method_name]))
+        profile.dump_stats(prefix + ".prof")
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(prefix + ".tracemalloc")
+
+        # remove oldest files
+        paths = glob.glob(os.path.join(self.profile_dir, "*.prof")) \
+                    + glob.glob(os.path.join(self.profile_dir, "*.tracemalloc"))
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(len(paths) - self.max_files, 0)]:
+            os.remove(path)
+
+def profiled_state(state_profiler):
+    """ Create a decorator for a GuardState method that profiles the method
+    with a StateProfiler if profiling is switched on for the state. When
+    profiling is off the only overhead is checking an attribute.
+
+    The decorator wraps the method itself, so it should be placed below any
+    GuardStateDecorator.
+
+    Parameters
+    ----------
+    state_profiler: StateProfiler
+        The StateProfiler to profile the method.
+
+    Returns
+    ----------
+    profiled_state_decorator: function
+        A decorator for a GuardState method.
+    """
+
+    def profiled_state_decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if state_profiler.active \
+                    and state_profiler.enabled(self.__class__.__name__):
+                return state_profiler.call(func, self, *args, **kwargs)
+            return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return profiled_state_decorator
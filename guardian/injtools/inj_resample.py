@@ -0,0 +1,208 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ resample guardian module
+
+This module provides classes for resampling waveforms by a rational factor
+with a polyphase filter bank, so that waveform files can be generated at a
+lower sample rate than the excitation channel and resampled in blocks as they
+are sent.
+
+2016 - Christopher M. Biwer
+"""
+
+import fractions
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+# number of filter taps per phase of the polyphase filter bank
+taps_per_phase = 32
+
+# Kaiser window shape parameter of the anti-aliasing filter
+kaiser_beta = 8.0
+
+# number of input samples to resample at a time
+resample_block_size = 2**16
+
+# cache of polyphase filter banks keyed by upsampling and downsampling factor
+filter_bank_cache = {}
+
+def get_filter_bank(up, down):
+    """ Returns the polyphase filter bank to resample by up / down. The
+    anti-aliasing filter is a Kaiser-windowed sinc with a cutoff at the
+    lower of the input and output Nyquist frequencies. Filter banks are
+    cached by up and down.
+
+    Parameters
+    ----------
+    up: int
+        Upsampling factor.
+    down: int
+        Downsampling factor.
+
+    Returns
+    ----------
+    bank: numpy.array
+        An array with one row per phase. Each row is the time-reversed filter
+        taps of the phase.
+    """
+
+    # check cache
+    if (up, down) in filter_bank_cache:
+        return filter_bank_cache[(up, down)]
+
+    # design filter at the upsampled rate with an odd number of taps so its
+    # delay is a whole number of samples and pad it to fill the phases
+    n_taps = up * taps_per_phase - 1
+    cutoff = 1.0 / max(up, down)
+    times = numpy.arange(n_taps) - (n_taps - 1) / 2.0
+    taps = up * cutoff * numpy.sinc(cutoff * times) \
+               * numpy.kaiser(n_taps, kaiser_beta)
+    taps = numpy.append(taps, 0.0)
+
+    # split filter into phases
+    bank = taps.reshape(taps_per_phase, up).T[:, ::-1].copy()
+    filter_bank_cache[(up, down)] = bank
+    return bank
+
+class PolyphaseResampler(object):
+    """ A class that resamples a time series by a rational factor in blocks.
+    The last input samples of each block are carried to the next block so the
+    output does not depend on how the input is split into blocks. The output
+    is aligned with the input, ie. the delay of the filter is removed.
+
+    Parameters
+    ----------
+    input_rate: int
+        Sample rate of the input time series.
+    output_rate: int
+        Sample rate of the output time series.
+    """
+
+    def __init__(self, input_rate, output_rate):
+        ratio = fractions.Fraction(int(output_rate), int(input_rate))
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        self.bank = get_filter_bank(self.up, self.down)
+
+        # number of input samples consumed and output samples generated
+        self.n_input = 0
+        self.n_output = 0
+        self.history = numpy.zeros(taps_per_phase - 1)
+
+        # delay of the filter in samples at the upsampled rate
+        self.delay = (self.up * taps_per_phase - 2) // 2
+
+    def process(self, block):
+        """ Resamples the next block of the input time series.
+
+        Parameters
+        ----------
+        block: numpy.array
+            The next block of the input time series.
+
+        Returns
+        ----------
+        output: numpy.array
+            The output samples that only depend on the input so far.
+        """
+
+        # add carried input samples
+        buf = numpy.concatenate([self.history,
+                                 numpy.asarray(block, dtype=numpy.float64)])
+        self.n_input += len(block)
+
+        # get upsampled index of each output sample that only depends on the
+        # input so far
+        last = (self.n_input - 1) * self.up + self.up - 1 - self.delay
+        n_output = max(last // self.down + 1 - self.n_output, 0)
+        index = (self.n_output + numpy.arange(n_output)) * self.down + self.delay
+        self.n_output += n_output
+
+        # filter each output sample with its phase
+        first = self.n_input - len(buf) + taps_per_phase - 1
+        windows = as_strided(buf, shape=(max(len(buf) - taps_per_phase + 1, 0),
+                                         taps_per_phase),
+                             strides=(buf.strides[0], buf.strides[0]))
+        output = numpy.einsum("ij,ij->i", self.bank[index % self.up],
+                              windows[index // self.up - first])
+
+        self.history = buf[len(buf) - taps_per_phase + 1:].copy()
+        return output
+
+class ResampledData(object):
+    """ A class that resamples a time series by a rational factor in blocks
+    as it is iterated, so that a waveform at a lower sample rate than the
+    excitation channel is resampled as it is sent instead of being resampled
+    to a full-length array when it is read. Zeros are appended to the input
+    to get the output samples at the end of the time series.
+
+    Parameters
+    ----------
+    waveform: numpy.array
+        The input time series.
+    input_rate: int
+        Sample rate of the input time series.
+    output_rate: int
+        Sample rate of the output time series.
+    """
+
+    def __init__(self, waveform, input_rate, output_rate):
+        self.waveform = waveform
+        self.input_rate = int(input_rate)
+        self.output_rate = int(output_rate)
+        ratio = fractions.Fraction(self.output_rate, self.input_rate)
+        self.length = -(-len(waveform) * ratio.numerator // ratio.denominator)
+
+    def __len__(self):
+        return self.length
+
+    def iter_blocks(self):
+        """ Resamples the time series in blocks of resample_block_size input
+        samples.
+
+        Yields
+        ----------
+        block: numpy.array
+            The next block of the output time series.
+        """
+        resampler = PolyphaseResampler(self.input_rate, self.output_rate)
+        n = 0
+        for start in range(0, len(self.waveform), resample_block_size):
+            block = resampler.process(self.waveform[start:start + resample_block_size])
+            block = block[:self.length - n]
+            n += len(block)
+            if len(block):
+                yield block
+        while n < self.length:
+            block = resampler.process(numpy.zeros(taps_per_phase))[:self.length - n]
+            n += len(block)
+            if len(block):
+                yield block
+
+def resample_waveform(waveform, input_rate, output_rate):
+    """ Resamples a time series by a rational factor. The time series is
+    resampled in blocks with ResampledData so a memory-mapped waveform is not
+    copied.
+
+    Parameters
+    ----------
+    waveform: numpy.array
+        The input time series.
+    input_rate: int
+        Sample rate of the input time series.
+    output_rate: int
+        Sample rate of the output time series.
+
+    Returns
+    ----------
+    output: numpy.array
+        The resampled time series.
+    """
+    data = ResampledData(waveform, input_rate, output_rate)
+    output = numpy.empty(len(data), dtype=numpy.float64)
+    n = 0
+    for block in data.iter_blocks():
+        output[n:n + len(block)] = block
+        n += len(block)
+    return output
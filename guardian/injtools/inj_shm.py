@@ -0,0 +1,152 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ shared-memory guardian module
+
+This module provides functions for handing off prepared waveform data from a
+separate preparation process to the guardian daemon through shared memory.
+
+The preparation process, see scripts/guardian_inj_waveform_prep.py, writes
+each prepared waveform as a binary waveform file in a shared-memory directory
+such as /dev/shm. The guardian daemon then memory-maps the file so no data is
+copied and several nodes on the same machine share one copy.
+
+2016 - Christopher M. Biwer
+"""
+
+import glob
+import hashlib
+import inj_io
+import os
+import os.path
+import time
+
+def get_segment_path(waveform_path, shm_dir, sample_rate=16384):
+    """ Returns the path of the shared-memory segment for a waveform file.
+    The name of the segment is a hash of the absolute path, modification time,
+    and size of the waveform file, the rate in its rate sidecar file, and the
+    sample rate of the segment. So a segment is not used after the waveform
+    file or its rate changes, or by a node with another sample rate.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+    shm_dir: str
+        Path to the shared-memory directory.
+    sample_rate: int
+        Sample rate of the excitation channel.
+
+    Returns
+    ----------
+    segment_path: str
+        Path to the shared-memory segment.
+    """
+    stat = os.stat(waveform_path)
+    source = "%s %r %d %s %d"%(os.path.abspath(waveform_path), stat.st_mtime,
+                               stat.st_size,
+                               inj_io.read_waveform_rate(waveform_path),
+                               sample_rate)
+    name = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    return os.path.join(shm_dir, name + ".f64")
+
+def publish_waveform(waveform_path, shm_dir, overwrite=False, sample_rate=16384):
+    """ Reads a waveform file and writes it to a shared-memory segment. If
+    there is an up-to-date binary file converted from the waveform file then
+    it is read instead. The waveform is resampled to the sample rate of the
+    excitation channel if it has a rate sidecar file with a different rate,
+    and the segment has a rate sidecar file with the sample rate.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+    shm_dir: str
+        Path to the shared-memory directory.
+    overwrite: bool
+        If True then write the segment even if it already exists.
+    sample_rate: int
+        Sample rate of the excitation channel.
+
+    Returns
+    ----------
+    segment_path: str
+        Path to the shared-memory segment. If the segment already existed
+        and was not overwritten then None.
+    """
+
+    # check if segment exists
+    segment_path = get_segment_path(waveform_path, shm_dir,
+                                    sample_rate=sample_rate)
+    if not overwrite and os.path.exists(segment_path + ".len"):
+        return None
+
+    # read waveform
+    path = inj_io.find_converted_waveform(waveform_path)
+    waveform = inj_io.read_waveform(path, ftype=inj_io.get_waveform_ftype(path))
+    waveform = inj_io.resample_to_rate(waveform, path, sample_rate)
+
+    # write segment
+    if not os.path.exists(shm_dir):
+        os.makedirs(shm_dir)
+    inj_io.write_waveform(segment_path, waveform, sample_rate=sample_rate)
+    return segment_path
+
+def find_segment(waveform_path, shm_dir, sample_rate=16384):
+    """ Returns the path of the shared-memory segment of a waveform file if
+    the segment has been written. The segment is a binary waveform file so
+    reading it with read_waveform memory-maps it.
+
+    Parameters
+    ----------
+    waveform_path: str
+        Path to the waveform file.
+    shm_dir: str
+        Path to the shared-memory directory.
+    sample_rate: int
+        Sample rate of the excitation channel.
+
+    Returns
+    ----------
+    segment_path: str
+        Path to the shared-memory segment. If there is no segment for the
+        waveform file then None.
+    """
+    try:
+        segment_path = get_segment_path(waveform_path, shm_dir,
+                                        sample_rate=sample_rate)
+    except OSError:
+        return None
+    if not os.path.exists(segment_path + ".len"):
+        return None
+    return segment_path
+
+def remove_stale_segments(shm_dir, keep_paths, min_age=3600):
+    """ Removes shared-memory segments that are not in keep_paths and have
+    not been modified in min_age seconds.
+
+    Parameters
+    ----------
+    shm_dir: str
+        Path to the shared-memory directory.
+    keep_paths: list
+        Paths of the segments to keep.
+    min_age: float
+        Minimum seconds since a segment was modified to remove it.
+
+    Returns
+    ----------
+    removed_paths: list
+        Paths of the segments that were removed.
+    """
+    keep_paths = set(keep_paths)
+    removed_paths = []
+    for segment_path in glob.glob(os.path.join(shm_dir, "*.f64")):
+        if segment_path in keep_paths \
+                or time.time() - os.path.getmtime(segment_path) < min_age:
+            continue
+        for suffix in [".len", "", ".sha256", ".rate"]:
+            if os.path.exists(segment_path + suffix):
+                os.remove(segment_path + suffix)
+        removed_paths.append(segment_path)
+    return removed_paths
@@ -0,0 +1,176 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ snapshot guardian module
+
+This module provides functions for writing and reading compiled snapshots of
+a parsed and validated schedule file.
+
+A snapshot is two files written next to the schedule file. The first is a
+numpy file with the rows of the ScheduleTable and, for each IFO, the index of
+the resolved waveform path, the number of samples in the waveform file, and
+the content hash, modification time, and size of the waveform file. The
+guardian node uses the resolved path to read the waveform, the length to
+check the schedule times, and the content hash to share the waveform in the
+waveform_store without hashing it. The second is a JSON file with the
+hash of the schedule file, the IFOs, and the lists of INJECT states and paths.
+A snapshot is only used if the hash of the schedule file has not changed, and
+the numpy file is memory-mapped so loading it is fast.
+
+2016 - Christopher M. Biwer
+"""
+
+import inj_io
+import inj_types
+import json
+import numpy
+import os
+import os.path
+
+def get_snapshot_paths(schedule_path):
+    """ Returns the paths of the files of the snapshot of a schedule file.
+
+    Parameters
+    ----------
+    schedule_path: str
+        Path to the schedule file.
+
+    Returns
+    ----------
+    rows_path: str
+        Path to the numpy file with the rows.
+    header_path: str
+        Path to the JSON file with the header.
+    """
+    return schedule_path + ".snapshot.npy", schedule_path + ".snapshot.json"
+
+def get_snapshot_dtype(n_ifos):
+    """ Returns the data type of the rows in a snapshot with n_ifos IFOs.
+    """
+    return numpy.dtype(inj_types.schedule_dtype.descr + [
+        ("resolved_index", numpy.int32, (n_ifos,)),
+        ("waveform_length", numpy.int64, (n_ifos,)),
+        ("content_hash", "S64", (n_ifos,)),
+        ("waveform_mtime", numpy.float64, (n_ifos,)),
+        ("waveform_size", numpy.int64, (n_ifos,)),
+    ])
+
+def write_schedule_snapshot(schedule_path, ifo_list, waveform_lengths=None):
+    """ Parses a schedule file and writes a snapshot of it.
+
+    Parameters
+    ----------
+    schedule_path: str
+        Path to the schedule file.
+    ifo_list: list
+        IFOs to resolve the {ifo} substring in the waveform paths.
+    waveform_lengths: dict
+        A dict keyed by resolved waveform path with the number of samples in
+        the waveform file, eg. from validating the schedule. If a path is not
+        in the dict then the length sidecar file is used if it exists.
+
+    Returns
+    ----------
+    schedule_table: ScheduleTable
+        The table that was written.
+    """
+    waveform_lengths = waveform_lengths or {}
+
+    # hash schedule file and parse it
+    schedule_hash = inj_io.file_sha256(schedule_path)
+    schedule_table = inj_io.read_schedule_table(schedule_path,
+                                                use_snapshot=False)
+
+    # copy rows to snapshot rows
+    paths = list(schedule_table.paths)
+    path_indices = dict([(path, i) for i, path in enumerate(paths)])
+    rows = numpy.zeros(len(schedule_table),
+                       dtype=get_snapshot_dtype(len(ifo_list)))
+    for name in inj_types.schedule_dtype.names:
+        rows[name] = schedule_table.rows[name]
+
+    # resolve paths for each IFO
+    rows["waveform_length"] = -1
+    for i, row in enumerate(schedule_table):
+        for j, ifo in enumerate(ifo_list):
+            path = row.waveform_path.format(ifo=ifo)
+            if path not in path_indices:
+                path_indices[path] = len(paths)
+                paths.append(path)
+            rows["resolved_index"][i, j] = path_indices[path]
+
+            # get length, content hash, modification time, and size of
+            # waveform file
+            if path in waveform_lengths:
+                rows["waveform_length"][i, j] = waveform_lengths[path]
+            elif os.path.exists(path):
+                length = inj_io.read_waveform_length(path)
+                if length is not None:
+                    rows["waveform_length"][i, j] = length
+            if os.path.exists(path):
+                stat = os.stat(path)
+                rows["content_hash"][i, j] = inj_io.file_content_hash(path)
+                rows["waveform_mtime"][i, j] = stat.st_mtime
+                rows["waveform_size"][i, j] = stat.st_size
+
+    # write files to temporary paths and then rename them, the header is
+    # renamed last since it has the hash of the schedule file
+    rows_path, header_path = get_snapshot_paths(schedule_path)
+    tmp_suffix = ".tmp%d"%os.getpid()
+    fp = open(rows_path + tmp_suffix, "wb")
+    numpy.save(fp, rows)
+    fp.close()
+    header = {
+        "schedule_hash" : schedule_hash,
+        "ifos" : list(ifo_list),
+        "state_names" : schedule_table.state_names,
+        "paths" : paths,
+    }
+    fp = open(header_path + tmp_suffix, "w")
+    json.dump(header, fp)
+    fp.close()
+    os.rename(rows_path + tmp_suffix, rows_path)
+    os.rename(header_path + tmp_suffix, header_path)
+
+    return inj_types.ScheduleTable(rows, header["state_names"], paths,
+                                   ifos=ifo_list)
+
+def read_schedule_snapshot(schedule_path):
+    """ Reads the snapshot of a schedule file if it is up-to-date.
+
+    Parameters
+    ----------
+    schedule_path: str
+        Path to the schedule file.
+
+    Returns
+    ----------
+    schedule_table: ScheduleTable
+        The table from the snapshot with memory-mapped rows. If there is no
+        snapshot or the schedule file has changed then None.
+    """
+
+    # read header
+    rows_path, header_path = get_snapshot_paths(schedule_path)
+    if not os.path.exists(header_path) or not os.path.exists(rows_path):
+        return None
+    fp = open(header_path, "r")
+    try:
+        header = json.load(fp)
+    except ValueError:
+        return None
+    finally:
+        fp.close()
+
+    # check schedule file has not changed
+    if header.get("schedule_hash") != inj_io.file_sha256(schedule_path):
+        return None
+
+    # memory-map rows and check they have all columns of a snapshot since a
+    # snapshot written by an older version may not
+    rows = numpy.load(rows_path, mmap_mode="r")
+    if not set(get_snapshot_dtype(0).names).issubset(rows.dtype.names):
+        return None
+    return inj_types.ScheduleTable(rows, [str(name) for name in header["state_names"]],
+                                   [str(path) for path in header["paths"]],
+                                   ifos=[str(ifo) for ifo in header["ifos"]])
@@ -0,0 +1,132 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ spectral guardian module
+
+This module provides functions for estimating the power spectral density of
+a waveform and checking that its power is in the frequency band expected for
+the type of injection.
+
+2016 - Christopher M. Biwer
+"""
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+# map injection states to the frequency band in Hz where most of the power
+# of the waveform is expected to be
+default_band_dict = {
+    "INJECT_CBC_ACTIVE" : (10.0, 2048.0),
+    "INJECT_BURST_ACTIVE" : (16.0, 8192.0),
+    "INJECT_STOCHASTIC_ACTIVE" : (10.0, 1024.0),
+}
+
+# number of overlapping segments to Fourier transform at a time
+segments_per_block = 16
+
+# cache of band-power summaries keyed by waveform key, sample rate, and bands
+band_power_cache = {}
+
+def welch_psd(waveform, sample_rate, segment_seconds=1.0, overlap=0.5):
+    """ Estimates the one-sided power spectral density of a time series with
+    Welch's method. Segments are Hann-windowed after removing their mean.
+
+    The time series is processed in blocks of segments_per_block overlapping
+    segments. Each block is a strided view of the time series, so a
+    memory-mapped waveform is read without copying it and memory use does not
+    depend on the length of the time series.
+
+    Parameters
+    ----------
+    waveform: numpy.array
+        The time series.
+    sample_rate: int
+        Sample rate of the time series.
+    segment_seconds: float
+        Length of each segment in seconds.
+    overlap: float
+        Fraction of each segment that overlaps the next segment.
+
+    Returns
+    ----------
+    freqs: numpy.array
+        Frequencies of the power spectral density in Hz.
+    psd: numpy.array
+        The power spectral density.
+    """
+
+    # get segment length and stride
+    n_samples = len(waveform)
+    segment_length = min(int(segment_seconds * sample_rate), max(n_samples, 1))
+    step = max(int(segment_length * (1.0 - overlap)), 1)
+    n_segments = max((n_samples - segment_length) // step + 1, 1)
+
+    # window and normalization of one-sided power spectral density
+    window = numpy.hanning(segment_length + 1)[:-1] if segment_length > 1 \
+                 else numpy.ones(segment_length)
+    scale = 1.0 / (sample_rate * (window**2).sum())
+    psd = numpy.zeros(segment_length // 2 + 1)
+
+    # sum periodograms of blocks of segments
+    waveform = numpy.asarray(waveform)
+    if n_samples < segment_length:
+        waveform = numpy.zeros(segment_length)
+    for first in range(0, n_segments, segments_per_block):
+        n = min(segments_per_block, n_segments - first)
+        block = waveform[first * step:(first + n - 1) * step + segment_length]
+        segments = as_strided(block, shape=(n, segment_length),
+                              strides=(step * block.strides[0], block.strides[0]))
+        segments = segments - segments.mean(axis=1)[:, numpy.newaxis]
+        psd += (numpy.abs(numpy.fft.rfft(segments * window, axis=1))**2).sum(axis=0)
+
+    # average and make one-sided
+    psd *= scale / n_segments
+    if segment_length % 2:
+        psd[1:] *= 2
+    else:
+        psd[1:-1] *= 2
+    freqs = numpy.fft.rfftfreq(segment_length, 1.0 / sample_rate)
+
+    return freqs, psd
+
+def band_power_fraction(waveform, sample_rate, band, key=None):
+    """ Returns the fraction of the power of a time series that is in a
+    frequency band. The power is estimated with welch_psd.
+
+    Parameters
+    ----------
+    waveform: numpy.array
+        The time series.
+    sample_rate: int
+        Sample rate of the time series.
+    band: tuple
+        Lower and upper frequency of the band in Hz.
+    key: str
+        If not None then the fraction is cached with this key, eg. the
+        key of the waveform file, and a cached fraction is returned
+        without estimating the power spectral density again.
+
+    Returns
+    ----------
+    fraction: float
+        Fraction of the power in the band. If the time series has no power
+        then 1.0 is returned.
+    """
+
+    # check cache
+    cache_key = (key, sample_rate, tuple(band))
+    if key is not None and cache_key in band_power_cache:
+        return band_power_cache[cache_key]
+
+    # sum power in band
+    freqs, psd = welch_psd(waveform, sample_rate)
+    total_power = psd.sum()
+    if total_power > 0:
+        in_band = (freqs >= band[0]) & (freqs <= band[1])
+        fraction = float(psd[in_band].sum() / total_power)
+    else:
+        fraction = 1.0
+
+    if key is not None:
+        band_power_cache[cache_key] = fraction
+    return fraction
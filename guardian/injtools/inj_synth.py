@@ -0,0 +1,134 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ synthesis guardian module
+
+This module provides functions for generating analytic waveforms, such as
+sine-Gaussians, Gaussians, and ringdowns, from a parameter spec instead of
+reading a waveform file.
+
+A spec is written in the waveform_path column of the schedule file as the
+prefix "synth:" then the name of the shape and comma-separated parameters,
+eg. synth:sine_gaussian,frequency=235,q=9,amplitude=1e-21. The spec cannot
+have whitespace since the schedule file is whitespace-delimited.
+
+2016 - Christopher M. Biwer
+"""
+
+import collections
+import numpy
+
+# prefix of waveform_path column for a synthetic waveform
+synth_prefix = "synth:"
+
+# number of synthesized waveforms to keep so that they are not generated again
+max_cached_waveforms = 16
+
+# cache of synthesized waveforms keyed by spec and sample rate
+synthetic_waveform_cache = collections.OrderedDict()
+
+def sine_gaussian(times, frequency, q, amplitude=1.0, phase=0.0, center=None):
+    """ Returns a sine-Gaussian with a Gaussian envelope whose width is
+    q / (sqrt(2) * pi * frequency) seconds.
+    """
+    tau = q / (numpy.sqrt(2.0) * numpy.pi * frequency)
+    dt = times - (center if center is not None else times[-1] / 2.0)
+    return amplitude * numpy.exp(-(dt / tau)**2) \
+               * numpy.sin(2 * numpy.pi * frequency * dt + phase)
+
+def gaussian(times, sigma, amplitude=1.0, center=None):
+    """ Returns a Gaussian with a width of sigma seconds.
+    """
+    dt = times - (center if center is not None else times[-1] / 2.0)
+    return amplitude * numpy.exp(-0.5 * (dt / sigma)**2)
+
+def ringdown(times, frequency, q, amplitude=1.0, phase=0.0, start=0.0):
+    """ Returns an exponentially damped sinusoid with a damping time of
+    q / (pi * frequency) seconds that starts at start seconds.
+    """
+    tau = q / (numpy.pi * frequency)
+    dt = numpy.maximum(times - start, 0.0)
+    return numpy.where(times >= start, amplitude * numpy.exp(-dt / tau) \
+               * numpy.sin(2 * numpy.pi * frequency * dt + phase), 0.0)
+
+# map names of shapes in a spec to functions and a function that returns the
+# default duration in seconds from the parameters
+synth_function_dict = {
+    "sine_gaussian" : (sine_gaussian,
+                       lambda p: 8 * p["q"] / (numpy.sqrt(2.0) * numpy.pi * p["frequency"])),
+    "gaussian" : (gaussian, lambda p: 8 * p["sigma"]),
+    "ringdown" : (ringdown,
+                  lambda p: p.get("start", 0.0) + 10 * p["q"] / (numpy.pi * p["frequency"])),
+}
+
+def is_synthetic_waveform(waveform_path):
+    """ Returns True if a waveform_path column is a spec of a synthetic
+    waveform.
+    """
+    return waveform_path.startswith(synth_prefix)
+
+def parse_synthetic_spec(spec):
+    """ Parses the spec of a synthetic waveform.
+
+    Parameters
+    ----------
+    spec: str
+        The spec, eg. synth:gaussian,sigma=0.01,amplitude=1e-21.
+
+    Returns
+    ----------
+    shape: str
+        Name of the shape.
+    params: dict
+        A dict of parameter names and float values.
+    """
+    fields = spec[len(synth_prefix):].split(",")
+    shape = fields[0]
+    if shape not in synth_function_dict:
+        raise ValueError("Unknown synthetic waveform shape %s"%shape)
+    params = {}
+    for field in fields[1:]:
+        name, _, value = field.partition("=")
+        params[name] = float(value)
+    return shape, params
+
+def synthesize_waveform(spec, sample_rate):
+    """ Generates a synthetic waveform from its spec. The parameter duration
+    gives the length of the waveform in seconds, otherwise a length that
+    contains the shape is used. Other parameters are passed to the function
+    of the shape. Waveforms are cached by spec and sample rate.
+
+    Parameters
+    ----------
+    spec: str
+        The spec, eg. synth:sine_gaussian,frequency=235,q=9.
+    sample_rate: int
+        Sample rate of the waveform.
+
+    Returns
+    ----------
+    waveform: numpy.array
+        The time series.
+    """
+
+    # check cache
+    key = (spec, sample_rate)
+    if key in synthetic_waveform_cache:
+        synthetic_waveform_cache[key] = synthetic_waveform_cache.pop(key)
+        return synthetic_waveform_cache[key]
+
+    # generate waveform
+    shape, params = parse_synthetic_spec(spec)
+    func, default_duration = synth_function_dict[shape]
+    duration = params.pop("duration", None)
+    if duration is None:
+        duration = default_duration(params)
+    times = numpy.arange(max(int(duration * sample_rate), 1),
+                         dtype=numpy.float64) / sample_rate
+    waveform = func(times, **params)
+
+    # add to cache and remove least recently used waveform
+    synthetic_waveform_cache[key] = waveform
+    while len(synthetic_waveform_cache) > max_cached_waveforms:
+        synthetic_waveform_cache.popitem(last=False)
+    return waveform
@@ -0,0 +1,374 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ timing guardian module
+
+This module provides classes for recording how long guardian states take to
+prepare a hardware injection and how much lead time is left before the
+injection begins.
+
+2016 - Christopher M. Biwer
+"""
+
+import collections
+import functools
+import numpy
+import os
+import os.path
+from gpstime import gpstime
+
+class StateTimer(object):
+    """ A class that records the entry and exit GPS times of guardian states for
+    each hardware injection.
+
+    The latency of each state is kept in a rolling history so that a histogram
+    of the most recent latencies can be made for any state. The lead-time
+    margin, ie. the seconds left before the scheduled start time when the node
+    jumps to the _INJECT_STATE_ACTIVE state, is written to a file.
+
+    Parameters
+    ----------
+    margin_path: str
+        Path to the file where lead-time margins are appended. If None then
+        no file is written.
+    history_length: int
+        Number of latencies to keep in the rolling history of each state.
+    injection_history: InjectionHistory
+        If not None then the entry and exit times of each state are also
+        recorded in the injection history.
+    log: function
+        If not None then errors writing the injection history are passed to
+        this function as a message.
+    """
+
+    def __init__(self, margin_path=None, history_length=100,
+                 injection_history=None, log=None):
+        self.margin_path = margin_path
+        self.history_length = history_length
+        self.injection_history = injection_history
+        self.log = log
+        self.latencies = {}
+        self.state_times = collections.OrderedDict()
+        self.hwinj = None
+
+    def enter(self, state_name):
+        """ Returns the GPS time a state was entered.
+
+        Parameters
+        ----------
+        state_name: str
+            Name of the guardian state.
+
+        Returns
+        ----------
+        enter_time: float
+            GPS time the state was entered.
+        """
+        return gpstime.utcnow().gps()
+
+    def exit(self, state_name, enter_time, hwinj=None):
+        """ Records the entry and exit times of a state for a hardware
+        injection and adds the latency to the rolling history of the state.
+
+        Parameters
+        ----------
+        state_name: str
+            Name of the guardian state.
+        enter_time: float
+            GPS time the state was entered.
+        hwinj: HardwareInjection
+            The injection the state was working on. If it is a different
+            injection than the last one, then the recorded state times
+            are reset.
+        """
+
+        # get the current GPS time
+        exit_time = gpstime.utcnow().gps()
+
+        # reset recorded state times for a new injection
+        if hwinj is not None and hwinj is not self.hwinj:
+            self.hwinj = hwinj
+            self.state_times = collections.OrderedDict()
+
+        # record times for this state
+        self.state_times[state_name] = (enter_time, exit_time)
+
+        # add latency to rolling history
+        if state_name not in self.latencies:
+            self.latencies[state_name] = collections.deque(
+                                             maxlen=self.history_length)
+        self.latencies[state_name].append(exit_time - enter_time)
+
+        # record times in injection history, an error writing the history
+        # should not stop the state
+        if self.injection_history is not None and hwinj is not None:
+            try:
+                self.injection_history.record_state(state_name, enter_time,
+                                                    exit_time, hwinj=hwinj)
+            except Exception as e:
+                if self.log is not None:
+                    self.log("Could not record %s in injection history: %s"%(state_name, e))
+
+    def latency_histogram(self, state_name, bins=10):
+        """ Returns a histogram of the rolling history of latencies for
+        a state.
+
+        Parameters
+        ----------
+        state_name: str
+            Name of the guardian state.
+        bins: int
+            Number of bins in the histogram.
+
+        Returns
+        ----------
+        counts: numpy.array
+            Number of latencies in each bin.
+        bin_edges: numpy.array
+            Edges of the bins in seconds.
+        """
+        latencies = numpy.array(self.latencies.get(state_name, []))
+        return numpy.histogram(latencies, bins=bins)
+
+    def latency_summary(self):
+        """ Returns a summary of the rolling history of latencies of all
+        states.
+
+        Returns
+        ----------
+        summary: dict
+            A dict keyed by state name where each value is a tuple of the
+            number of latencies, the median, the 90th percentile, and the
+            maximum latency in seconds.
+        """
+        summary = {}
+        for state_name, latencies in self.latencies.items():
+            latencies = numpy.array(latencies)
+            summary[state_name] = (len(latencies),
+                                   numpy.median(latencies),
+                                   numpy.percentile(latencies, 90),
+                                   latencies.max())
+        return summary
+
+    def record_lead_time(self, hwinj, ezca=None, channel_name=None):
+        """ Records the lead-time margin of a hardware injection. This should
+        be called right before jumping to the _INJECT_STATE_ACTIVE state.
+
+        A line is appended to the file at margin_path with the following
+        columns: scheduled GPS start time, INJECT state, GPS time of the
+        jump, lead-time margin in seconds, and the latency of each state
+        recorded for the injection.
+
+        Parameters
+        ----------
+        hwinj: HardwareInjection
+            The injection that will be performed.
+        ezca: Ezca
+            If not None then write the margin to the EPICS record channel_name.
+        channel_name: str
+            Name of the EPICS record to write the margin.
+
+        Returns
+        ----------
+        margin: float
+            Seconds between now and the scheduled start time of the injection.
+        """
+
+        # get the current GPS time
+        current_gps_time = gpstime.utcnow().gps()
+        margin = hwinj.schedule_time - current_gps_time
+
+        # write margin to EPICS record
+        if ezca is not None and channel_name:
+            ezca[channel_name] = margin
+
+        # append line to file
+        if self.margin_path:
+            state_times = self.state_times if hwinj is self.hwinj else {}
+            line = [hwinj.schedule_time, hwinj.schedule_state,
+                    current_gps_time, margin]
+            line += ["%s=%f"%(state_name, exit_time - enter_time)
+                     for state_name, (enter_time, exit_time) in state_times.items()]
+            margin_dir = os.path.dirname(self.margin_path)
+            if margin_dir and not os.path.exists(margin_dir):
+                os.makedirs(margin_dir)
+            fp = open(self.margin_path, "a")
+            fp.write(" ".join(map(str, line)) + "\n")
+            fp.close()
+
+        return margin
+
+class LeadTimeEstimator(object):
+    """ A class that estimates how many seconds in advance of its scheduled
+    start time the node needs to begin preparing a hardware injection.
+
+    The estimate is the sum of the recent latencies of the states that prepare
+    an injection, eg. uploading to GraceDB, plus the time of the state that
+    reads the waveform. The time of the read state is the larger of its recent
+    latency and the time given the size of the waveform file and the recently
+    measured throughput of the whole state, ie. reading, checking, and
+    coalescing the waveform. This sum is multiplied by a safety factor and then
+    jump_to_inj_seconds is added. The estimate is clipped to be between
+    min_seconds and max_seconds. If there is not enough history to make an
+    estimate, then max_seconds is returned.
+
+    Parameters
+    ----------
+    state_timer: StateTimer
+        The StateTimer that records the latencies of the states.
+    min_seconds: float
+        Minimum lead time in seconds.
+    max_seconds: float
+        Maximum lead time in seconds.
+    jump_seconds: float
+        Seconds before the injection start time when the node jumps to the
+        _INJECT_STATE_ACTIVE state.
+    state_names: list
+        Names of the states whose latencies are added to the estimate.
+    read_state_name: str
+        Name of the state that reads the waveform.
+    safety_factor: float
+        Factor to multiply the preparation time.
+    history_length: int
+        Number of read throughput measurements to keep.
+    """
+
+    def __init__(self, state_timer, min_seconds, max_seconds, jump_seconds,
+                 state_names=("CHECK_SCHEDULE_TIMES", "CREATE_GRACEDB_EVENT",
+                              "CREATE_AWG_STREAM"),
+                 read_state_name="READ_WAVEFORM",
+                 safety_factor=2.0, history_length=20):
+        self.state_timer = state_timer
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.jump_seconds = jump_seconds
+        self.state_names = state_names
+        self.read_state_name = read_state_name
+        self.safety_factor = safety_factor
+        self.read_throughputs = collections.deque(maxlen=history_length)
+        self.waveform_sizes = {}
+
+    def waveform_size(self, hwinj, format_dict=None):
+        """ Returns the size in bytes of the waveform file of a
+        HardwareInjection. Sizes are cached by path.
+
+        Parameters
+        ----------
+        hwinj: HardwareInjection
+            The injection to get the waveform file size.
+        format_dict: dict
+            A dict to be used with python built-in string formatting.
+
+        Returns
+        ----------
+        size: int
+            Size of the file in bytes. If the file does not exist then None.
+        """
+        if format_dict is not None:
+            path = hwinj.waveform_path.format(**format_dict)
+        else:
+            path = hwinj.waveform_path
+        if path not in self.waveform_sizes:
+            try:
+                self.waveform_sizes[path] = os.path.getsize(path)
+            except OSError:
+                return None
+        return self.waveform_sizes[path]
+
+    def record_read(self, hwinj, seconds, format_dict=None):
+        """ Records the time it took the read state to prepare the waveform
+        of a HardwareInjection, ie. to read, check, and coalesce it.
+
+        Parameters
+        ----------
+        hwinj: HardwareInjection
+            The injection whose waveform file was read.
+        seconds: float
+            Time in seconds the read state took.
+        format_dict: dict
+            A dict to be used with python built-in string formatting.
+        """
+        size = self.waveform_size(hwinj, format_dict=format_dict)
+        if size and seconds > 0:
+            self.read_throughputs.append(size / float(seconds))
+
+    def lead_time(self, hwinj, format_dict=None):
+        """ Returns the estimated lead time for a HardwareInjection.
+
+        Parameters
+        ----------
+        hwinj: HardwareInjection
+            The injection to estimate the lead time.
+        format_dict: dict
+            A dict to be used with python built-in string formatting.
+
+        Returns
+        ----------
+        lead_time: float
+            Seconds in advance of the start time to begin preparing the
+            injection.
+        """
+
+        # if there are no measurements then use the maximum
+        size = self.waveform_size(hwinj, format_dict=format_dict)
+        if not size or not len(self.read_throughputs):
+            return self.max_seconds
+
+        # add latencies of the states that prepare the injection
+        prepare_seconds = 0.0
+        for state_name in self.state_names:
+            latencies = self.state_timer.latencies.get(state_name)
+            if not latencies:
+                return self.max_seconds
+            prepare_seconds += numpy.percentile(latencies, 90)
+
+        # add time to read the waveform file, the recent latency of the read
+        # state covers the work that does not scale with the file size
+        read_seconds = size / numpy.min(self.read_throughputs)
+        latencies = self.state_timer.latencies.get(self.read_state_name)
+        if latencies:
+            read_seconds = max(read_seconds, numpy.percentile(latencies, 90))
+        prepare_seconds += read_seconds
+
+        # add margin and clip
+        lead_time = self.safety_factor * prepare_seconds + self.jump_seconds
+        return min(max(lead_time, self.min_seconds), self.max_seconds)
+
+def timed_state(state_timer):
+    """ Create a decorator for a GuardState method that records the entry and
+    exit times of the state with a StateTimer. The name of the state is the
+    name of the GuardState class and the injection is the hwinj attribute of
+    the GuardState after the method returns.
+
+    The decorator wraps the method itself, so it should be placed below any
+    GuardStateDecorator, eg.
+
+        @check_exttrig_alert(hwinj_list, "ABORT_INJECT_FOR_EXTTRIG")
+        @injtools.timed_state(state_timer)
+        def main(self):
+
+    Parameters
+    ----------
+    state_timer: StateTimer
+        The StateTimer to record times.
+
+    Returns
+    ----------
+    timed_state_decorator: function
+        A decorator for a GuardState method.
+    """
+
+    def timed_state_decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            state_name = self.__class__.__name__
+            enter_time = state_timer.enter(state_name)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                state_timer.exit(state_name, enter_time, hwinj=self.hwinj)
+
+        return wrapper
+
+    return timed_state_decorator
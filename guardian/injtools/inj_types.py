@@ -8,12 +8,27 @@ This module provides class for managing hardware injections.
 2016 - Christopher M. Biwer
 """
 
-import awg
+import collections
+import inj_filter
 import inj_io
+import inj_resample
+import inj_shm
 import numpy
 import os.path
+import threading
+import time
 from gpstime import gpstime
 from guardian import GuardState
+from inj_lazy import LazyModule
+
+# awg is slow to import so it is imported when first used
+awg = LazyModule("awg")
+
+# number of samples to append to a stream at a time when data is filtered
+send_block_size = 2**16
+
+# maximum seconds to wait for each stream to be aborted and closed
+stream_abort_timeout = 10.0
 
 class HwinjGuardState(GuardState):
     """ A subclass of the guardian GuardState that has a hwinj class attribute.
@@ -31,12 +46,227 @@ class HwinjGuardState(GuardState):
     """
     hwinj = None
 
+class WaveformStore(object):
+    """ A class that stores waveform arrays shared between HardwareInjection
+    instances so that a waveform file used by many injections is only read
+    once.
+
+    Arrays are keyed by the path, modification time, and size of the waveform
+    file. If the waveform file has a checksum sidecar file, or hash_files is
+    True, then arrays are keyed by the content hash of the file instead so
+    that waveform files with the same contents share an array.
+
+    Each call to acquire returns a read-only view of the array and increments
+    a reference count. Each call to release decrements the reference count.
+    When no injection is using an array it is kept in a least-recently-used
+    cache, so a waveform used again by a later injection is not read again.
+    The oldest arrays are removed from the cache when its arrays use more than
+    max_cached_bytes bytes.
+
+    Arrays may be acquired from the thread of an InjectionPipeline and
+    released from the main thread so the store is guarded by a lock. A
+    waveform file is read outside the lock so that a slow read does not block
+    the other thread, and only one thread reads a waveform file at a time.
+
+    Parameters
+    ----------
+    max_cached_bytes: int
+        Maximum number of bytes of arrays kept when no injection is using
+        them.
+    hash_files: bool
+        If True then hash waveform files that do not have a checksum sidecar
+        file to get their key.
+    """
+
+    def __init__(self, max_cached_bytes=2**30, hash_files=False):
+        self.max_cached_bytes = max_cached_bytes
+        self.hash_files = hash_files
+        self.waveforms = {}
+        self.ref_counts = {}
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.reading = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, waveform_path, ftype="ascii", sample_rate=16384,
+                key=None):
+        """ Returns a read-only view of the array of a waveform file. The
+        waveform file is only read if it is not in the store.
+
+        Parameters
+        ----------
+        waveform_path: str
+            Path to the waveform file.
+        ftype: str
+            Selects what method to use to read the waveform file.
+        sample_rate: int
+            Sample rate to generate a synthetic waveform. A waveform file with
+            a rate sidecar file is stored at its own rate, see
+            HardwareInjection.read_data.
+        key: str
+            The content hash of the waveform file if it is already known, eg.
+            from a schedule snapshot. If None then the key is found from the
+            waveform file.
+
+        Returns
+        ----------
+        key: str
+            The key of the array in the store. It should be used to release
+            the array.
+        waveform: numpy.array
+            A read-only view of the time series.
+        """
+        if key is None:
+            key = inj_io.file_content_key(waveform_path,
+                                          hash_file=self.hash_files)
+
+        # use the array in the store or wait if another thread is reading it
+        while True:
+            with self.lock:
+                if key in self.cache:
+                    self.waveforms[key] = self.cache.pop(key)
+                    self.cached_bytes -= self.waveforms[key].nbytes
+                    self.ref_counts[key] = 0
+                if key in self.waveforms:
+                    self.ref_counts[key] += 1
+                    return key, self.waveforms[key].view()
+                if key not in self.reading:
+                    self.reading[key] = threading.Event()
+                    break
+                reading = self.reading[key]
+            reading.wait()
+
+        # read the waveform file outside the lock
+        try:
+            waveform = inj_io.read_waveform(waveform_path, ftype=ftype,
+                                            sample_rate=sample_rate)
+            waveform.flags.writeable = False
+            with self.lock:
+                self.waveforms[key] = waveform
+                self.ref_counts[key] = 1
+            return key, waveform.view()
+        finally:
+            with self.lock:
+                self.reading.pop(key).set()
+
+    def release(self, key):
+        """ Decrements the reference count of an array and moves the array
+        to the cache if it is no longer used.
+
+        Parameters
+        ----------
+        key: str
+            The key of the array returned by acquire.
+        """
+        with self.lock:
+            if key not in self.ref_counts:
+                return
+            self.ref_counts[key] -= 1
+            if self.ref_counts[key] <= 0:
+                del self.ref_counts[key]
+                waveform = self.waveforms.pop(key)
+                self.cache[key] = waveform
+                self.cached_bytes += waveform.nbytes
+                while self.cached_bytes > self.max_cached_bytes:
+                    _, waveform = self.cache.popitem(last=False)
+                    self.cached_bytes -= waveform.nbytes
+
+# store of waveform arrays shared between HardwareInjection instances
+waveform_store = WaveformStore()
+
+class InjectionRegistry(object):
+    """ A class that keeps track of the HardwareInjection instances that hold
+    a stream or data, so that streams can be killed and data released without
+    looping over every injection in the schedule. Injections are added by the
+    create_stream and read_data methods and removed by close_all_streams.
+
+    Injections may be added from the thread of an InjectionPipeline so the
+    registry is guarded by a lock.
+    """
+
+    def __init__(self):
+        self.hwinjs = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hwinjs)
+
+    def __iter__(self):
+        """ Iterates over a copy of the registered injections so they can be
+        removed while iterating.
+        """
+        with self.lock:
+            return iter(list(self.hwinjs))
+
+    def add(self, hwinj):
+        """ Registers a HardwareInjection.
+        """
+        with self.lock:
+            self.hwinjs.add(hwinj)
+
+    def discard(self, hwinj):
+        """ Removes a HardwareInjection if it is registered.
+        """
+        with self.lock:
+            self.hwinjs.discard(hwinj)
+
+# HardwareInjection instances that hold a stream or data
+active_injections = InjectionRegistry()
+
+class OffsetData(object):
+    """ A class that skips the first samples of data that is generated in
+    blocks, such as a ColoredNoiseGenerator, so that a generated injection can
+    be resumed from a sample offset. The skipped samples are still generated
+    so the remaining samples are the same as in the whole time series.
+
+    Parameters
+    ----------
+    data: object
+        An object with __len__ and iter_blocks methods.
+    offset: int
+        Number of samples to skip.
+    """
+
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = min(int(offset), len(data))
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def __getattr__(self, name):
+        # other attributes, eg. the expected_rms of a ColoredNoiseGenerator,
+        # are from the data
+        if name == "data":
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+    def iter_blocks(self):
+        """ Yields the blocks of the data after the skipped samples.
+        """
+        skip = self.offset
+        for block in self.data.iter_blocks():
+            if skip >= len(block):
+                skip -= len(block)
+                continue
+            yield block[skip:]
+            skip = 0
+
 class HardwareInjection(object):
     """ A class representing a single hardware injection.
     """
 
+    # there can be many instances so do not use a per-instance dict
+    __slots__ = ("schedule_time", "schedule_state", "observation_mode",
+                 "scale_factor", "waveform_path", "metadata_path", "stream",
+                 "data", "waveform_key", "gracedb_id", "waveform_length",
+                 "fractional_delay", "coalesced_hwinj_list", "sample_offset",
+                 "samples_delivered", "schedule_row", "data_sent", "filters",
+                 "schedule_fraction")
+
     def __init__(self, schedule_time, schedule_state, observation_mode,
-                 scale_factor, waveform_path, metadata_path):
+                 scale_factor, waveform_path, metadata_path, sample_offset=0,
+                 schedule_fraction=None):
 
         self.schedule_time = float(schedule_time)
         self.schedule_state = schedule_state
@@ -46,7 +276,20 @@ class HardwareInjection(object):
         self.metadata_path = metadata_path
         self.stream = None
         self.data = None
+        self.waveform_key = None
         self.gracedb_id = None
+        self.fractional_delay = None
+        self.coalesced_hwinj_list = None
+        self.sample_offset = int(sample_offset)
+        self.samples_delivered = None
+        self.schedule_row = None
+        self.data_sent = False
+        self.filters = []
+
+        # the fractional second of schedule_time parsed exactly from the
+        # schedule file since a float GPS time is not precise enough to
+        # align the start of the stream to a fraction of a sample
+        self.schedule_fraction = schedule_fraction
 
     def __repr__(self):
         """ String representation of instance.
@@ -65,12 +308,21 @@ class HardwareInjection(object):
         DURATION is the length in seconds of the waveform file, and EXT is
         an arbitrary file extension.
 
+        A synthetic waveform or generated noise from a spec starts at
+        schedule_time, so the times in its meta-data file are taken as the
+        times of the injection.
+
         Returns
         ----------
         waveform_start_time: float
             Start time of the waveform file.
         """
 
+        # a waveform generated from a spec has no file name with a start time
+        if inj_io.get_waveform_ftype(self.waveform_path) \
+                in ["synthetic", "noise"]:
+            return self.schedule_time
+
         # get waveform file name
         filename = os.path.basename(self.waveform_path)
 
@@ -79,35 +331,445 @@ class HardwareInjection(object):
 
         return float(waveform_start_time)
 
-    def create_stream(self, channel_name, sample_rate):
+    def create_stream(self, channel_name, sample_rate, align_start=False):
         """ Creates an ArbitraryStream instance for the HardwareInjection. The
         ArbitraryStream is accessible with the self.stream attribute.
 
+        If align_start is True then the stream starts on a whole sample and
+        the remaining fraction of a sample of schedule_time is applied to the
+        data with a FractionalDelayFilter in send_data. The stream starts
+        early by the latency of the filter.
+
         Parameters
         ----------
         channel_name: str
             Name of excitation channel to inject signal.
         sample_rate: int
             Sample rate of the time series and excitation channel.
+        align_start: bool
+            If True then delay the data by the fraction of a sample of
+            schedule_time.
         """
 
+        # split start time into whole samples and a fractional delay
+        start_time = self.schedule_time
+        self.fractional_delay = None
+        if align_start:
+            start_time, step = inj_filter.split_start_time(self.schedule_time,
+                                   sample_rate, fraction=self.schedule_fraction)
+            if step:
+                self.fractional_delay = inj_filter.FractionalDelayFilter(step)
+                start_time -= float(self.fractional_delay.latency) / sample_rate
+
         # call awg to create a stream
         self.stream = awg.ArbitraryStream(channel_name, rate=sample_rate,
-                                          start=self.schedule_time)
+                                          start=start_time)
+        active_injections.add(self)
+
+    def read_data(self, format_dict=None, shm_dir=None, sample_rate=16384):
+        """ Reads waveform data. The data is shared with other injections that
+        use the same waveform file through the waveform_store, so the returned
+        array is read-only. The data should be released with
+        the release_data method.
+
+        If sample_offset is nonzero then the data starts at that sample of
+        the waveform, eg. to resume an injection that was interrupted.
 
-    def read_data(self, format_dict=None):
-        """ Reads waveform data.
+        If the injection was made from a schedule snapshot, see schedule_row,
+        then the resolved waveform path is from the snapshot, and the content
+        hash from the snapshot is the key of the data in the waveform_store if
+        the waveform file has not changed.
 
         format_dict: dict
             A dict to be used with python built-in string formatting.
+        shm_dir: str
+            Path to the shared-memory directory where a preparation process
+            writes waveforms. If the waveform is there then it is memory-mapped
+            instead of reading the waveform file.
+        sample_rate: int
+            Sample rate to generate a synthetic waveform or noise, and to
+            resample a waveform file with a rate sidecar file to.
+
+        Returns
+        ----------
+        data: {numpy.array, ColoredNoiseGenerator, ResampledData, OffsetData}
+            The time series from sample_offset. For generated noise a
+            ColoredNoiseGenerator that generates the time series in blocks,
+            and for a waveform file at another rate a ResampledData that
+            resamples it in blocks.
         """
 
         # read waveform file
-        if format_dict is not None:
+        ifo = (format_dict or {}).get("ifo")
+        row = self.schedule_row
+        if row is not None and ifo in row.table.ifos:
+            path = row.resolved_waveform_path(ifo)
+        elif format_dict is not None:
             path = self.waveform_path.format(**format_dict)
         else:
             path = self.waveform_path
-        return inj_io.read_waveform(path)
+        active_injections.add(self)
+
+        # generated noise is not stored since it is generated in blocks
+        if inj_io.get_waveform_ftype(path) == "noise":
+            self.release_data()
+            self.waveform_key = inj_io.file_content_hash(path)
+            data = inj_io.read_waveform(path, ftype="noise",
+                                        sample_rate=sample_rate)
+            if self.sample_offset:
+                data = OffsetData(data, self.sample_offset)
+            return data
+
+        # use shared-memory segment if it has been written otherwise use
+        # binary file converted from ASCII file if it is up-to-date, which
+        # has the same content hash as the ASCII file in the snapshot
+        content_hash = None
+        segment_path = None
+        if shm_dir is not None:
+            segment_path = inj_shm.find_segment(path, shm_dir,
+                                                sample_rate=sample_rate)
+        if segment_path is not None:
+            path = segment_path
+        else:
+            if row is not None:
+                content_hash = row.content_hash(ifo)
+            path = inj_io.find_converted_waveform(path)
+
+        # get data from store and release previous data
+        key, data = waveform_store.acquire(path,
+                                           ftype=inj_io.get_waveform_ftype(path),
+                                           sample_rate=sample_rate,
+                                           key=content_hash)
+        self.release_data()
+        self.waveform_key = key
+
+        # resample in blocks as the data is sent if the waveform file has
+        # another rate, sample_offset is a sample at the sample rate
+        waveform_rate = inj_io.read_waveform_rate(path)
+        if waveform_rate is not None and waveform_rate != sample_rate:
+            data = inj_resample.ResampledData(data, waveform_rate, sample_rate)
+            if self.sample_offset:
+                data = OffsetData(data, self.sample_offset)
+            return data
+
+        # resume from sample_offset with a view so the data is not copied
+        if self.sample_offset:
+            data = data[self.sample_offset:]
+        return data
+
+    def iter_data_blocks(self):
+        """ Yields the data in blocks of send_block_size samples. Generated
+        noise is yielded in the blocks it is generated in.
+        """
+        if hasattr(self.data, "iter_blocks"):
+            for block in self.data.iter_blocks():
+                yield block
+        else:
+            for start in range(0, len(self.data), send_block_size):
+                yield self.data[start:start + send_block_size]
+
+    def iter_stream_blocks(self, filters=None):
+        """ Yields the blocks of samples that send_data appends to the
+        stream. The fractional delay from create_stream is applied first and
+        then the filters in order. The state of each filter is reset before
+        the first block, and the end of the data from filters that delay it
+        is yielded after the last block.
+
+        Parameters
+        ----------
+        filters: list
+            Filters, such as ActuationFilter instances, that are applied in
+            order to each block. If None then the filters attribute.
+        """
+        if filters is None:
+            filters = self.filters
+        if self.fractional_delay is not None:
+            filters = [self.fractional_delay] + list(filters)
+        for block_filter in filters:
+            block_filter.reset()
+        for block in self.iter_data_blocks():
+            for block_filter in filters:
+                block = block_filter.process(block)
+            yield block
+
+        # yield the end of the data from filters that delay it
+        tail = numpy.zeros(0)
+        for block_filter in filters:
+            if len(tail):
+                tail = block_filter.process(tail)
+            if hasattr(block_filter, "flush"):
+                tail = numpy.concatenate([tail, block_filter.flush()])
+        if len(tail):
+            yield tail
+
+    def send_data(self, filters=None, monitor=None):
+        """ Sends the data to the stream and waits for the injection to
+        finish. If there are filters, a fractional delay, a monitor, or the
+        data is generated noise then the blocks from iter_stream_blocks are
+        appended to the stream one by one.
+
+        Parameters
+        ----------
+        filters: list
+            Filters, such as ActuationFilter instances, that are applied in
+            order to each block before it is appended to the stream. The
+            fractional delay from create_stream is applied first. If None
+            then the filters attribute.
+        monitor: WaveformMonitor
+            If not None then each block is checked with the monitor before it
+            is appended, eg. for generated noise that is not scanned before
+            it is sent. If a block exceeds a limit then the stream is aborted
+            and the ValueError from the monitor is raised.
+        """
+
+        # mark the data as sent before the stream is opened so an
+        # interrupted injection is recorded once the stream may have data
+        self.data_sent = True
+        if filters is None:
+            filters = self.filters
+        if self.fractional_delay is None and not filters and monitor is None \
+                and not hasattr(self.data, "iter_blocks"):
+            self.stream.send(self.data)
+            return
+        self.stream.open()
+        for block in self.iter_stream_blocks(filters):
+            if monitor is not None:
+                try:
+                    monitor.check(block)
+                except ValueError:
+                    self.stream.abort()
+                    raise
+            self.stream.append(block)
+        self.stream.close()
+
+    def release_data(self):
+        """ Releases waveform data read with the read_data method and sets
+        the data attribute to None.
+        """
+        self.data = None
+        if self.waveform_key is not None:
+            waveform_store.release(self.waveform_key)
+            self.waveform_key = None
+
+# data type of the rows of a ScheduleTable, the INJECT state is stored as
+# an index into the state_names list, paths are stored as indices into the
+# paths list, and the fractional second of the GPS start time is stored
+# separately since it is parsed exactly from the schedule file
+schedule_dtype = numpy.dtype([
+    ("schedule_time", numpy.float64),
+    ("state_code", numpy.int16),
+    ("observation_mode", numpy.int8),
+    ("scale_factor", numpy.float64),
+    ("waveform_index", numpy.int32),
+    ("metadata_index", numpy.int32),
+    ("sample_offset", numpy.int64),
+    ("schedule_fraction", numpy.float64),
+])
+
+class ScheduleTable(object):
+    """ A class representing a schedule as a numpy structured array with one
+    row per injection. This is more compact than a list of HardwareInjection
+    instances and queries over all rows run as numpy array operations.
+
+    Indexing with an integer returns a ScheduleRow. Indexing with a slice,
+    an array of indices, or a boolean mask returns a ScheduleTable.
+
+    Parameters
+    ----------
+    rows: numpy.array
+        A structured array with the data type schedule_dtype.
+    state_names: list
+        A list of INJECT state names indexed by the state_code column.
+    paths: list
+        A list of paths indexed by the waveform_index and metadata_index
+        columns.
+    ifos: list
+        A list of IFOs indexing the per-IFO resolved_index, waveform_length,
+        content_hash, waveform_mtime, and waveform_size columns. These
+        columns are only in tables loaded from a schedule snapshot.
+    """
+
+    __slots__ = ("rows", "state_names", "paths", "ifos")
+
+    def __init__(self, rows, state_names, paths, ifos=()):
+        self.rows = rows
+        self.state_names = state_names
+        self.paths = paths
+        self.ifos = list(ifos)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for i in range(len(self.rows)):
+            yield ScheduleRow(self, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, numpy.integer)):
+            if index < 0:
+                index += len(self.rows)
+            return ScheduleRow(self, index)
+        return ScheduleTable(self.rows[index], self.state_names, self.paths,
+                             ifos=self.ifos)
+
+    def state_code(self, schedule_state):
+        """ Returns the code of an INJECT state in the state_code column. If
+        the state is not in the table then -1 is returned.
+        """
+        if schedule_state in self.state_names:
+            return self.state_names.index(schedule_state)
+        return -1
+
+    def select(self, schedule_state=None, observation_mode=None,
+               start_time=None, end_time=None):
+        """ Returns the rows that match all of the given criteria.
+
+        Parameters
+        ----------
+        schedule_state: str
+            INJECT state of the rows.
+        observation_mode: int
+            Observation mode of the rows.
+        start_time: float
+            Rows are scheduled at or after this GPS time.
+        end_time: float
+            Rows are scheduled before this GPS time.
+
+        Returns
+        ----------
+        schedule_table: ScheduleTable
+            A table with the rows that match.
+        """
+        mask = numpy.ones(len(self.rows), dtype=bool)
+        if schedule_state is not None:
+            mask &= self.rows["state_code"] == self.state_code(schedule_state)
+        if observation_mode is not None:
+            mask &= self.rows["observation_mode"] == observation_mode
+        if start_time is not None:
+            mask &= self.rows["schedule_time"] >= start_time
+        if end_time is not None:
+            mask &= self.rows["schedule_time"] < end_time
+        return self[mask]
+
+    def sort(self):
+        """ Returns the table sorted by scheduled time.
+        """
+        return self[numpy.argsort(self.rows["schedule_time"], kind="mergesort")]
+
+    def to_hwinj_list(self):
+        """ Returns a list with a HardwareInjection instance for each row.
+        """
+        return [row.to_hwinj() for row in self]
+
+class ScheduleRow(object):
+    """ A class representing a view of one row of a ScheduleTable. It has the
+    same schedule attributes as a HardwareInjection.
+
+    Parameters
+    ----------
+    table: ScheduleTable
+        The table of the row.
+    index: int
+        The index of the row in the table.
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __repr__(self):
+        """ String representation of instance.
+        """
+        return "<" + " ".join(map(str, [self.schedule_time, self.schedule_state])) + " ScheduleRow>"
+
+    @property
+    def schedule_time(self):
+        return float(self.table.rows["schedule_time"][self.index])
+
+    @property
+    def schedule_state(self):
+        return self.table.state_names[self.table.rows["state_code"][self.index]]
+
+    @property
+    def observation_mode(self):
+        return int(self.table.rows["observation_mode"][self.index])
+
+    @property
+    def scale_factor(self):
+        return float(self.table.rows["scale_factor"][self.index])
+
+    @property
+    def waveform_path(self):
+        return self.table.paths[self.table.rows["waveform_index"][self.index]]
+
+    @property
+    def metadata_path(self):
+        return self.table.paths[self.table.rows["metadata_index"][self.index]]
+
+    @property
+    def sample_offset(self):
+        return int(self.table.rows["sample_offset"][self.index])
+
+    @property
+    def schedule_fraction(self):
+        return float(self.table.rows["schedule_fraction"][self.index])
+
+    def resolved_waveform_path(self, ifo):
+        """ Returns the waveform path with {ifo} replaced by an IFO. If the
+        table was loaded from a schedule snapshot with the IFO then the
+        resolved path is not formatted again.
+        """
+        if ifo in self.table.ifos:
+            i = self.table.ifos.index(ifo)
+            return self.table.paths[self.table.rows["resolved_index"][self.index][i]]
+        return self.waveform_path.format(ifo=ifo)
+
+    def waveform_length(self, ifo):
+        """ Returns the number of samples in the waveform file for an IFO from
+        the schedule snapshot. If it is not known then None.
+        """
+        if ifo in self.table.ifos:
+            i = self.table.ifos.index(ifo)
+            length = int(self.table.rows["waveform_length"][self.index][i])
+            if length >= 0:
+                return length
+        return None
+
+    def content_hash(self, ifo):
+        """ Returns the content hash of the waveform file for an IFO from the
+        schedule snapshot. If it is not known, or the modification time or
+        size of the waveform file changed since the snapshot was written,
+        then None.
+        """
+        if ifo in self.table.ifos:
+            i = self.table.ifos.index(ifo)
+            digest = self.table.rows["content_hash"][self.index][i]
+            if not digest:
+                return None
+            try:
+                stat = os.stat(self.resolved_waveform_path(ifo))
+            except OSError:
+                return None
+            if stat.st_mtime == self.table.rows["waveform_mtime"][self.index][i] \
+                    and stat.st_size == self.table.rows["waveform_size"][self.index][i]:
+                return digest.decode("ascii")
+        return None
+
+    def to_hwinj(self):
+        """ Returns a HardwareInjection instance for the row. If the table is
+        from a schedule snapshot then the row is kept as the schedule_row
+        attribute of the injection so the snapshot columns can be used.
+        """
+        hwinj = HardwareInjection(self.schedule_time, self.schedule_state,
+                                  self.observation_mode, self.scale_factor,
+                                  self.waveform_path, self.metadata_path,
+                                  sample_offset=self.sample_offset,
+                                  schedule_fraction=self.schedule_fraction)
+        if self.table.ifos:
+            hwinj.schedule_row = self
+        return hwinj
 
 def check_imminent_injection(hwinj_list, imminent_wait_time):
     """ Find the most imminent hardware injection, this is the injection in the
@@ -118,9 +780,11 @@ def check_imminent_injection(hwinj_list, imminent_wait_time):
     ----------
     hwinj_list: list
         A list of HardwareInjection instances.
-    imminent_wait_time: float
+    imminent_wait_time: {float, function}
         Seconds to check from current time to determine if a hardware
-        injection is imminent.
+        injection is imminent. If a function then it is called with the
+        soonest HardwareInjection and should return the seconds to check
+        for that injection.
 
     Retuns
     ----------
@@ -132,25 +796,42 @@ def check_imminent_injection(hwinj_list, imminent_wait_time):
     # get the current GPS time
     current_gps_time = gpstime.utcnow().gps()
 
+    # a LazySchedule is sorted so it finds the injection without making a
+    # HardwareInjection for each row
+    if hasattr(hwinj_list, "find_imminent"):
+        return hwinj_list.find_imminent(current_gps_time, imminent_wait_time)
+
     # find the injection in the future and soonest to the present
     if len(hwinj_list):
         imminent_hwinj = min(hwinj_list,
                              key=lambda hwinj: hwinj.schedule_time-current_gps_time \
                                  if hwinj.schedule_time-current_gps_time > 0 else float("inf"))
+        if callable(imminent_wait_time):
+            imminent_wait_time = imminent_wait_time(imminent_hwinj)
         if imminent_hwinj.schedule_time-current_gps_time < imminent_wait_time \
                       and imminent_hwinj.schedule_time-current_gps_time > 0:
             return imminent_hwinj
     return None
 
-def get_last_injection(hwinj_list):
+def get_last_injection(hwinj_list, history=None, start_time=None):
     """ Find the most recent hardware injection, this is the injection that is
     in the past and closest to the current GPS time. The injection must be
-    within look_back_seconds for it to be returned.
+    scheduled at or after start_time for it to be returned.
+
+    If there is an injection history then the most recent injection in the
+    history is returned instead, so the schedule is not scanned and injections
+    that were not attempted are skipped.
 
     Parameters
     ----------
     hwinj_list: list
         A list of HardwareInjection instances.
+    history: InjectionHistory
+        If not None then find the most recent injection in the history.
+    start_time: float
+        If not None then only return an injection scheduled at or after this
+        GPS time, eg. the time the node was loaded, so that an injection from
+        a previous run is not returned.
 
     Retuns
     ----------
@@ -162,28 +843,160 @@ def get_last_injection(hwinj_list):
     # get the current GPS time
     current_gps_time = gpstime.utcnow().gps()
 
+    # use the injection history
+    if history is not None:
+        return history.get_last_injection(current_gps_time,
+                                          start_time=start_time)
+    if hasattr(hwinj_list, "find_last"):
+        recent_hwinj = hwinj_list.find_last(current_gps_time)
+
     # find the injection in the past and most recent
-    if len(hwinj_list):
+    elif len(hwinj_list):
         recent_hwinj = min(hwinj_list,
                            key=lambda hwinj: abs(hwinj.schedule_time-current_gps_time) \
                                if hwinj.schedule_time-current_gps_time < 0 else float("inf"))
-        if recent_hwinj.schedule_time-current_gps_time < 0:
-            return recent_hwinj
-    return None
+        if recent_hwinj.schedule_time-current_gps_time >= 0:
+            recent_hwinj = None
+    else:
+        recent_hwinj = None
+
+    # check injection is within the current run
+    if recent_hwinj is not None and start_time is not None \
+            and recent_hwinj.schedule_time < start_time:
+        return None
+    return recent_hwinj
 
-def close_all_streams(hwinj_list):
-    """ Run abort and close for all streams.
+def get_next_injection(hwinj_list, hwinj):
+    """ Find the hardware injection that is scheduled soonest after another
+    hardware injection.
 
     Parameters
     ----------
     hwinj_list: list
         A list of HardwareInjection instances.
+    hwinj: HardwareInjection
+        The injection to find the next injection after.
+
+    Retuns
+    ----------
+    next_hwinj: HardwareInjection
+        A HardwareInjection instance is returned if there is an injection
+        scheduled after hwinj.
+    """
+    if hasattr(hwinj_list, "find_next"):
+        return hwinj_list.find_next(hwinj.schedule_time)
+    later_hwinj_list = [later_hwinj for later_hwinj in hwinj_list
+                        if later_hwinj.schedule_time > hwinj.schedule_time]
+    if later_hwinj_list:
+        return min(later_hwinj_list, key=lambda later_hwinj: later_hwinj.schedule_time)
+    return None
+
+def record_samples_delivered(hwinj, gps_time, sample_rate):
+    """ Records how many samples of the waveform of a hardware injection have
+    been delivered by its stream at a GPS time, eg. when the injection is
+    interrupted. The stream delivers samples in real time from schedule_time
+    so this is the number of samples before the GPS time. If injections were
+    coalesced into the stream then it is recorded for each of them.
+
+    The samples_delivered attribute of each injection is set to the offset
+    of the next sample in the waveform, ie. it includes sample_offset, so it
+    can be used as the sample_offset to resume the injection.
+
+    Parameters
+    ----------
+    hwinj: HardwareInjection
+        The injection whose stream was sending data.
+    gps_time: float
+        The GPS time the stream stopped.
+    sample_rate: int
+        Sample rate of the time series.
+
+    Retuns
+    ----------
+    interrupted_hwinj_list: list
+        The HardwareInjection instances that were started but not finished.
+    """
+
+    # get the data of each injection in the stream
+    coalesced_hwinj_list = hwinj.coalesced_hwinj_list or [hwinj]
+    parts = getattr(hwinj.data, "parts", None) or [(0, hwinj.data)]
+
+    # get samples delivered by the stream and then by each injection
+    n_delivered = int((gps_time - hwinj.schedule_time) * sample_rate)
+    interrupted_hwinj_list = []
+    for coalesced_hwinj, (offset, data) in zip(coalesced_hwinj_list, parts):
+        n = min(max(n_delivered - offset, 0), len(data))
+        coalesced_hwinj.samples_delivered = coalesced_hwinj.sample_offset + n
+        if 0 < n < len(data):
+            interrupted_hwinj_list.append(coalesced_hwinj)
+    return interrupted_hwinj_list
+
+def _abort_stream(hwinj, stream, errors):
+    """ Run abort and close for a stream. An exception is stored in errors
+    keyed by the HardwareInjection since it cannot be raised from the thread.
+    """
+    try:
+        stream.abort()
+        stream.close()
+    except Exception as e:
+        errors[hwinj] = e
+
+def close_all_streams(hwinj_list=None, keep=(), timeout=None):
+    """ Run abort and close for all streams and release all data. The streams
+    are aborted concurrently in threads. After all streams are closed or the
+    timeout has passed, a RuntimeError is raised that lists the streams that
+    raised an exception and the streams that were not closed in time.
+
+    Parameters
+    ----------
+    hwinj_list: list
+        A list of HardwareInjection instances. If None then the injections in
+        active_injections, ie. all injections that hold a stream or data.
+    keep: list
+        HardwareInjection instances whose streams and data are not closed,
+        eg. an injection prepared while another injection was active.
+    timeout: float
+        Maximum seconds to wait for each stream to be aborted and closed. If
+        None then stream_abort_timeout when the function is called.
     """
 
-    # close all streams
+    # release data and start a thread to abort each stream
+    if hwinj_list is None:
+        hwinj_list = active_injections
+    if timeout is None:
+        timeout = stream_abort_timeout
+    threads = []
+    errors = {}
     for hwinj in hwinj_list:
-        hwinj.data = None
+        if any(hwinj is keep_hwinj for keep_hwinj in keep):
+            continue
+        hwinj.release_data()
         if hwinj.stream is not None:
-            hwinj.stream.abort()
-            hwinj.stream.close()
+            thread = threading.Thread(target=_abort_stream,
+                                      args=(hwinj, hwinj.stream, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append((hwinj, thread))
             hwinj.stream = None
+        active_injections.discard(hwinj)
+
+    # wait for streams to be aborted, the deadline is shared since the
+    # threads run at the same time
+    deadline = time.time() + timeout
+    not_closed = []
+    for hwinj, thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            not_closed.append(hwinj)
+
+    # raise the errors of all streams together
+    messages = []
+    for hwinj, thread in threads:
+        if hwinj in errors:
+            messages.append("%s raised %s: %s"%(str(hwinj),
+                            type(errors[hwinj]).__name__, errors[hwinj]))
+    if not_closed:
+        messages.append("Streams were not closed within %f seconds: %s"
+                        %(timeout, ", ".join(map(str, not_closed))))
+    if messages:
+        raise RuntimeError("Could not close all streams. " + " ".join(messages))
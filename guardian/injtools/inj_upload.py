@@ -5,17 +5,301 @@ INJ GraceDB module
 
 This module provides functions for uploading hardware injections to GraceDB.
 
+Each call to GraceDB is made in a thread that is waited on for at most
+gracedb_timeout seconds or until a deadline, so a hung request cannot block
+the guardian node. A failed call is retried up to gracedb_max_attempts times
+while there is time before the deadline. Calls that add to GraceDB, eg.
+createEvent, are only retried if the error shows nothing was added, ie. the
+connection was refused or GraceDB returned a status in gracedb_retry_statuses,
+so that a retry does not add a second event. Other HTTP error responses are
+not retried for any call. If gracedb_breaker_threshold calls
+fail in a row then the circuit breaker opens and calls fail immediately until
+gracedb_breaker_reset_seconds have passed.
+
 2016 - Christopher M. Biwer
 """
 
+import errno
 import inj_io
 import sys
 import tempfile
+import threading
+import time
 import traceback
-import ligo.gracedb.rest as gracedb_rest
+from gpstime import gpstime
+from inj_lazy import LazyModule
+
+# the GraceDB client is slow to import so it is imported when first used
+gracedb_rest = LazyModule("ligo.gracedb.rest")
+
+# function that returns a client with the createEvent, writeLog, and
+# writeLabel methods of the GraceDB client, if None then the GraceDB client
+gracedb_backend = None
+
+def set_gracedb_backend(backend):
+    """ Sets the function that returns the client used to upload to GraceDB,
+    eg. to upload to a GraceDbEmulator instead of GraceDB.
+
+    Parameters
+    ----------
+    backend: function
+        A function that takes no arguments and returns a client with the
+        createEvent, writeLog, and writeLabel methods of the GraceDB client.
+        If None then the GraceDB client is used.
+    """
+    global gracedb_backend
+    gracedb_backend = backend
+
+# maximum seconds to wait for each attempt of a call to GraceDB
+gracedb_timeout = 30.0
+
+# maximum number of attempts of a call to GraceDB
+gracedb_max_attempts = 3
+
+# seconds to wait before the first retry, doubled for each retry after that
+gracedb_retry_wait = 1.0
+
+# methods of the GraceDB client that can be called again after any failure
+# since calling them twice has the same result as calling them once, other
+# methods are only retried after errors that show the call was not made
+gracedb_idempotent_methods = ["writeLabel"]
+
+# HTTP statuses that show GraceDB did not act on a call, ie. too many
+# requests and service unavailable, other statuses are not retried since
+# either the call may have been made, eg. a proxy timed out, or a retry will
+# fail again, eg. the call was not authorized
+gracedb_retry_statuses = [429, 503]
+
+# number of failed attempts in a row before the circuit breaker opens and
+# seconds before it lets an attempt through again
+gracedb_breaker_threshold = 5
+gracedb_breaker_reset_seconds = 60.0
+
+class CircuitBreaker(object):
+    """ A class that stops calls to a service after repeated failures so that
+    callers fail immediately instead of waiting for a service that is down.
+
+    The breaker is closed until threshold failures in a row are recorded.
+    Then it is open and no calls are allowed for reset_seconds. After that one
+    call is allowed; if it succeeds the breaker closes and if it fails the
+    breaker stays open for another reset_seconds.
+
+    Parameters
+    ----------
+    threshold: int
+        Number of failures in a row that opens the breaker.
+    reset_seconds: float
+        Seconds the breaker stays open.
+    """
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.n_failures = 0
+        self.open_time = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """ Returns True if the breaker is open and calls are not allowed.
+        """
+        return self.open_time is not None \
+                   and time.time() - self.open_time < self.reset_seconds
+
+    def allow(self):
+        """ Returns True if a call is allowed. If the breaker has been open for
+        reset_seconds then one call is allowed and the breaker is opened again
+        until the call is recorded.
+        """
+        with self.lock:
+            if self.open_time is None:
+                return True
+            if time.time() - self.open_time < self.reset_seconds:
+                return False
+            self.open_time = time.time()
+            return True
+
+    def record_success(self):
+        """ Records a successful call and closes the breaker.
+        """
+        with self.lock:
+            self.n_failures = 0
+            self.open_time = None
+
+    def record_failure(self):
+        """ Records a failed call and opens the breaker if there have been
+        threshold failures in a row.
+        """
+        with self.lock:
+            self.n_failures += 1
+            if self.n_failures >= self.threshold:
+                self.open_time = time.time()
+
+# circuit breaker for all calls to GraceDB
+gracedb_breaker = CircuitBreaker(gracedb_breaker_threshold,
+                                 gracedb_breaker_reset_seconds)
+
+def get_gracedb_client():
+    """ Returns a client to upload to GraceDB. See set_gracedb_backend.
+
+    Returns
+    ----------
+    client: object
+        A ligo.gracedb.rest.GraceDb instance or the client returned by the
+        function set with set_gracedb_backend.
+    """
+    if gracedb_backend is not None:
+        return gracedb_backend()
+    return gracedb_rest.GraceDb()
+
+# re-raises an exception with its original traceback, the python 2 syntax is
+# executed so that the module can also be compiled with python 3
+if sys.version_info[0] >= 3:
+    def _reraise(etype, val, tb):
+        raise val.with_traceback(tb)
+else:
+    exec("def _reraise(etype, val, tb):\n"
+         "    raise etype, val, tb\n")
+
+def get_http_status(error):
+    """ Returns the HTTP status of an error from a call to GraceDB.
+
+    Parameters
+    ----------
+    error: Exception
+        The error raised by the call.
+
+    Returns
+    ----------
+    status: int
+        The HTTP status or None if the error is not an HTTP error response.
+    """
+    for attr in ["status", "code"]:
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+def is_not_made_error(error):
+    """ Returns True if an error from a call to GraceDB shows that the call
+    was not made, ie. the connection was refused or GraceDB returned a status
+    in gracedb_retry_statuses. Any other error, eg. a timeout or an HTTP
+    error response such as a gateway timeout, returns False since GraceDB
+    may have received the call.
+
+    Parameters
+    ----------
+    error: Exception
+        The error raised by the call.
+
+    Returns
+    ----------
+    not_made: bool
+        True if the call can be made again without being repeated.
+    """
+
+    # HTTP error responses have a status code
+    status = get_http_status(error)
+    if status is not None:
+        return status in gracedb_retry_statuses
+
+    # connection refused may be wrapped in the reason of a URL error
+    for err in [error, getattr(error, "reason", None)]:
+        if getattr(err, "errno", None) == errno.ECONNREFUSED:
+            return True
+    return False
+
+def _call_with_timeout(func, timeout):
+    """ Calls a function in a thread and waits for it for at most timeout
+    seconds. If the function does not return in time then the thread is left
+    to finish in the background and a RuntimeError is raised.
+    """
+    result = {}
+    def target():
+        try:
+            result["value"] = func()
+        except Exception:
+            result["error"] = sys.exc_info()
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(max(timeout, 0))
+    if thread.is_alive():
+        raise RuntimeError("GraceDB call did not finish within %f seconds"%timeout)
+    if "error" in result:
+        _reraise(*result["error"])
+    return result["value"]
+
+def gracedb_call(method_name, args=(), kwargs=None, deadline=None):
+    """ Calls a method of a GraceDB client with a timeout, retries, and the
+    circuit breaker. A new client is made for each attempt since making a
+    client can also contact GraceDB.
+
+    An attempt that times out may still finish in the background, so methods
+    that are not in gracedb_idempotent_methods are only retried if
+    is_not_made_error returns True for the error. An HTTP error response with
+    a status that is not in gracedb_retry_statuses is not retried for any
+    method. An error that is not retried is raised with its original
+    traceback.
+
+    Parameters
+    ----------
+    method_name: str
+        Name of the method, eg. createEvent.
+    args: tuple
+        Positional arguments of the method.
+    kwargs: dict
+        Keyword arguments of the method.
+    deadline: float
+        GPS time the call must finish by. If None then each attempt can take
+        gracedb_timeout seconds.
+
+    Returns
+    ----------
+    out: object
+        The return value of the method.
+    """
+    kwargs = kwargs or {}
+    func = lambda: getattr(get_gracedb_client(), method_name)(*args, **kwargs)
+
+    # get end time of call from deadline
+    if deadline is not None:
+        end_time = time.time() + deadline - gpstime.utcnow().gps()
+    else:
+        end_time = None
+
+    # try until a call succeeds or there are no attempts or time left
+    for attempt in range(gracedb_max_attempts):
+        if not gracedb_breaker.allow():
+            raise RuntimeError("Not calling GraceDB %s since there were %d "
+                               "failures in a row"%(method_name,
+                                                    gracedb_breaker.n_failures))
+        timeout = gracedb_timeout
+        if end_time is not None:
+            timeout = min(timeout, end_time - time.time())
+            if timeout <= 0:
+                raise RuntimeError("No time left before deadline to call "
+                                   "GraceDB %s"%method_name)
+        try:
+            out = _call_with_timeout(func, timeout)
+        except Exception:
+            etype, val, tb = sys.exc_info()
+            gracedb_breaker.record_failure()
+            wait = gracedb_retry_wait * 2**attempt
+            if attempt + 1 == gracedb_max_attempts or gracedb_breaker.is_open \
+                    or (end_time is not None and time.time() + wait >= end_time) \
+                    or (method_name not in gracedb_idempotent_methods
+                        and not is_not_made_error(val)) \
+                    or get_http_status(val) not in [None] + gracedb_retry_statuses:
+                _reraise(etype, val, tb)
+            time.sleep(wait)
+            continue
+        gracedb_breaker.record_success()
+        return out
 
 def gracedb_upload_injection(hwinj, ifo_list,
-                             pipeline="HardwareInjection", group="Test"):
+                             pipeline="HardwareInjection", group="Test",
+                             deadline=None):
     """ Uploads an event to GraceDB.
 
     Parameters
@@ -28,6 +312,9 @@ def gracedb_upload_injection(hwinj, ifo_list,
         The pipeline to tag for the GraceDB event.
     group: str
         The group to tag for the GraceDB event.
+    deadline: float
+        GPS time the upload must finish by, eg. a little before the
+        schedule_time of the injection. If None then there is no deadline.
 
     Returns
     ----------
@@ -36,10 +323,6 @@ def gracedb_upload_injection(hwinj, ifo_list,
         uploaded.
     """
 
-    # begin GraceDB API
-    client = gracedb_rest.GraceDb()
-
-
     # read meta-data file
     if hwinj.metadata_path != "None":
         file_contents = inj_io.read_metadata(hwinj.metadata_path,
@@ -55,16 +338,18 @@ def gracedb_upload_injection(hwinj, ifo_list,
     ifo_str = ",".join(ifo_list)
 
     # upload event to GraceDB
-    out = client.createEvent(group, pipeline, hwinj.metadata_path,
-                             filecontents=file_contents, instrument=ifo_str,
-                             source_channel="", destination_channel="")
+    out = gracedb_call("createEvent", (group, pipeline, hwinj.metadata_path),
+                       {"filecontents" : file_contents, "instrument" : ifo_str,
+                        "source_channel" : "", "destination_channel" : ""},
+                       deadline=deadline)
 
     # get GraceDB ID
     gracedb_id = out.json()["graceid"]
 
     return gracedb_id
 
-def gracedb_upload_message(gracedb_id, message, tagname="analyst comments"):
+def gracedb_upload_message(gracedb_id, message, tagname="analyst comments",
+                           deadline=None):
     """ Adds a message to the GraceDB entry.
 
     Parameters
@@ -75,15 +360,15 @@ def gracedb_upload_message(gracedb_id, message, tagname="analyst comments"):
         The message to be appended to the GraceDB ID entry.
     tagname: str
         The name of the tag to use for GraceDB event.
+    deadline: float
+        GPS time the upload must finish by. If None then there is no deadline.
     """
 
-    # begin GraceDB API
-    client = gracedb_rest.GraceDb()
-
     # append comment to GraceDB entry
-    out = client.writeLog(gracedb_id, message, tagname=tagname)
+    out = gracedb_call("writeLog", (gracedb_id, message), {"tagname" : tagname},
+                       deadline=deadline)
 
-def gracedb_add_label(gracedb_id, label):
+def gracedb_add_label(gracedb_id, label, deadline=None):
     """ Adds a message to the GraceDB entry.
 
     Parameters
@@ -92,11 +377,10 @@ def gracedb_add_label(gracedb_id, label):
         The GraceDB ID of the entry to be appended.
     label: str
         The label to be appended to the GraceDB ID entry.
+    deadline: float
+        GPS time the upload must finish by. If None then there is no deadline.
     """
 
-    # begin GraceDB API
-    client = gracedb_rest.GraceDb()
-
     # append comment to GraceDB entry
-    out = client.writeLabel(gracedb_id, label)
+    out = gracedb_call("writeLabel", (gracedb_id, label), deadline=deadline)
 
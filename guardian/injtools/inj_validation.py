@@ -0,0 +1,148 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+"""
+INJ validation guardian module
+
+This module provides a class for storing the results of validating the
+waveform and meta-data files of a schedule so that only new or changed files
+are validated again.
+
+2016 - Christopher M. Biwer
+"""
+
+import inj_io
+import inj_noise
+import json
+import os
+import os.path
+
+class ValidationCache(object):
+    """ A class that stores validation results in a JSON file. Results are
+    keyed by the waveform path, meta-data path, and the sample rate the
+    waveform was validated at, since the length and band power fractions of a
+    resampled waveform depend on the sample rate. Each result has the
+    modification time, size, and content hash of both files. A result is used
+    if the modification time and size of both files are unchanged, or if they
+    changed but the content hashes are unchanged.
+
+    Parameters
+    ----------
+    cache_path: str
+        Path to the JSON file.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.results = {}
+        if os.path.exists(cache_path):
+            fp = open(cache_path, "r")
+            try:
+                self.results = json.load(fp)
+            except ValueError:
+                self.results = {}
+            fp.close()
+
+    @staticmethod
+    def _key(waveform_path, metadata_path, sample_rate):
+        return "%s %s %d"%(waveform_path, metadata_path, sample_rate)
+
+    @staticmethod
+    def _file_state(path):
+        """ Returns the modification time and size of a file. If the path is
+        "None" or a spec of a synthetic waveform then there is no file and None
+        is returned. For a spec of generated noise the power spectral density
+        file is used.
+        """
+        if path == "None" or inj_io.get_waveform_ftype(path) == "synthetic":
+            return None
+        if inj_io.get_waveform_ftype(path) == "noise":
+            path = inj_noise.parse_noise_spec(path)[0]
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+
+    def lookup(self, waveform_path, metadata_path, sample_rate):
+        """ Returns the stored result for a waveform and meta-data file if the
+        files have not changed since they were validated at the sample rate.
+
+        Parameters
+        ----------
+        waveform_path: str
+            Path to the waveform file.
+        metadata_path: str
+            Path to the meta-data file or "None".
+        sample_rate: int
+            Sample rate the waveform is validated at.
+
+        Returns
+        ----------
+        result: dict
+            The stored result that has a waveform_length key, a scan key
+            with the fields of the WaveformScan, and a band_fractions
+            key that maps "<low>-<high>" frequency bands to the fraction of
+            power in the band. If the files have not been validated or have
+            changed then None.
+        """
+
+        # get stored result
+        result = self.results.get(self._key(waveform_path, metadata_path,
+                                            sample_rate))
+        if result is None:
+            return None
+
+        # compare modification time and size and if those changed
+        # then compare content hash
+        for name, path in [("waveform", waveform_path),
+                           ("metadata", metadata_path)]:
+            try:
+                state = self._file_state(path)
+            except OSError:
+                return None
+            if state == result[name + "_state"]:
+                continue
+            if inj_io.file_content_hash(path) != result[name + "_hash"]:
+                return None
+            result[name + "_state"] = state
+
+        return result
+
+    def store(self, waveform_path, metadata_path, sample_rate, waveform_length,
+              scan=None, band_fractions=None):
+        """ Stores the result of validating a waveform and meta-data file.
+
+        Parameters
+        ----------
+        waveform_path: str
+            Path to the waveform file.
+        metadata_path: str
+            Path to the meta-data file or "None".
+        sample_rate: int
+            Sample rate the waveform was validated at.
+        waveform_length: int
+            Number of samples in the waveform at the sample rate.
+        scan: WaveformScan
+            The safety scan of the waveform file.
+        band_fractions: dict
+            Maps "<low>-<high>" frequency bands to the fraction of power of
+            the waveform in the band.
+        """
+        result = {"waveform_length" : waveform_length}
+        if scan is not None:
+            result["scan"] = list(scan)
+        if band_fractions is not None:
+            result["band_fractions"] = band_fractions
+        for name, path in [("waveform", waveform_path),
+                           ("metadata", metadata_path)]:
+            result[name + "_state"] = self._file_state(path)
+            result[name + "_hash"] = inj_io.file_content_hash(path) \
+                                         if path != "None" else None
+        self.results[self._key(waveform_path, metadata_path,
+                               sample_rate)] = result
+
+    def save(self):
+        """ Writes the results to the JSON file.
+        """
+        tmp_path = self.cache_path + ".tmp%d"%os.getpid()
+        fp = open(tmp_path, "w")
+        json.dump(self.results, fp)
+        fp.close()
+        os.rename(tmp_path, self.cache_path)
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+import argparse
+import collections
+import injtools
+import logging
+import numpy
+import sys
+import threading
+import time
+
+"""
+Measures the throughput and failure behavior of uploading hardware injections
+to GraceDB with the functions in injtools, using a local GraceDB emulator so
+that it can be run on an offline machine.
+
+By default an emulator is started in this process. Use --serve to only run
+an emulator, eg. for a guardian node with gracedb_emulator_url set, or use
+--url to benchmark against an emulator that is already running.
+
+2016 - Christopher M. Biwer
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", type=str,
+                    help="URL of a running emulator, if not given then an emulator is started.")
+parser.add_argument("--port", type=int, default=0,
+                    help="Port of the emulator that is started, default is a free port.")
+parser.add_argument("--serve", action="store_true",
+                    help="Only run the emulator until interrupted.")
+parser.add_argument("--latency", type=float, default=0.0,
+                    help="Seconds the emulator waits before each response.")
+parser.add_argument("--latency-jitter", type=float, default=0.0,
+                    help="Maximum seconds of random latency added to each response.")
+parser.add_argument("--error-rate", type=float, default=0.0,
+                    help="Fraction of requests the emulator fails.")
+parser.add_argument("--rate-limit", type=float,
+                    help="Maximum requests per second the emulator allows.")
+parser.add_argument("--burst", type=int, default=1,
+                    help="Number of requests the emulator allows at once before the rate limit applies.")
+parser.add_argument("--n-events", type=int, default=1000,
+                    help="Number of events to upload.")
+parser.add_argument("--n-threads", type=int, default=16,
+                    help="Number of threads uploading events.")
+parser.add_argument("--ifos", nargs="+", default=["H1"],
+                    help="IFOs of the events.")
+parser.add_argument("--metadata-path", type=str, default="None",
+                    help="Path to the meta-data file of the events, default is an empty sim_inspiral table.")
+parser.add_argument("--post-inject-update", action="store_true",
+                    help="Also add a message and a label to each event as the node does after an injection.")
+opts = parser.parse_args()
+if opts.serve and opts.url:
+    parser.error("--serve starts an emulator so it cannot be used with --url")
+
+# setup log
+logging.basicConfig(format="%(asctime)s : %(levelname)s : %(message)s", level=logging.DEBUG)
+
+# start emulator
+emulator = None
+if opts.url is None:
+    emulator = injtools.GraceDbEmulator(port=opts.port, latency=opts.latency,
+                                        latency_jitter=opts.latency_jitter,
+                                        error_rate=opts.error_rate,
+                                        rate_limit=opts.rate_limit,
+                                        burst=opts.burst)
+    emulator.start()
+    opts.url = emulator.url
+    logging.info("Started GraceDB emulator at %s", opts.url)
+if opts.serve:
+    try:
+        while True:
+            time.sleep(60)
+            logging.info("Emulator stats: %s", emulator.get_stats())
+    except KeyboardInterrupt:
+        emulator.stop()
+        sys.exit(0)
+
+# upload to emulator
+injtools.set_gracedb_backend(lambda: injtools.EmulatorClient(opts.url))
+
+# make an injection for each event
+hwinj_list = [injtools.HardwareInjection(1000000000 + i, "INJECT_CBC_ACTIVE", 1,
+                                         1.0, "H1-TEST-1000000000-1.txt",
+                                         opts.metadata_path)
+              for i in range(opts.n_events)]
+
+# make an empty sim_inspiral table once before timing so that importing glue
+# is not timed
+if opts.metadata_path == "None":
+    injtools.create_empty_sim_inspiral_xml(hwinj_list[0].schedule_time)
+
+def upload(hwinj):
+    """ Uploads an event and returns its latency.
+    """
+    start_time = time.time()
+    gracedb_id = injtools.gracedb_upload_injection(hwinj, opts.ifos,
+                                                   group="CBC")
+    if opts.post_inject_update:
+        injtools.gracedb_upload_message(gracedb_id, "Injection was successful.")
+        injtools.gracedb_add_label(gracedb_id, "INJ")
+    return time.time() - start_time
+
+# upload events from threads
+lock = threading.Lock()
+latencies = []
+failures = collections.Counter()
+def worker(hwinj_sublist):
+    for hwinj in hwinj_sublist:
+        try:
+            seconds = upload(hwinj)
+        except Exception as e:
+            with lock:
+                failures[type(e).__name__ + " " + str(getattr(e, "code", ""))] += 1
+            continue
+        with lock:
+            latencies.append(seconds)
+logging.info("Uploading %d events with %d threads", opts.n_events, opts.n_threads)
+start_time = time.time()
+threads = [threading.Thread(target=worker, args=(hwinj_list[i::opts.n_threads],))
+           for i in range(opts.n_threads)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+seconds = time.time() - start_time
+
+# print results
+logging.info("Uploaded %d events in %f seconds, %f events per second",
+             len(latencies), seconds, len(latencies) / seconds)
+if latencies:
+    logging.info("Median latency is %f seconds and 99th percentile is %f seconds",
+                 numpy.median(latencies), numpy.percentile(latencies, 99))
+for failure, count in sorted(failures.items()):
+    logging.info("%d uploads failed with %s", count, failure)
+if emulator is not None:
+    logging.info("Emulator stats: %s", emulator.get_stats())
+    emulator.stop()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+
+import argparse
+import logging
+import numpy
+import os.path
+import subprocess
+import sys
+import time
+
+"""
+Measures how long it takes to import injtools and read the schedule, ie. the
+startup cost paid each time the guardian INJ node is loaded or reloaded.
+
+The lazy case imports injtools and creates a LazySchedule as the node does.
+The eager case also imports glue, the GraceDB client, and awg and reads the
+schedule as the node did before these were deferred.
+
+2016 - Christopher M. Biwer
+"""
+
+# code to run in a new python process for each case
+code_dict = {
+    "lazy" : "import injtools; hwinj_list = injtools.LazySchedule({schedule!r})",
+    "eager" : "import injtools; import glue.ligolw.lsctables, glue.ligolw.utils; "
+              "import ligo.gracedb.rest; import awg; "
+              "hwinj_list = injtools.read_schedule({schedule!r})",
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--schedule", type=str,
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         "../guardian/schedule/schedule_1148558052.txt"),
+                    help="Path to the schedule file.")
+parser.add_argument("--guardian-dir", type=str,
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         "../guardian"),
+                    help="Path to the directory with injtools.")
+parser.add_argument("--n-trials", type=int, default=10,
+                    help="Number of times to run each case.")
+opts = parser.parse_args()
+
+# setup log
+logging.basicConfig(format="%(asctime)s : %(levelname)s : %(message)s", level=logging.DEBUG)
+
+# time python startup alone so it can be subtracted
+code_dict["python"] = "pass"
+
+# run each case in a new python process
+env = dict(os.environ)
+env["PYTHONPATH"] = opts.guardian_dir + os.pathsep + env.get("PYTHONPATH", "")
+results = {}
+for case in ["python", "lazy", "eager"]:
+    code = code_dict[case].format(schedule=opts.schedule)
+    times = []
+    for i in range(opts.n_trials):
+        start_time = time.time()
+        ret = subprocess.call([sys.executable, "-c", code], env=env)
+        times.append(time.time() - start_time)
+        if ret:
+            logging.error("Case %s failed", case)
+            break
+    else:
+        results[case] = numpy.median(times)
+
+# print results
+for case in ["lazy", "eager"]:
+    if case in results:
+        logging.info("Median startup time for %s case is %f seconds",
+                     case, results[case] - results["python"])
+if "lazy" in results and "eager" in results:
+    logging.info("Lazy startup is %f seconds faster",
+                 results["eager"] - results["lazy"])
@@ -12,7 +12,8 @@ Validates the guardian INJ schedule.
 """
 
 def waveform_end_time(hwinj, sample_rate):
-    return hwinj.schedule_time + float(hwinj.waveform_length) / sample_rate
+    return hwinj.schedule_time \
+               + float(hwinj.waveform_length - hwinj.sample_offset) / sample_rate
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--ifos", nargs="+",
@@ -24,6 +25,20 @@ parser.add_argument("--min-cadence", type=int,
                          and end of two adjacent injections.")
 parser.add_argument("--sample-rate", type=int, default=16384,
                     help="Sample rate of waveform file and injection channel.")
+parser.add_argument("--max-peak", type=float,
+                    help="Maximum peak amplitude of a waveform, the scale factor is not applied to the excitation.")
+parser.add_argument("--max-rms", type=float,
+                    help="Maximum RMS amplitude of a waveform, the scale factor is not applied to the excitation.")
+parser.add_argument("--max-slew", type=float,
+                    help="Maximum difference between adjacent samples of a waveform, the scale factor is not applied to the excitation.")
+parser.add_argument("--min-band-fraction", type=float,
+                    help="Minimum fraction of power of a waveform that must be in the frequency band expected for its injection state.")
+parser.add_argument("--write-snapshot", action="store_true",
+                    help="Write a snapshot of the schedule if it is valid so the guardian node loads it faster.")
+parser.add_argument("--cache-file", type=str,
+                    help="Path to the file that stores validation results, default is the schedule path with a .validation.json suffix.")
+parser.add_argument("--no-cache", action="store_true",
+                    help="Validate all files even if they have not changed since they were last validated.")
 opts = parser.parse_args()
 
 # setup log
@@ -33,8 +48,16 @@ logging.basicConfig(format="%(asctime)s : %(levelname)s : %(message)s", level=lo
 logging.info("Reading schedule file: %s", opts.schedule)
 hwinj_list = injtools.read_schedule(opts.schedule)
 
+# read stored validation results
+if not opts.no_cache:
+    cache_path = opts.cache_file or opts.schedule + ".validation.json"
+    logging.info("Reading validation results: %s", cache_path)
+    cache = injtools.ValidationCache(cache_path)
+
 # loop over HardwareInjection
 logging.info("Reading waveform and meta-data files")
+waveform_lengths = {}
+n_cached = 0
 for hwinj in hwinj_list:
 
     # loop over IFO
@@ -46,22 +69,91 @@ for hwinj in hwinj_list:
             "ifo" : ifo,
         }
 
-        # check all waveform files are readable
+        # use stored result if waveform and meta-data files have not
+        # changed since they were last validated at this sample rate
         waveform_path = hwinj.waveform_path.format(**format_dict)
-        waveform = injtools.read_waveform(hwinj.waveform_path)
+        result = cache.lookup(waveform_path, hwinj.metadata_path,
+                              opts.sample_rate) \
+                     if not opts.no_cache else None
+        band = injtools.default_band_dict.get(hwinj.schedule_state) \
+                   if opts.min_band_fraction is not None \
+                       and injtools.get_waveform_ftype(waveform_path) != "noise" \
+                   else None
+        band_key = "%f-%f"%tuple(band) if band else None
+        if result is not None and "scan" in result \
+                and (not band_key or band_key in result.get("band_fractions", {})):
+            waveform_length = result["waveform_length"]
+            scan = injtools.WaveformScan(*result["scan"])
+            band_fractions = result.get("band_fractions", {})
+            n_cached += 1
+
+        else:
+
+            # check all waveform files are readable
+            waveform = injtools.read_waveform(waveform_path,
+                             ftype=injtools.get_waveform_ftype(waveform_path),
+                             sample_rate=opts.sample_rate)
+            if injtools.get_waveform_ftype(waveform_path) in ["ascii", "binary"]:
+                waveform = injtools.resample_to_rate(waveform, waveform_path,
+                                                     opts.sample_rate)
+            waveform_length = len(waveform)
+
+            # scan waveform for unsafe values
+            scan = injtools.scan_waveform(waveform)
+
+            # get fraction of power in expected frequency band
+            band_fractions = result.get("band_fractions", {}) \
+                                 if result is not None else {}
+            if band_key:
+                band_fractions[band_key] = injtools.band_power_fraction(
+                                               waveform, opts.sample_rate, band)
+
+            # read meta-data file
+            if hwinj.metadata_path != "None":
+                file_contents = injtools.read_metadata(hwinj.metadata_path,
+                                                       hwinj.waveform_start_time,
+                                                       hwinj.schedule_time)
+
+            # store result
+            if not opts.no_cache:
+                cache.store(waveform_path, hwinj.metadata_path, opts.sample_rate,
+                            waveform_length, scan=scan,
+                            band_fractions=band_fractions)
+
+        # check waveform is safe to inject, the guardian node checks the
+        # samples appended to the stream again after its filters
+        problems = injtools.check_waveform_scan(scan, max_peak=opts.max_peak,
+                                                max_rms=opts.max_rms,
+                                                max_slew=opts.max_slew)
+        if problems:
+            for problem in problems:
+                logging.error("%s: %s", problem, hwinj)
+            sys.exit(1)
+
+        # check power of waveform is in expected frequency band
+        if band_key and band_fractions[band_key] < opts.min_band_fraction:
+            logging.error("Waveform has %f of its power between %f and %f Hz: %s",
+                          band_fractions[band_key], band[0], band[1], hwinj)
+            sys.exit(1)
+
+        # check injection resumes from a sample in the waveform
+        if not 0 <= hwinj.sample_offset < waveform_length:
+            logging.error("Sample offset %d is not in waveform with %d samples: %s",
+                          hwinj.sample_offset, waveform_length, hwinj)
+            sys.exit(1)
 
         # add a length of waveform attribute
+        waveform_lengths[waveform_path] = waveform_length
         if hasattr(hwinj, "waveform_length"):
-            if hwinj.waveform_length != len(waveform):
+            if hwinj.waveform_length != waveform_length:
                 logging.info("Waveform file for different IFOs have different lengths: %s", hwinj)
         else:
-            hwinj.waveform_length = len(waveform)
+            hwinj.waveform_length = waveform_length
 
-        # read meta-data file
-        if hwinj.metadata_path != "None":
-            file_contents = inj_io.read_metadata(hwinj.metadata_path,
-                                                 hwinj.waveform_start_time,
-                                                 hwinj.schedule_time)
+# write stored validation results
+if not opts.no_cache:
+    logging.info("Used %d stored validation results", n_cached)
+    cache.save()
 
 # check that no two injections are within X seconds of each other
 logging.info("Checking cadence of scheduled injections")
@@ -79,5 +171,11 @@ for hwinj_1, hwinj_2 in zip(hwinj_list, hwinj_list[1:]):
     if dt > 0 and abs(dt) < opts.min_cadence:
         logging.warn("Two injections are scheduled close together with only %f seconds from the end of the first injection to the start of the next injection: %s and %s", dt, str(hwinj_2), str(hwinj_1))
 
+# write snapshot
+if opts.write_snapshot:
+    logging.info("Writing snapshot of schedule")
+    injtools.write_schedule_snapshot(opts.schedule, opts.ifos,
+                                     waveform_lengths=waveform_lengths)
+
 # exit
 logging.info("Finished and schedule is valid")
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+
+import argparse
+import functools
+import injtools
+import logging
+import multiprocessing
+import os
+import sys
+
+"""
+Converts ASCII waveform files to binary waveform files that are read faster by
+the guardian INJ node. Each binary file is written next to its ASCII file with
+a ".f64" suffix along with length, checksum, and source sidecar files. A
+binary file is up-to-date if the ASCII file has the same contents as when it
+was converted.
+
+2016 - Christopher M. Biwer
+"""
+
+def convert(waveform_path, compression=None, overwrite=False):
+    try:
+        converted_path = injtools.convert_waveform(waveform_path,
+                                                   compression=compression,
+                                                   overwrite=overwrite)
+        return waveform_path, converted_path, None
+    except Exception as e:
+        return waveform_path, None, "%s: %s"%(type(e).__name__, e)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ifos", nargs="+", default=[],
+                    help="IFOs to substitute for {ifo} in schedule waveform paths, eg. H1 and L1.")
+parser.add_argument("--schedule", type=str,
+                    help="Path to the schedule file with the waveform files to convert.")
+parser.add_argument("--waveform-dir", type=str,
+                    help="Path to a directory with the waveform files to convert.")
+parser.add_argument("--extensions", nargs="+", default=[".txt", ".out"],
+                    help="File extensions of ASCII waveform files in --waveform-dir.")
+parser.add_argument("--compression", type=str, default=None,
+                    choices=sorted(injtools.compression_dict.keys()),
+                    help="Compress binary waveform files, eg. .gz.")
+parser.add_argument("--nproc", type=int, default=multiprocessing.cpu_count(),
+                    help="Number of processes to use.")
+parser.add_argument("--overwrite", action="store_true",
+                    help="Convert files even if the binary file is up-to-date.")
+opts = parser.parse_args()
+
+# setup log
+logging.basicConfig(format="%(asctime)s : %(levelname)s : %(message)s", level=logging.DEBUG)
+
+# get waveform files from schedule; we allow users to use the {ifo}
+# substring substition in the waveform_path column
+waveform_paths = set()
+if opts.schedule:
+    logging.info("Reading schedule file: %s", opts.schedule)
+    hwinj_list = injtools.read_schedule(opts.schedule, include_past=True)
+    for hwinj in hwinj_list:
+        for ifo in opts.ifos or [None]:
+            if ifo is None and "{ifo}" in hwinj.waveform_path:
+                logging.error("Waveform path has {ifo} but no --ifos given: %s", hwinj.waveform_path)
+                sys.exit(1)
+            waveform_paths.add(hwinj.waveform_path.format(ifo=ifo))
+
+# get waveform files from directory
+if opts.waveform_dir:
+    logging.info("Finding waveform files in: %s", opts.waveform_dir)
+    for dir_path, _, filenames in os.walk(opts.waveform_dir):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] in opts.extensions:
+                waveform_paths.add(os.path.join(dir_path, filename))
+
+# remove files that are not ASCII files
+waveform_paths = sorted([waveform_path for waveform_path in waveform_paths
+                         if injtools.get_waveform_ftype(waveform_path) == "ascii"])
+logging.info("Found %d ASCII waveform files", len(waveform_paths))
+
+# convert files in a pool of processes, the options are passed to each process
+# so that it does not rely on forking to see them
+pool = multiprocessing.Pool(opts.nproc)
+func = functools.partial(convert, compression=opts.compression,
+                         overwrite=opts.overwrite)
+n_converted = n_current = n_failed = 0
+for waveform_path, converted_path, error in pool.imap_unordered(func, waveform_paths, chunksize=4):
+    if error:
+        logging.error("Could not convert %s: %s", waveform_path, error)
+        n_failed += 1
+    elif converted_path:
+        logging.debug("Converted %s to %s", waveform_path, converted_path)
+        n_converted += 1
+    else:
+        n_current += 1
+pool.close()
+pool.join()
+
+# exit
+logging.info("Converted %d files, skipped %d up-to-date files, and failed to convert %d files",
+             n_converted, n_current, n_failed)
+if n_failed:
+    sys.exit(1)
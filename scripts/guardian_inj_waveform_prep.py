@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+
+import argparse
+import injtools
+import logging
+import os
+import time
+from gpstime import gpstime
+
+"""
+Prepares the waveforms of upcoming injections in the guardian INJ schedule and
+writes them to a shared-memory directory. Set shm_dir in the guardian node to
+the same directory so that the node memory-maps the prepared waveforms instead
+of reading the waveform files itself.
+
+2016 - Christopher M. Biwer
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ifos", nargs="+", required=True,
+                    help="IFOs to prepare, eg. H1 and L1.")
+parser.add_argument("--schedule", type=str, required=True,
+                    help="Path to the schedule file.")
+parser.add_argument("--shm-dir", type=str, default="/dev/shm/guardian-inj",
+                    help="Path to the shared-memory directory.")
+parser.add_argument("--sample-rate", type=int, default=16384,
+                    help="Sample rate of the injection channel, waveforms with a different rate are resampled.")
+parser.add_argument("--look-ahead", type=float, default=3600,
+                    help="Prepare injections scheduled within this many seconds.")
+parser.add_argument("--interval", type=float, default=10,
+                    help="Seconds to wait between checking the schedule.")
+parser.add_argument("--min-age", type=float, default=3600,
+                    help="Remove prepared waveforms that are no longer scheduled after this many seconds.")
+parser.add_argument("--once", action="store_true",
+                    help="Check the schedule once and then exit.")
+opts = parser.parse_args()
+
+# setup log
+logging.basicConfig(format="%(asctime)s : %(levelname)s : %(message)s", level=logging.DEBUG)
+
+# loop until killed
+while True:
+
+    # read schedule
+    hwinj_list = injtools.read_schedule(opts.schedule)
+    current_gps_time = gpstime.utcnow().gps()
+
+    # loop over injections within look ahead window
+    keep_paths = []
+    for hwinj in hwinj_list:
+        if hwinj.schedule_time - current_gps_time > opts.look_ahead:
+            continue
+
+        # loop over IFO
+        for ifo in opts.ifos:
+            waveform_path = hwinj.waveform_path.format(ifo=ifo)
+            if injtools.get_waveform_ftype(waveform_path) in ["synthetic", "noise"]:
+                continue
+            try:
+                segment_path = injtools.publish_waveform(waveform_path, opts.shm_dir,
+                                                         sample_rate=opts.sample_rate)
+                if segment_path:
+                    logging.info("Prepared %s in %s", waveform_path, segment_path)
+                keep_paths.append(injtools.get_segment_path(waveform_path, opts.shm_dir,
+                                                            sample_rate=opts.sample_rate))
+            except Exception as e:
+                logging.error("Could not prepare %s: %s", waveform_path, e)
+
+    # remove prepared waveforms that are no longer scheduled
+    if os.path.exists(opts.shm_dir):
+        for segment_path in injtools.remove_stale_segments(opts.shm_dir, keep_paths,
+                                                           min_age=opts.min_age):
+            logging.info("Removed %s", segment_path)
+
+    # exit or wait
+    if opts.once:
+        break
+    time.sleep(opts.interval)